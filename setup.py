@@ -9,7 +9,7 @@ setup(
     author_email="stevent3115@gmail.com",
     python_requires='>=3.5,<3.7',
     install_requires=[
-        "boto3 >= 1.10.2",
+        "boto3 >= 1.12.0",
         "gensim >= 3.8.1",
         "giveme5w1h >= 1.0.17",
         "jamspell >= 0.0.11",
@@ -20,6 +20,10 @@ setup(
         "tensorflow >= 2.0.0",
         "textblob >= 0.15.3",
     ],
+    extras_require={
+        "arrow": ["pyarrow >= 0.15.0"],
+        "zstd": ["zstandard >= 0.13.0"],
+    },
     packages=find_packages(),
     entry_points={
         "console_scripts": [
@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+from whatwhy.text_processing.batch_formats import CSVBatchFormat, ArrowBatchFormat, ParquetBatchFormat
+
+def get_test_df():
+    return pd.DataFrame({
+        "ID" : [1, 2],
+        "Text" : ["What happened?", "Why did it happen?"],
+        "Tokens" : [ ["What", "happened", "?"], ["Why", "did", "it", "happen", "?"] ]
+    })
+
+def test_csv_round_trip():
+    batch_format = CSVBatchFormat()
+    batch = batch_format.get_batch_from_df(get_test_df())
+    assert isinstance(batch, str)
+    df = batch_format.get_df_from_batch(batch)
+    assert df["Text"].tolist() == ["What happened?", "Why did it happen?"]
+    assert df["Tokens"].tolist() == ["['What', 'happened', '?']", "['Why', 'did', 'it', 'happen', '?']"]
+    assert batch_format.get_df_from_batch(batch.encode("utf-8"))["Text"].tolist() == df["Text"].tolist()
+
+@pytest.mark.parametrize("batch_format_class", [ArrowBatchFormat, ParquetBatchFormat])
+def test_arrow_round_trip_keeps_token_lists(batch_format_class):
+    pytest.importorskip("pyarrow")
+    batch_format = batch_format_class()
+    batch = batch_format.get_batch_from_df(get_test_df())
+    assert isinstance(batch, bytes)
+    df = batch_format.get_df_from_batch(batch)
+    assert df["ID"].tolist() == [1, 2]
+    assert df["Text"].tolist() == ["What happened?", "Why did it happen?"]
+    assert df["Tokens"].tolist() == [ ["What", "happened", "?"], ["Why", "did", "it", "happen", "?"] ]
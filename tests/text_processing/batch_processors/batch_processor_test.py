@@ -0,0 +1,161 @@
+import multiprocessing
+import threading
+import time
+import pandas as pd
+import pytest
+from whatwhy.text_processing.batch_processors import BatchProcessorBase
+from whatwhy.text_processing.result_cache import LocalResultCache
+
+class ListBatchSource():
+
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.cur_batch = None
+        self.completed_batches = []
+        self.is_closed = False
+
+    def get_next_batch(self):
+        self.cur_batch = next(self.batches)
+        return self.cur_batch
+
+    def get_batch_handle(self):
+        return self.cur_batch
+
+    def mark_batch_as_complete(self, batch_handle=None):
+        self.completed_batches.append(self.cur_batch if batch_handle is None else batch_handle)
+
+    def close(self):
+        self.is_closed = True
+
+class ListBatchDestination():
+
+    def __init__(self, failed_results=(), num_failed_flushes=0):
+        self.results = []
+        self.failed_results = failed_results
+        self.num_failed_flushes = num_failed_flushes
+
+    def publish_batch_results(self, results, target_file_name=None):
+        if results in self.failed_results:
+            return False
+        self.results.append(results)
+        return True
+
+    def flush(self):
+        if self.num_failed_flushes > 0:
+            self.num_failed_flushes -= 1
+            return 1
+        return 0
+
+class UppercaseBatchProcessor(BatchProcessorBase):
+
+    def get_batch_results(self, batch):
+        if batch == "bad batch":
+            raise ValueError(batch)
+        return {
+            "target_results_file_name" : f"{batch}.csv",
+            "file_content" : batch.upper()
+        }
+
+def test_run_only_completes_published_batches():
+    source = ListBatchSource(["batch0", "batch1", "batch2", "batch3"])
+    dest = ListBatchDestination(failed_results=["BATCH1"], num_failed_flushes=1)
+    UppercaseBatchProcessor(source, dest).run()
+    # batch0 fails to be flushed, and batch1 fails to be published.
+    assert source.completed_batches == ["batch2", "batch3"]
+    assert source.is_closed
+
+def test_run_pipelined():
+    batches = [ f"batch{i}" for i in range(20) ]
+    source = ListBatchSource(batches)
+    dest = ListBatchDestination()
+    UppercaseBatchProcessor(source, dest).run_pipelined(fetch_queue_depth=2, publish_queue_depth=3)
+    assert dest.results == [ batch.upper() for batch in batches ]
+    assert source.completed_batches == batches
+    assert source.is_closed
+
+def test_run_pipelined_skips_failed_batches():
+    source = ListBatchSource(["batch0", "bad batch", "batch2"])
+    dest = ListBatchDestination()
+    UppercaseBatchProcessor(source, dest).run_pipelined()
+    assert dest.results == ["BATCH0", "BATCH2"]
+    assert source.completed_batches == ["batch0", "batch2"]
+
+def test_run_pipelined_only_completes_published_batches():
+    source = ListBatchSource(["batch0", "batch1", "batch2"])
+    dest = ListBatchDestination(failed_results=["BATCH1"])
+    UppercaseBatchProcessor(source, dest).run_pipelined()
+    assert source.completed_batches == ["batch0", "batch2"]
+
+    source = ListBatchSource(["batch0", "batch1"])
+    dest = ListBatchDestination(num_failed_flushes=10)
+    UppercaseBatchProcessor(source, dest).run_pipelined()
+    assert source.completed_batches == []
+
+def test_run_pipelined_with_worker_processes():
+    batches = [ f"batch{i}" for i in range(20) ] + ["bad batch"]
+    source = ListBatchSource(batches)
+    dest = ListBatchDestination()
+    UppercaseBatchProcessor(source, dest).run_pipelined(num_workers=3)
+    assert dest.results == [ batch.upper() for batch in batches[:-1] ]
+    assert source.completed_batches == batches[:-1]
+
+def test_worker_processes_require_fork(monkeypatch):
+    monkeypatch.setattr(multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+    source = ListBatchSource(["batch0"])
+    with pytest.raises(AttributeError):
+        UppercaseBatchProcessor(source, ListBatchDestination()).run_pipelined(num_workers=2)
+    assert source.completed_batches == []
+
+class CountingBatchProcessor(BatchProcessorBase):
+
+    def __init__(self, result_cache):
+        super().__init__(None, None, id_col_name="ID", source_col_name="Text", dest_col_name="Result", result_cache=result_cache)
+        self.processed_values = []
+
+    def get_batch_results_df(self, batch_as_df):
+        batch_as_df[self.dest_col_name] = self.get_cached_results(batch_as_df[self.source_col_name], self.get_result, is_cacheable=lambda result: result != "FAILED")
+        return batch_as_df
+
+    def get_result(self, text):
+        self.processed_values.append(text)
+        return "FAILED" if text == "bad" else text.upper()
+
+def test_results_are_cached(tmp_path):
+    result_cache = LocalResultCache(str(tmp_path / "cache.db"))
+    batch_processor = CountingBatchProcessor(result_cache)
+    df = pd.DataFrame({ "ID" : [0, 1, 2, 3], "Text" : ["a", "b", "a", "bad"] })
+    assert list(batch_processor.get_batch_results_df(df)["Result"]) == ["A", "B", "A", "FAILED"]
+    assert batch_processor.processed_values == ["a", "b", "bad"]
+
+    batch_processor = CountingBatchProcessor(result_cache)
+    df = pd.DataFrame({ "ID" : [4, 5, 6], "Text" : ["b", "c", "bad"] })
+    assert list(batch_processor.get_batch_results_df(df)["Result"]) == ["B", "C", "FAILED"]
+    assert batch_processor.processed_values == ["c", "bad"]
+    assert (batch_processor.num_cache_hits, batch_processor.num_cache_misses) == (1, 2)
+
+class SlowBatchProcessor(CountingBatchProcessor):
+
+    def __init__(self, num_result_threads):
+        super().__init__(None)
+        self.num_result_threads = num_result_threads
+        self.lock = threading.Lock()
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+
+    def get_result(self, text):
+        with self.lock:
+            self.num_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+        # Later values finish first, so results complete out of order.
+        time.sleep(0.05 / (1 + int(text)))
+        with self.lock:
+            self.num_in_flight -= 1
+        return f"result {text}"
+
+def test_results_are_computed_concurrently_in_order():
+    batch_processor = SlowBatchProcessor(num_result_threads=3)
+    texts = [ str(i) for i in range(8) ] + ["0"]
+    df = pd.DataFrame({ "ID" : range(len(texts)), "Text" : texts })
+    results = list(batch_processor.get_batch_results_df(df)["Result"])
+    assert results == [ f"result {text}" for text in texts ]
+    assert batch_processor.max_in_flight == 3
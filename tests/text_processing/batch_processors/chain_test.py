@@ -0,0 +1,46 @@
+import pandas as pd
+from whatwhy.text_processing.helper_methods import get_csv_string_from_df, get_df_from_csv_string
+from whatwhy.text_processing.batch_processors import BatchProcessorBase
+from whatwhy.text_processing.batch_processors.chain import ChainedBatchProcessor
+
+class SuffixBatchProcessor(BatchProcessorBase):
+
+    def __init__(self, source_col_name, dest_col_name, suffix):
+        super().__init__(source=None, dest=None, id_col_name="ID", source_col_name=source_col_name, dest_col_name=dest_col_name)
+        self.suffix = suffix
+
+    def get_batch_results_df(self, batch_as_df):
+        batch_as_df[self.dest_col_name] = batch_as_df[self.source_col_name] + self.suffix
+        return batch_as_df[[self.id_col_name, self.dest_col_name]]
+
+class ListBatchDestination():
+
+    def __init__(self):
+        self.results = []
+
+    def publish_batch_results(self, results, target_file_name=None):
+        self.results.append( (target_file_name, results) )
+
+    def flush(self):
+        pass
+
+def get_batch():
+    df = pd.DataFrame({ "ID" : ["1", "2"], "Text" : ["a", "b"] })
+    return get_csv_string_from_df(df)
+
+def test_get_batch_results():
+    batch_processors = [
+        SuffixBatchProcessor("Text", "First", "1"),
+        SuffixBatchProcessor("First", "Second", "2")
+    ]
+    intermediate_dest = ListBatchDestination()
+    chained_batch_processor = ChainedBatchProcessor(None, None, batch_processors, intermediate_dests=[intermediate_dest])
+    results = chained_batch_processor.get_batch_results(get_batch())
+    assert results["target_results_file_name"] == "batch1.csv"
+    df = get_df_from_csv_string(results["file_content"])
+    assert list(df["Second"]) == ["a12", "b12"]
+
+    assert len(intermediate_dest.results) == 1
+    target_file_name, intermediate_results = intermediate_dest.results[0]
+    assert target_file_name == "batch1.csv"
+    assert list(get_df_from_csv_string(intermediate_results)["First"]) == ["a1", "b1"]
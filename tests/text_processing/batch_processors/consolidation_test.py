@@ -0,0 +1,61 @@
+import pandas as pd
+from whatwhy.text_processing.helper_methods import get_csv_string_from_df, get_df_from_csv_string
+from whatwhy.text_processing.batch_processors.consolidation import BatchConsolidator
+from whatwhy.text_processing.clients import FileSystemBatchSource, FileSystemBatchDestination
+from whatwhy.text_processing.clients.compression import GzipCompression
+
+def write_batches(folder, num_batches, batch_size):
+    folder.mkdir()
+    for i in range(num_batches):
+        ids = [ str(i * batch_size + j) for j in range(batch_size) ]
+        df = pd.DataFrame({ "ID" : ids, "Text" : [ f"text {id}" for id in ids ] })
+        (folder / f"batch{i}.csv").write_text(get_csv_string_from_df(df))
+
+def test_consolidate_streams_batches_to_a_single_file(tmp_path):
+    write_batches(tmp_path / "batches", num_batches=5, batch_size=3)
+    source = FileSystemBatchSource(str(tmp_path / "batches"), delete_when_complete=True)
+    dest = FileSystemBatchDestination(str(tmp_path / "consolidated"))
+    BatchConsolidator(source, dest).run_pipelined(fetch_queue_depth=2)
+
+    df = get_df_from_csv_string((tmp_path / "consolidated" / "consolidated_batches.csv").read_text())
+    assert df["ID"].tolist() == [ str(i) for i in range(15) ]
+    assert df["Text"].tolist() == [ f"text {i}" for i in range(15) ]
+    assert list((tmp_path / "batches").iterdir()) == []
+
+def test_consolidate_compressed_output(tmp_path):
+    write_batches(tmp_path / "batches", num_batches=2, batch_size=2)
+    source = FileSystemBatchSource(str(tmp_path / "batches"))
+    dest = FileSystemBatchDestination(str(tmp_path / "consolidated"), compression=GzipCompression())
+    BatchConsolidator(source, dest).run()
+
+    consolidated_file = tmp_path / "consolidated" / "consolidated_batches.csv.gz"
+    df = get_df_from_csv_string(GzipCompression().decompress(consolidated_file.read_bytes()))
+    assert df["ID"].tolist() == ["0", "1", "2", "3"]
+
+def write_batch(folder, file_name, rows):
+    df = pd.DataFrame(rows, columns=["ID", "what", "why"])
+    (folder / file_name).write_text(get_csv_string_from_df(df))
+
+def test_sort_and_dedup_by_id(tmp_path):
+    (tmp_path / "batches").mkdir()
+    write_batch(tmp_path / "batches", "batch0.csv", [ ("10", "a", "b"), ("2", "c", "d") ])
+    write_batch(tmp_path / "batches", "batch1.csv", [ ("1", "e", "f"), ("2", "g", "h"), ("9", "i", "j") ])
+    source = FileSystemBatchSource(str(tmp_path / "batches"))
+    dest = FileSystemBatchDestination(str(tmp_path / "consolidated"))
+    BatchConsolidator(source, dest, sort_and_dedup=True, max_rows_in_memory=2, tmp_dir=str(tmp_path)).run()
+
+    df = get_df_from_csv_string((tmp_path / "consolidated" / "consolidated_batches.csv").read_text())
+    assert df["ID"].tolist() == ["1", "2", "9", "10"]
+    assert df["what"].tolist() == ["e", "c", "i", "a"]
+    assert sorted( path.name for path in tmp_path.iterdir() ) == ["batches", "consolidated"]
+
+def test_sort_and_dedup_by_columns(tmp_path):
+    (tmp_path / "batches").mkdir()
+    write_batch(tmp_path / "batches", "batch0.csv", [ ("5", "a", "b"), ("4", "c", "d") ])
+    write_batch(tmp_path / "batches", "batch1.csv", [ ("3", "a", "b"), ("1", "c", "x"), ("2", "c", "d") ])
+    source = FileSystemBatchSource(str(tmp_path / "batches"))
+    dest = FileSystemBatchDestination(str(tmp_path / "consolidated"))
+    BatchConsolidator(source, dest, sort_and_dedup=True, dedup_col_names=["what", "why"], max_rows_in_memory=2).run_pipelined()
+
+    df = get_df_from_csv_string((tmp_path / "consolidated" / "consolidated_batches.csv").read_text())
+    assert df["ID"].tolist() == ["1", "2", "3"]
@@ -0,0 +1,212 @@
+import gzip
+import mmap
+import os
+import threading
+import time
+import pandas as pd
+import pytest
+from whatwhy.text_processing.clients import FileSystemBatchSource, FileSystemBatchDestination, FileSystemCompletionManifest
+from whatwhy.text_processing.clients.client import BatchDestinationBase, BATCH_CLAIMED, BATCH_HELD_BY_OTHER_CONSUMER
+from whatwhy.text_processing.clients.fs_client import FileSystemBatchLeases
+from whatwhy.text_processing.helper_methods import get_df_chunks_from_file, get_df_from_csv_string
+
+def test_populate_from_gzipped_file_in_chunks(tmp_path):
+    rows = [ f'"{i}"\t"Text {i}"' for i in range(25) ]
+    source_file = tmp_path / "source.csv.gz"
+    with gzip.open(source_file, "wt") as f:
+        f.write("\n".join(['"ID"\t"Text"'] + rows) + "\n")
+
+    dest_folder = tmp_path / "batches"
+    dest = FileSystemBatchDestination(str(dest_folder))
+    dest.populate_from_df_chunks(get_df_chunks_from_file(str(source_file), 10))
+    assert sorted( path.name for path in dest_folder.iterdir() ) == ["batch0.csv", "batch1.csv", "batch2.csv"]
+
+    source = FileSystemBatchSource(str(dest_folder))
+    ids = []
+    for _ in range(3):
+        ids.extend(get_df_from_csv_string(source.get_next_batch())["ID"].tolist())
+    assert ids == [ str(i) for i in range(25) ]
+
+class FlakyBatchDestination(BatchDestinationBase):
+
+    def __init__(self):
+        self.published_file_names = []
+        self.lock = threading.Lock()
+
+    def publish_batch_results(self, results, target_file_name=None):
+        if target_file_name == "batch3.csv":
+            return False
+        with self.lock:
+            self.published_file_names.append(target_file_name)
+        return True
+
+def test_populate_from_df_uploads_concurrently_and_counts_failures():
+    df = pd.DataFrame({ "ID" : [ str(i) for i in range(50) ] })
+    dest = FlakyBatchDestination()
+    assert dest.populate_from_df(df, batch_size=5, num_upload_threads=4) == (9, 1)
+    assert sorted(dest.published_file_names) == sorted( f"batch{i}.csv" for i in range(10) if i != 3 )
+
+def test_manifest_skips_completed_batches(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    for i in range(3):
+        (batch_folder / f"batch{i}.csv").write_text(f"contents {i}")
+    manifest_file_name = str(tmp_path / "manifest.jsonl")
+
+    source = FileSystemBatchSource(str(batch_folder), manifest=FileSystemCompletionManifest(manifest_file_name))
+    assert source.get_next_batch() == b"contents 0"
+    source.mark_batch_as_complete()
+    assert source.get_next_batch() == b"contents 1"
+    source.close() # The run is interrupted before batch1.csv is complete.
+
+    (batch_folder / "batch0.csv").write_text("contents 0") # Unchanged batches are skipped.
+    source = FileSystemBatchSource(str(batch_folder), manifest=FileSystemCompletionManifest(manifest_file_name))
+    assert source.get_next_batch() == b"contents 1"
+    source.mark_batch_as_complete()
+    assert source.get_next_batch() == b"contents 2"
+
+    (batch_folder / "batch0.csv").write_text("changed contents") # Changed batches are processed again.
+    source = FileSystemBatchSource(str(batch_folder), manifest=FileSystemCompletionManifest(manifest_file_name))
+    assert source.get_next_batch() == b"changed contents"
+    assert source.get_next_batch() == b"contents 2"
+
+def test_leases_share_a_folder_between_consumers(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    for i in range(4):
+        (batch_folder / f"batch{i}.csv").write_text(f"contents {i}")
+
+    first_source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    second_source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    assert first_source.get_next_batch() == b"contents 0"
+    assert second_source.get_next_batch() == b"contents 1"
+    first_source.mark_batch_as_complete()
+    second_source.mark_batch_as_complete()
+    assert first_source.get_next_batch() == b"contents 2"
+    assert second_source.get_next_batch() == b"contents 3"
+    second_source.mark_batch_as_complete()
+    second_source.close() # The lease on batch2.csv is still held by the first consumer.
+    first_source.close() # The unfinished batch2.csv is released.
+
+    third_source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    assert third_source.get_next_batch() == b"contents 2"
+    third_source.close()
+
+def test_expired_leases_are_reclaimed(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    (batch_folder / "batch0.csv").write_text("contents 0")
+    lease_file = tmp_path / "batches.leases" / "batch0.csv.lease"
+
+    dead_source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    assert dead_source.get_next_batch() == b"contents 0"
+    dead_source.leases.stop_event.set() # The consumer stops renewing its lease.
+    os.utime(lease_file, (time.time() - 120, time.time() - 120))
+
+    source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    assert source.get_next_batch() == b"contents 0"
+    source.mark_batch_as_complete()
+    assert (tmp_path / "batches.leases" / "batch0.csv.done").exists()
+    assert not lease_file.exists()
+
+def test_reclaimed_leases_are_not_reclaimed_again(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    (batch_folder / "batch0.csv").write_text("contents 0")
+    lease_file = tmp_path / "batches.leases" / "batch0.csv.lease"
+    lease_file.parent.mkdir()
+    lease_file.write_text("dead")
+    os.utime(lease_file, (time.time() - 120, time.time() - 120))
+
+    first_leases = FileSystemBatchLeases(str(batch_folder), lease_seconds=60)
+    second_leases = FileSystemBatchLeases(str(batch_folder), lease_seconds=60)
+    # Both consumers saw the expired lease, but the first one reclaims it before the second one renames it.
+    is_expired = second_leases.is_expired(str(lease_file))
+    assert first_leases.try_claim("batch0.csv") == BATCH_CLAIMED
+    second_leases.is_expired = lambda file_name: is_expired if file_name == str(lease_file) else FileSystemBatchLeases.is_expired(second_leases, file_name)
+    assert second_leases.try_claim("batch0.csv") == BATCH_HELD_BY_OTHER_CONSUMER
+    assert lease_file.read_text() == first_leases.consumer_id
+    first_leases.renew("batch0.csv")
+
+    with pytest.raises(RuntimeError):
+        second_leases.release("batch0.csv")
+    assert lease_file.exists()
+    first_leases.release("batch0.csv")
+    assert not lease_file.exists()
+    for leases in (first_leases, second_leases):
+        leases.stop_event.set()
+
+def test_batch_files_written_again_are_not_complete(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    (batch_folder / "batch0.csv").write_text("contents 0")
+    (batch_folder / "batch1.csv").write_text("contents 1")
+    source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    for _ in range(2):
+        source.get_next_batch()
+        source.mark_batch_as_complete()
+    source.close()
+
+    (batch_folder / "batch0.csv").write_text("new contents 0")
+    source = FileSystemBatchSource(str(batch_folder), lease_seconds=60)
+    assert source.get_next_batch() == b"new contents 0"
+    source.mark_batch_as_complete()
+    with pytest.raises(StopIteration):
+        source.get_next_batch()
+    source.close()
+
+def test_mmap_batches_are_parsed_without_copying(tmp_path):
+    dest = FileSystemBatchDestination(str(tmp_path / "batches"))
+    dest.populate_from_df(pd.DataFrame({ "ID" : ["1", "2"], "Text" : ["a", "b"] }))
+    source = FileSystemBatchSource(str(tmp_path / "batches"), use_mmap=True)
+    batch = source.get_next_batch()
+    assert isinstance(batch, mmap.mmap)
+    assert get_df_from_csv_string(batch)["Text"].tolist() == ["a", "b"]
+
+def test_watch_picks_up_new_batches(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    (batch_folder / "batch0.csv").write_text("contents 0")
+    source = FileSystemBatchSource(str(batch_folder), watch_interval_seconds=0.01, max_idle_seconds=5)
+    assert source.get_next_batch() == b"contents 0"
+
+    dest = FileSystemBatchDestination(str(batch_folder))
+    threading.Timer(0.1, dest.publish_batch_results, args=("contents 1", "batch1.csv")).start()
+    assert source.get_next_batch() == b"contents 1"
+
+    source.max_idle_seconds = 0
+    with pytest.raises(StopIteration):
+        source.get_next_batch()
+
+def test_watch_picks_up_replaced_batches(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    (batch_folder / "batch0.csv").write_text("contents 0")
+    source = FileSystemBatchSource(str(batch_folder), watch_interval_seconds=0.01, max_idle_seconds=5)
+    assert source.get_next_batch() == b"contents 0"
+
+    dest = FileSystemBatchDestination(str(batch_folder))
+    threading.Timer(0.1, dest.publish_batch_results, args=("new contents 0", "batch0.csv")).start()
+    assert source.get_next_batch() == b"new contents 0"
+    source.close()
+
+def test_watch_retries_batches_held_by_other_consumers(tmp_path):
+    batch_folder = tmp_path / "batches"
+    batch_folder.mkdir()
+    (batch_folder / "batch0.csv").write_text("contents 0")
+    (batch_folder / "batch1.csv").write_text("contents 1")
+    lease_file = tmp_path / "batches.leases" / "batch0.csv.lease"
+    lease_file.parent.mkdir()
+    lease_file.write_text("other")
+
+    source = FileSystemBatchSource(str(batch_folder), lease_seconds=60, watch_interval_seconds=0.01, max_idle_seconds=5)
+    source.leases.retry_interval_seconds = 0.01
+    assert source.get_next_batch() == b"contents 1"
+    source.mark_batch_as_complete()
+    # The other consumer releases its lease while this one is still watching the folder.
+    threading.Timer(0.1, os.remove, args=(str(lease_file),)).start()
+    start_time = time.monotonic()
+    assert source.get_next_batch() == b"contents 0"
+    assert time.monotonic() - start_time < source.max_idle_seconds
+    source.mark_batch_as_complete()
+    source.close()
@@ -0,0 +1,31 @@
+import pytest
+from whatwhy.text_processing.clients import FileSystemBatchSource, FileSystemBatchDestination
+from whatwhy.text_processing.clients.compression import GzipCompression, ZstdCompression, get_compression, get_compression_for_file_name
+
+def get_compressions():
+    compressions = [GzipCompression()]
+    try:
+        compressions.append(ZstdCompression())
+    except ImportError:
+        pass
+    return compressions
+
+@pytest.mark.parametrize("compression", get_compressions())
+def test_fs_batches_are_compressed_and_decompressed(compression, tmp_path):
+    batch = "\"ID\"\t\"Text\"\n" * 100
+    dest = FileSystemBatchDestination(str(tmp_path), compression=compression)
+    dest.publish_batch_results(batch, "batch0.csv")
+    batch_file = tmp_path / f"batch0.csv.{compression.file_extension}"
+    assert batch_file.exists()
+    assert len(batch_file.read_bytes()) < len(batch)
+
+    source = FileSystemBatchSource(str(tmp_path))
+    assert source.get_next_batch() == batch.encode("utf-8")
+
+def test_get_compression():
+    assert get_compression("none") is None
+    assert isinstance(get_compression("gzip"), GzipCompression)
+    assert isinstance(get_compression_for_file_name("folder/batch0.csv.gz"), GzipCompression)
+    assert get_compression_for_file_name("folder/batch0.csv") is None
+    with pytest.raises(AttributeError):
+        get_compression("lzma")
@@ -0,0 +1,61 @@
+import os
+import threading
+import pandas as pd
+import pytest
+from whatwhy.text_processing.clients import PipeBatchSource, PipeBatchDestination
+from whatwhy.text_processing.clients.compression import GzipCompression
+from whatwhy.text_processing.helper_methods import get_df_from_csv_string
+
+def test_batches_are_sent_through_fifo(tmp_path):
+    fifo_name = str(tmp_path / "batches")
+    os.mkfifo(fifo_name)
+    df = pd.DataFrame({ "ID" : list(range(10)), "Text" : [ f"text {i}" for i in range(10) ] })
+
+    def write_batches():
+        # Opening a FIFO for writing blocks until it is opened for reading.
+        dest = PipeBatchDestination(fifo_name)
+        dest.populate_from_df(df, batch_size=3)
+        dest.pipe.close()
+
+    writer_thread = threading.Thread(target=write_batches)
+    writer_thread.start()
+    source = PipeBatchSource(fifo_name)
+    batches = []
+    while True:
+        try:
+            batches.append(source.get_next_batch())
+            source.mark_batch_as_complete()
+        except StopIteration:
+            break
+    source.close()
+    writer_thread.join()
+
+    assert len(batches) == 4
+    assert list(get_df_from_csv_string(batches[0])["Text"]) == ["text 0", "text 1", "text 2"]
+
+def test_compressed_batches_keep_their_file_names(tmp_path):
+    file_name = str(tmp_path / "batches.bin")
+    dest = PipeBatchDestination(file_name, compression=GzipCompression())
+    assert dest.publish_batch_results("a" * 100, "batch0.csv")
+    assert dest.publish_batch_results(b"\x00\x01", "batch1.arrow")
+    assert dest.flush() == 0
+    dest.pipe.close()
+
+    source = PipeBatchSource(file_name)
+    assert source.get_next_batch() == b"a" * 100
+    assert source.get_batch_handle() == "batch0.csv.gz"
+    assert source.get_next_batch() == b"\x00\x01"
+    with pytest.raises(StopIteration):
+        source.get_next_batch()
+
+def test_truncated_batch_ends_stream(tmp_path):
+    file_name = str(tmp_path / "batches.bin")
+    dest = PipeBatchDestination(file_name)
+    dest.publish_batch_results("text", "batch0.csv")
+    dest.pipe.close()
+    with open(file_name, "rb+") as batches_file:
+        batches_file.truncate(os.path.getsize(file_name) - 1)
+
+    source = PipeBatchSource(file_name)
+    with pytest.raises(StopIteration):
+        source.get_next_batch()
@@ -0,0 +1,199 @@
+import io
+import json
+import pytest
+from botocore.exceptions import ClientError
+from whatwhy.text_processing.clients import s3_client
+from whatwhy.text_processing.clients import S3BatchSource, S3BatchDestination
+from whatwhy.text_processing.clients.s3_client import S3BatchResultsStream, S3BatchLeases
+from whatwhy.text_processing.clients.client import CompletionManifestBase, BATCH_CLAIMED, BATCH_HELD_BY_OTHER_CONSUMER
+
+class FakePaginator():
+
+    def __init__(self, s3, page_size):
+        self.s3 = s3
+        self.page_size = page_size
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted( key for key in self.s3.objects if key.startswith(Prefix) )
+        for i in range(0, len(keys), self.page_size):
+            yield { "Contents" : [ {"Key" : key, "ETag" : f"etag-{key}"} for key in keys[i:i+self.page_size] ] }
+
+class FakeS3():
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.delete_requests = []
+        self.multipart_uploads = {}
+        self.put_callbacks = []
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects_v2"
+        return FakePaginator(self, page_size=2)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({ "Error" : { "Code" : "NoSuchKey" } }, "GetObject")
+        contents = self.objects[Key]
+        return { "Body" : io.BytesIO(contents.encode("utf-8") if isinstance(contents, str) else contents), "ETag" : self.get_etag(Key) }
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({ "Error" : { "Code" : "404" } }, "HeadObject")
+        return { "ETag" : self.get_etag(Key) }
+
+    def get_etag(self, Key):
+        return f"etag-{hash(self.objects[Key])}"
+
+    def list_objects_v2(self, Bucket, Prefix):
+        keys = sorted( key for key in self.objects if key.startswith(Prefix) )
+        return { "Contents" : [ {"Key" : key} for key in keys ] } if len(keys) > 0 else {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+        for put_callback in self.put_callbacks:
+            put_callback(Key)
+        return { "ETag" : self.get_etag(Key) }
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.multipart_uploads)}"
+        self.multipart_uploads[upload_id] = {}
+        return { "UploadId" : upload_id }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.multipart_uploads[UploadId][PartNumber] = Body
+        return { "ETag" : f"etag-{PartNumber}" }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.multipart_uploads.pop(UploadId)
+        self.objects[Key] = b"".join( parts[part["PartNumber"]] for part in MultipartUpload["Parts"] )
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [ obj["Key"] for obj in Delete["Objects"] ]
+        self.delete_requests.append(keys)
+        for key in keys:
+            del self.objects[key]
+        return {}
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    objects = { "folder/" : "" }
+    for i in range(5):
+        objects[f"folder/batch{i}.csv"] = f"contents {i}"
+    s3 = FakeS3(objects)
+    monkeypatch.setattr(s3_client.boto3, "client", lambda *args, **kwargs: s3)
+    return s3
+
+def read_all_batches(source):
+    batches = []
+    while True:
+        try:
+            batches.append(source.get_next_batch())
+            source.mark_batch_as_complete()
+        except StopIteration:
+            source.close()
+            return batches
+
+def test_get_next_batch_reads_every_page(fake_s3):
+    source = S3BatchSource("bucket", "folder", num_prefetched_batches=2)
+    assert read_all_batches(source) == [ f"contents {i}".encode("utf-8") for i in range(5) ]
+
+def test_mark_batch_as_complete_deletes_in_groups(fake_s3):
+    source = S3BatchSource("bucket", "folder", delete_when_complete=True, delete_batch_size=2)
+    read_all_batches(source)
+    assert [ len(keys) for keys in fake_s3.delete_requests ] == [2, 2, 1]
+    assert list(fake_s3.objects.keys()) == ["folder/"]
+
+def test_results_stream_uploads_parts(fake_s3):
+    stream = S3BatchResultsStream(fake_s3, "bucket", "folder/consolidated.csv", part_size=10)
+    for i in range(5):
+        stream.write(f"line {i:03d}\n")
+    assert stream.close()
+    assert fake_s3.objects["folder/consolidated.csv"] == b"".join( f"line {i:03d}\n".encode("utf-8") for i in range(5) )
+    assert fake_s3.multipart_uploads == {}
+
+def test_small_results_stream_uses_put_object(fake_s3):
+    dest = S3BatchDestination("bucket", "folder")
+    stream = dest.open_batch_results_stream("consolidated.csv")
+    stream.write("small")
+    assert stream.close()
+    assert fake_s3.objects["folder/consolidated.csv"] == b"small"
+    assert fake_s3.multipart_uploads == {}
+
+class FakeManifest(CompletionManifestBase):
+
+    def __init__(self, lines):
+        self.lines = lines
+        super().__init__()
+
+    def load_lines(self):
+        return list(self.lines)
+
+    def write_line(self, line):
+        self.lines.append(line)
+
+def test_manifest_skips_completed_batches_without_downloading(fake_s3):
+    manifest = FakeManifest([ '{"key" : "folder/batch0.csv", "hash" : "etag-folder/batch0.csv"}\n',
+                              '{"key" : "folder/batch1.csv", "hash" : "outdated"}\n' ])
+    source = S3BatchSource("bucket", "folder", manifest=manifest)
+    assert read_all_batches(source) == [ f"contents {i}".encode("utf-8") for i in range(1, 5) ]
+    assert manifest.is_complete("folder/batch1.csv", "etag-folder/batch1.csv")
+
+def test_leases_share_a_folder_between_consumers(fake_s3):
+    first_source = S3BatchSource("bucket", "folder", num_prefetched_batches=1, lease_seconds=60)
+    second_source = S3BatchSource("bucket", "folder", num_prefetched_batches=1, lease_seconds=60)
+    for source in (first_source, second_source):
+        source.leases.retry_interval_seconds = 0.01
+    batches = []
+    for source in (first_source, second_source, first_source, second_source, first_source):
+        batches.append(source.get_next_batch())
+        source.mark_batch_as_complete()
+    assert sorted(batches) == [ f"contents {i}".encode("utf-8") for i in range(5) ]
+    for source in (first_source, second_source):
+        with pytest.raises(StopIteration):
+            source.get_next_batch()
+        source.close()
+    assert sorted( key for key in fake_s3.objects if key.startswith("folder.leases/") ) == [ f"folder.leases/batch{i}.csv/complete-etag-folder/batch{i}.csv" for i in range(5) ]
+
+def test_expired_s3_leases_are_reclaimed(fake_s3):
+    for i in range(4):
+        fake_s3.objects[f"folder.leases/batch{i}.csv/complete-etag-folder/batch{i}.csv"] = b""
+    fake_s3.objects["folder.leases/batch4.csv/dead"] = json.dumps({ "consumer" : "dead", "expires" : 0 })
+    source = S3BatchSource("bucket", "folder", lease_seconds=60)
+    assert read_all_batches(source) == [b"contents 4"]
+    assert "folder.leases/batch4.csv/dead" not in fake_s3.objects
+
+def test_batches_written_again_are_not_complete(fake_s3):
+    fake_s3.objects["folder.leases/batch0.csv/complete-outdated"] = b""
+    for i in range(1, 5):
+        fake_s3.objects[f"folder.leases/batch{i}.csv/complete-etag-folder/batch{i}.csv"] = b""
+    source = S3BatchSource("bucket", "folder", lease_seconds=60)
+    assert read_all_batches(source) == [b"contents 0"]
+    assert "folder.leases/batch0.csv/complete-etag-folder/batch0.csv" in fake_s3.objects
+
+def test_release_keeps_leases_of_other_consumers(fake_s3):
+    source = S3BatchSource("bucket", "folder", num_prefetched_batches=1, lease_seconds=60)
+    assert source.get_next_batch() == b"contents 0"
+    other_lease = json.dumps({ "consumer" : "other", "expires" : 2**40 })
+    fake_s3.objects["folder.leases/batch0.csv/other"] = other_lease
+    source.close()
+    assert [ key for key in fake_s3.objects if key.startswith("folder.leases/") ] == ["folder.leases/batch0.csv/other"]
+
+def test_leases_taken_at_the_same_time_are_given_up(fake_s3):
+    leases = S3BatchLeases(fake_s3, "bucket", "folder/", lease_seconds=60)
+    other_lease = json.dumps({ "consumer" : "other", "expires" : 2**40 })
+    fake_s3.put_callbacks.append(lambda key: fake_s3.objects.setdefault("folder.leases/batch0.csv/other", other_lease))
+    assert leases.try_claim("folder/batch0.csv") == BATCH_HELD_BY_OTHER_CONSUMER
+    assert leases.held_leases == {}
+    assert [ key for key in fake_s3.objects if key.startswith("folder.leases/") ] == ["folder.leases/batch0.csv/other"]
+    leases.close()
+
+def test_expired_leases_are_not_renewed(fake_s3):
+    leases = S3BatchLeases(fake_s3, "bucket", "folder/", lease_seconds=60)
+    assert leases.try_claim("folder/batch0.csv") == BATCH_CLAIMED
+    leases.held_leases["folder/batch0.csv"] = 0
+    with pytest.raises(Exception):
+        leases.renew("folder/batch0.csv")
+    leases.close()
@@ -0,0 +1,64 @@
+import pandas as pd
+from whatwhy.text_processing.clients import SQLiteBatchSource, SQLiteBatchDestination
+from whatwhy.text_processing.clients.compression import GzipCompression
+
+def get_all_batches(source):
+    batches = []
+    while True:
+        try:
+            batches.append(source.get_next_batch())
+            source.mark_batch_as_complete()
+        except StopIteration:
+            break
+    return batches
+
+def test_batches_are_completed_in_database(tmp_path):
+    db_file_name = str(tmp_path / "batches.db")
+    df = pd.DataFrame({ "ID" : list(range(10)), "Text" : [ f"text {i}" for i in range(10) ] })
+    dest = SQLiteBatchDestination(db_file_name, id_col_name="ID")
+    assert dest.populate_from_df(df, batch_size=3, num_upload_threads=2) == (4, 0)
+
+    source = SQLiteBatchSource(db_file_name)
+    assert source.get_batch_names_for_id(4) == ["batch1.csv"]
+    assert len(get_all_batches(source)) == 4
+    source.close()
+
+    # Completed batches are skipped, until they are published again.
+    dest.publish_batch_results("\"ID\"\t\"Text\"\n\"0\"\t\"new text\"\n", "batch0.csv")
+    source = SQLiteBatchSource(db_file_name)
+    assert get_all_batches(source) == [b"\"ID\"\t\"Text\"\n\"0\"\t\"new text\"\n"]
+    assert source.get_batch_names_for_id(1) == []
+    source.close()
+
+def test_consumers_share_database(tmp_path):
+    db_file_name = str(tmp_path / "batches.db")
+    dest = SQLiteBatchDestination(db_file_name, compression=GzipCompression())
+    for i in range(6):
+        dest.publish_batch_results(f"batch {i}", f"batch{i}.csv")
+
+    first_source = SQLiteBatchSource(db_file_name, delete_when_complete=True)
+    second_source = SQLiteBatchSource(db_file_name, delete_when_complete=True)
+    second_source.leases.retry_interval_seconds = 0.01
+    assert first_source.get_next_batch() == b"batch 0"
+    assert second_source.get_next_batch() == b"batch 1"
+    first_source.mark_batch_as_complete()
+    second_source.mark_batch_as_complete()
+    assert get_all_batches(second_source) == [ f"batch {i}".encode("utf-8") for i in range(2, 6) ]
+    assert get_all_batches(first_source) == []
+    second_source.close()
+    first_source.close()
+
+    assert dest.execute("SELECT COUNT(*) FROM batches")[1][0][0] == 0
+
+def test_closed_consumer_releases_claims(tmp_path):
+    db_file_name = str(tmp_path / "batches.db")
+    dest = SQLiteBatchDestination(db_file_name)
+    dest.publish_batch_results("batch 0", "batch0.csv")
+
+    first_source = SQLiteBatchSource(db_file_name)
+    assert first_source.get_next_batch() == b"batch 0"
+    first_source.close()
+
+    second_source = SQLiteBatchSource(db_file_name)
+    assert get_all_batches(second_source) == [b"batch 0"]
+    second_source.close()
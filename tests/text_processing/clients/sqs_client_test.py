@@ -0,0 +1,165 @@
+import pytest
+from whatwhy.text_processing.clients import sqs_client
+from whatwhy.text_processing.clients import SQSBatchSource, SQSBatchDestination, FileSystemClaimCheckStore
+from whatwhy.text_processing.clients.compression import GzipCompression
+
+class FakeSQS():
+
+    def __init__(self, bodies):
+        self.messages = [ { "Body" : body, "ReceiptHandle" : f"handle-{body}" } for body in bodies ]
+        self.receive_requests = []
+        self.delete_requests = []
+        self.visibility_changes = []
+        self.send_requests = []
+
+    def get_queue_url(self, QueueName):
+        return { "QueueUrl" : f"https://sqs/{QueueName}" }
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, **kwargs):
+        self.receive_requests.append(MaxNumberOfMessages)
+        messages = self.messages[:MaxNumberOfMessages]
+        self.messages = self.messages[MaxNumberOfMessages:]
+        return { "Messages" : messages } if len(messages) > 0 else {}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.send_requests.append(len(Entries))
+        for entry in Entries:
+            message = { "Body" : entry["MessageBody"], "ReceiptHandle" : f"handle-{len(self.messages)}" }
+            if "MessageAttributes" in entry:
+                message["MessageAttributes"] = entry["MessageAttributes"]
+            self.messages.append(message)
+        return { "Successful" : Entries }
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.delete_requests.append([ entry["ReceiptHandle"] for entry in Entries ])
+        return { "Successful" : Entries }
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility_changes.extend( (entry["ReceiptHandle"], entry["VisibilityTimeout"]) for entry in Entries )
+        return { "Successful" : Entries }
+
+    def get_released_handles(self):
+        return [ handle for handle, visibility_timeout in self.visibility_changes if visibility_timeout == 0 ]
+
+@pytest.fixture
+def fake_sqs(monkeypatch):
+    sqs = FakeSQS([ str(i) for i in range(12) ])
+    monkeypatch.setattr(sqs_client.boto3, "client", lambda *args, **kwargs: sqs)
+    return sqs
+
+@pytest.fixture
+def empty_fake_sqs(monkeypatch):
+    sqs = FakeSQS([])
+    monkeypatch.setattr(sqs_client.boto3, "client", lambda *args, **kwargs: sqs)
+    return sqs
+
+def test_get_next_batch_receives_and_deletes_in_groups(fake_sqs):
+    source = SQSBatchSource("queue", max_idle_seconds=0, handle_shutdown_signals=False)
+    batches = []
+    while True:
+        try:
+            batches.append(source.get_next_batch())
+            source.mark_batch_as_complete()
+        except StopIteration:
+            source.close()
+            break
+    assert batches == [ str(i) for i in range(12) ]
+    assert fake_sqs.receive_requests == [10, 10, 10]
+    assert [ len(handles) for handles in fake_sqs.delete_requests ] == [10, 2]
+    assert fake_sqs.get_released_handles() == []
+
+def test_shutdown_releases_buffered_messages(fake_sqs):
+    source = SQSBatchSource("queue", handle_shutdown_signals=False)
+    assert source.get_next_batch() == "0"
+    source.mark_batch_as_complete()
+    source.shutdown()
+    with pytest.raises(StopIteration):
+        source.get_next_batch()
+    source.close()
+    assert fake_sqs.delete_requests == [["handle-0"]]
+    assert fake_sqs.get_released_handles() == [ f"handle-{i}" for i in range(1, 10) ]
+
+def test_extend_visibility_timeouts(fake_sqs):
+    source = SQSBatchSource("queue", visibility_timeout=60, handle_shutdown_signals=False)
+    source.get_next_batch()
+    source.extend_visibility_timeouts()
+    assert fake_sqs.visibility_changes == [ (f"handle-{i}", 60) for i in range(10) ]
+    source.close()
+
+def test_extend_visibility_timeouts_releases_stuck_batches(fake_sqs):
+    source = SQSBatchSource("queue", max_visibility_extension=0, handle_shutdown_signals=False)
+    source.get_next_batch()
+    source.extend_visibility_timeouts()
+    # Only the batch that was handed out is released. Buffered batches are still extended.
+    assert fake_sqs.visibility_changes == [ (f"handle-{i}", 300) for i in range(1, 10) ]
+    assert "handle-0" not in source.in_flight_messages
+    source.close()
+
+def test_publish_batch_results_sends_in_groups(empty_fake_sqs):
+    dest = SQSBatchDestination("queue")
+    for i in range(12):
+        dest.publish_batch_results(str(i))
+    dest.flush()
+    assert empty_fake_sqs.send_requests == [10, 2]
+    assert [ message["Body"] for message in empty_fake_sqs.messages ] == [ str(i) for i in range(12) ]
+
+def test_oversized_batches_use_claim_check(empty_fake_sqs, tmp_path):
+    large_batch = "x" * (sqs_client.MAX_MESSAGE_SIZE + 1)
+    dest = SQSBatchDestination("queue", claim_check_store=FileSystemClaimCheckStore(str(tmp_path)))
+    dest.publish_batch_results("small batch")
+    dest.publish_batch_results(large_batch, "batch1.csv")
+    dest.flush()
+    assert len(list(tmp_path.iterdir())) == 1
+    assert len(empty_fake_sqs.messages[1]["Body"]) < 1000
+
+    source = SQSBatchSource("queue", max_idle_seconds=0, handle_shutdown_signals=False)
+    assert source.get_next_batch() == "small batch"
+    source.mark_batch_as_complete()
+    assert source.get_next_batch() == large_batch.encode("utf-8")
+    source.mark_batch_as_complete()
+    with pytest.raises(StopIteration):
+        source.get_next_batch()
+    source.close()
+    assert len(list(tmp_path.iterdir())) == 0
+
+def test_binary_batches_round_trip(empty_fake_sqs):
+    binary_batch = bytes(range(256))
+    dest = SQSBatchDestination("queue")
+    dest.publish_batch_results(binary_batch, "batch1.arrow")
+    dest.flush()
+    assert isinstance(empty_fake_sqs.messages[0]["Body"], str)
+
+    source = SQSBatchSource("queue", max_idle_seconds=0, handle_shutdown_signals=False)
+    assert source.get_next_batch() == binary_batch
+    source.mark_batch_as_complete()
+    source.close()
+
+def test_text_batches_are_not_encoded(empty_fake_sqs):
+    dest = SQSBatchDestination("queue")
+    dest.publish_batch_results("\"ID\"\t\"Text\"\n\"0\"\t\"caf\u00e9\"\n".encode("utf-8"), "batch0.csv")
+    dest.publish_batch_results(b"\xff\xfe", "batch1.csv")
+    dest.publish_batch_results("\x00", "batch2.csv")
+    dest.flush()
+    assert empty_fake_sqs.messages[0]["Body"] == "\"ID\"\t\"Text\"\n\"0\"\t\"caf\u00e9\"\n"
+    assert "MessageAttributes" not in empty_fake_sqs.messages[0]
+
+    source = SQSBatchSource("queue", max_idle_seconds=0, handle_shutdown_signals=False)
+    assert source.get_next_batch() == "\"ID\"\t\"Text\"\n\"0\"\t\"caf\u00e9\"\n"
+    source.mark_batch_as_complete()
+    assert source.get_next_batch() == b"\xff\xfe"
+    source.mark_batch_as_complete()
+    assert source.get_next_batch() == b"\x00"
+    source.mark_batch_as_complete()
+    source.close()
+
+def test_compressed_batches_round_trip(empty_fake_sqs):
+    batch = "\"ID\"\t\"Text\"\n" * 100
+    dest = SQSBatchDestination("queue", compression=GzipCompression())
+    dest.publish_batch_results(batch, "batch0.csv")
+    dest.flush()
+    assert len(empty_fake_sqs.messages[0]["Body"]) < len(batch)
+
+    source = SQSBatchSource("queue", max_idle_seconds=0, handle_shutdown_signals=False)
+    assert source.get_next_batch() == batch.encode("utf-8")
+    source.mark_batch_as_complete()
+    source.close()
@@ -0,0 +1,104 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import pytest
+from whatwhy.text_processing.corenlp_pool import CoreNLPEndpointPool, CachedCoreNLPAnnotator
+from whatwhy.text_processing.result_cache import LocalResultCache
+
+class FakeCoreNLPHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200 if self.server.is_ready else 503)
+        self.end_headers()
+
+    def do_POST(self):
+        text = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        properties = json.loads(parse_qs(urlparse(self.path).query)["properties"][0])
+        self.server.num_requests += 1
+        if self.server.is_failing:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps({ "text" : text, "annotators" : properties.get("annotators"), "port" : self.server.server_port }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeCoreNLPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@pytest.fixture
+def fake_servers():
+    servers = []
+    for _ in range(2):
+        server = FakeCoreNLPServer(("127.0.0.1", 0), FakeCoreNLPHandler)
+        server.is_ready = True
+        server.is_failing = False
+        server.num_requests = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def get_url(server):
+    return f"http://127.0.0.1:{server.server_port}"
+
+def get_unused_url():
+    with socket.socket() as unused_socket:
+        unused_socket.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{unused_socket.getsockname()[1]}"
+
+def test_requests_go_to_server_with_fewest_outstanding_requests(fake_servers):
+    pool = CoreNLPEndpointPool([ get_url(server) for server in fake_servers ])
+    assert pool.wait_until_ready(timeout_seconds=5)
+    pool.endpoints[0].num_outstanding_requests = 2
+    annotation = pool.annotate("Some text.", properties={ "annotators" : "tokenize" })
+    assert annotation == { "text" : "Some text.", "annotators" : "tokenize", "port" : fake_servers[1].server_port }
+    assert pool.endpoints[1].num_outstanding_requests == 0
+
+def test_failed_servers_are_retried_with_backoff(fake_servers):
+    pool = CoreNLPEndpointPool([ get_url(server) for server in fake_servers ], min_backoff_seconds=60)
+    assert pool.wait_until_ready(timeout_seconds=5)
+    fake_servers[0].is_failing = True
+    fake_servers[1].num_requests = 1
+
+    # The request fails on the first server, and is retried on the second.
+    assert pool.annotate("text")["port"] == fake_servers[1].server_port
+    assert not pool.endpoints[0].is_healthy
+    assert pool.annotate("text")["port"] == fake_servers[1].server_port
+    assert fake_servers[0].num_requests == 1
+
+    fake_servers[0].is_failing = False
+    pool.endpoints[0].retry_time = 0
+    pool.endpoints[1].num_outstanding_requests = 1
+    assert pool.annotate("text")["port"] == fake_servers[0].server_port
+
+def test_no_server_is_ready(fake_servers):
+    fake_servers[0].is_ready = False
+    pool = CoreNLPEndpointPool([ get_url(fake_servers[0]), get_unused_url() ], min_backoff_seconds=60)
+    assert not pool.wait_until_ready(timeout_seconds=0)
+    with pytest.raises(ConnectionError):
+        pool.annotate("text")
+
+def test_annotations_are_cached_by_properties(fake_servers, tmp_path):
+    pool = CoreNLPEndpointPool([ get_url(fake_servers[0]) ])
+    annotation_cache = LocalResultCache(str(tmp_path / "annotations.db"))
+    annotator = CachedCoreNLPAnnotator(pool, annotation_cache)
+    assert annotator.annotate("text", properties={ "annotators" : "tokenize", "timeout" : 1 })["text"] == "text"
+    assert annotator.annotate("text", properties={ "annotators" : "tokenize", "timeout" : 2 })["text"] == "text"
+    annotator.flush()
+    assert fake_servers[0].num_requests == 1
+
+    annotator = CachedCoreNLPAnnotator(pool, annotation_cache)
+    assert annotator.annotate("text", properties={ "annotators" : "tokenize" })["annotators"] == "tokenize"
+    assert annotator.annotate("text", properties={ "annotators" : "tokenize,ssplit" })["annotators"] == "tokenize,ssplit"
+    assert fake_servers[0].num_requests == 2
@@ -0,0 +1,32 @@
+import sys
+from whatwhy.text_processing import main
+
+def test_transfer_from_command_line(tmp_path, monkeypatch):
+    source_folder = tmp_path / "source"
+    source_folder.mkdir()
+    (source_folder / "batch0.csv").write_text("ID\tText\n0\tlorem ipsum\n")
+    (source_folder / "batch1.csv").write_text("ID\tText\n1\tdolor sit amet\n")
+    dest_folder = tmp_path / "dest"
+    argv = [ "whatwhy-text", "--process", "transfer", "-st", "fs", "-sn", str(source_folder), "-dt", "fs", "-dn", str(dest_folder) ]
+    monkeypatch.setattr(sys, "argv", argv)
+    main.main()
+    assert (dest_folder / "batch0.csv").read_text() == "ID\tText\n0\tlorem ipsum\n"
+    assert (dest_folder / "batch1.csv").read_text() == "ID\tText\n1\tdolor sit amet\n"
+
+class RecordingBatchProcessor():
+
+    def __init__(self):
+        self.calls = []
+
+    def run(self):
+        self.calls.append("run")
+
+    def run_pipelined(self, fetch_queue_depth, publish_queue_depth, num_workers):
+        self.calls.append( ("run_pipelined", fetch_queue_depth, publish_queue_depth, num_workers) )
+
+def test_process_publishes_to_sqs_in_the_background():
+    batch_processor = RecordingBatchProcessor()
+    main.process(batch_processor, dest_type="fs")
+    main.process(batch_processor, dest_type="sqs")
+    main.process(batch_processor, publish_queue_depth=2, dest_type="sqs")
+    assert batch_processor.calls == [ "run", ("run_pipelined", 0, 10, 1), ("run_pipelined", 0, 2, 1) ]
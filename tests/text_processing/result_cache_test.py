@@ -0,0 +1,38 @@
+import pickle
+from whatwhy.text_processing.result_cache import LocalResultCache, FileSystemResultCache, TieredResultCache
+
+def test_local_cache_evicts_least_recently_used_results(tmp_path):
+    cache = LocalResultCache(str(tmp_path / "cache.db"), max_size_bytes=700)
+    cache.put_many({ f"key{i}" : ["token"] * 10 for i in range(5) })
+    assert cache.get_many(["key0"]) == { "key0" : ["token"] * 10 }
+    cache.put_many({ f"key{i}" : ["token"] * 10 for i in range(5, 10) })
+
+    results = cache.get_many([ f"key{i}" for i in range(10) ])
+    assert "key0" in results
+    assert not any( f"key{i}" in results for i in range(1, 5) )
+    assert "key9" in results
+
+def test_local_cache_can_be_pickled(tmp_path):
+    cache = LocalResultCache(str(tmp_path / "cache.db"))
+    cache.put_many({ "key" : None })
+    assert pickle.loads(pickle.dumps(cache)).get_many(["key", "missing"]) == { "key" : None }
+
+def test_tiered_cache_fills_local_cache(tmp_path):
+    local_cache = LocalResultCache(str(tmp_path / "cache.db"))
+    shared_cache = FileSystemResultCache(str(tmp_path / "shared"))
+    shared_cache.put_many({ "abc" : { "what" : "text" } })
+    cache = TieredResultCache(local_cache, shared_cache)
+
+    assert cache.get_many(["abc", "def"]) == { "abc" : { "what" : "text" } }
+    assert local_cache.get_many(["abc"]) == { "abc" : { "what" : "text" } }
+    cache.put_many({ "def" : "text" })
+    assert shared_cache.get_many(["def"]) == { "def" : "text" }
+
+def test_local_cache_keeps_total_size(tmp_path):
+    cache = LocalResultCache(str(tmp_path / "cache.db"), max_size_bytes=700)
+    for i in range(10):
+        cache.put_many({ "key" : "x" * i, f"key{i}" : ["token"] * 10 })
+    connection = cache.get_connection()
+    total_size = connection.execute("SELECT size FROM total_size").fetchone()[0]
+    assert total_size == connection.execute("SELECT SUM(size) FROM results").fetchone()[0]
+    assert total_size <= 700
@@ -0,0 +1,48 @@
+from whatwhy.text_processing.result_cache import LocalResultCache
+from whatwhy.text_processing.spelling_correction import SpellingCorrector, get_file_hash, load_known_words
+
+class FakeSpellChecker():
+
+    def __init__(self):
+        self.fragments = []
+
+    def FixFragment(self, fragment):
+        self.fragments.append(fragment)
+        return fragment.replace("Tgis", "This")
+
+def test_sentences_are_corrected_once():
+    spell_checker = FakeSpellChecker()
+    spelling_corrector = SpellingCorrector(spell_checker, max_cached_sentences=2)
+    assert spelling_corrector.correct("Tgis is one.  Tgis is two!\nTgis is one.") == "This is one.  This is two!\nThis is one."
+    assert spelling_corrector.correct("Tgis is three. Tgis is one.") == "This is three. This is one."
+    assert spell_checker.fragments == ["Tgis is one.", "Tgis is two!", "Tgis is three."]
+    # Only the 2 most recently used sentences are kept.
+    spelling_corrector.correct("Tgis is two!")
+    assert spell_checker.fragments[-1] == "Tgis is two!"
+
+def test_corrections_are_persisted_for_model(tmp_path):
+    model_file = tmp_path / "en.bin"
+    model_file.write_bytes(b"model")
+    persistent_cache = LocalResultCache(str(tmp_path / "spelling.db"))
+    spelling_corrector = SpellingCorrector(FakeSpellChecker(), persistent_cache=persistent_cache, model_hash=get_file_hash(str(model_file)))
+    spelling_corrector.correct("Tgis is cached.")
+    spelling_corrector.flush()
+
+    spell_checker = FakeSpellChecker()
+    spelling_corrector = SpellingCorrector(spell_checker, persistent_cache=persistent_cache, model_hash=get_file_hash(str(model_file)))
+    assert spelling_corrector.correct("Tgis is cached.") == "This is cached."
+    assert spell_checker.fragments == []
+
+    model_file.write_bytes(b"new model")
+    spelling_corrector = SpellingCorrector(spell_checker, persistent_cache=persistent_cache, model_hash=get_file_hash(str(model_file)))
+    spelling_corrector.correct("Tgis is cached.")
+    assert spell_checker.fragments == ["Tgis is cached."]
+
+def test_sentences_with_only_known_words_are_not_checked(tmp_path):
+    known_words_file = tmp_path / "words.txt"
+    known_words_file.write_text("this\nis\nclean\ndon't\n")
+    spell_checker = FakeSpellChecker()
+    spelling_corrector = SpellingCorrector(spell_checker, known_words=load_known_words(str(known_words_file)))
+    text = "This is clean, don't 123! Tgis is not clean. This is clean."
+    assert spelling_corrector.correct(text) == "This is clean, don't 123! This is not clean. This is clean."
+    assert spell_checker.fragments == ["Tgis is not clean."]
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+import pytest
+from whatwhy.text_processing.text_normalization import TextNormalizer, get_normalization_stages
+
+def test_stages_are_applied_in_order():
+    text_normalizer = TextNormalizer(get_normalization_stages(["urls", "mentions", "hashtags", "whitespace", "unicode"]))
+    values = pd.Series([ "lorem ipsum www.google.com", "@user  says #hello\tto me@example.com", "ﬁne", None, np.nan ])
+    normalized_values = text_normalizer.normalize_column(values)
+    assert list(normalized_values[:3]) == ["lorem ipsum", "says hello to me@example.com", "fine"]
+    assert normalized_values[3:].isna().all()
+    assert text_normalizer.stage_hits == { "urls" : 1, "mentions" : 1, "hashtags" : 1, "whitespace" : 2, "unicode" : 1 }
+
+    text_normalizer.log_statistics()
+    assert text_normalizer.stage_hits["urls"] == 0
+
+def test_url_removal_matches_preprocessing():
+    text_normalizer = TextNormalizer(get_normalization_stages(["urls"]))
+    values = pd.Series(["lorem ipsum www.google.com", "see https://example.com/page?q=1.", "lorem ipsum"])
+    assert list(text_normalizer.normalize_column(values)) == ["lorem ipsum ", "see .", "lorem ipsum"]
+
+def test_unsupported_stage():
+    with pytest.raises(AttributeError):
+        get_normalization_stages(["emoji"])
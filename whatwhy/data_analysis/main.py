@@ -22,9 +22,10 @@ this script in a Python distribution (e.g., Anaconda) that stores
 files on a large enough disk.
 """
 
-def get_raw_what_and_why_tokens_from_csv(csv_file_name, min_num_tokens_per_sample, max_num_tokens_per_sample, min_token_frequency):
+def get_raw_what_and_why_tokens_from_csv(csv_file_name, min_num_tokens_per_sample, max_num_tokens_per_sample, min_token_frequency, drop_duplicates=True):
     df = get_df_from_file(csv_file_name)
-    df = df.drop_duplicates(subset=QUESTION_WORDS)
+    if drop_duplicates:
+        df = df.drop_duplicates(subset=QUESTION_WORDS)
 
     for question_type in QUESTION_WORDS:
         token_col = question_type + " tokens"
@@ -112,6 +113,14 @@ def main():
                               )
                        )
 
+    parser.add_argument( "--deduplicated",
+                         action="store_true",
+                         help=( "Skip removing duplicate rows from the CSV file, because it was already \n"
+                                "deduplicated with 'whatwhy-text --process consolidate --sort-and-dedup \n"
+                                "--dedup-cols who what when where why how'."
+                              )
+                       )
+
     parser.add_argument( "--min-token-frequency",
                          type=int,
                          default=30,
@@ -159,7 +168,8 @@ def main():
             what_tokens, why_tokens = get_raw_what_and_why_tokens_from_csv( args.csv_file_name,
                                                                             args.min_tokens_per_sample,
                                                                             args.max_tokens_per_sample,
-                                                                            args.min_token_frequency
+                                                                            args.min_token_frequency,
+                                                                            not args.deduplicated
                                                                           )
             predictor = create_and_save_whatwhy_predictor( what_tokens,
                                                            why_tokens,
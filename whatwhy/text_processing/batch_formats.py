@@ -0,0 +1,92 @@
+import numpy as np
+from .helper_methods import get_csv_string_from_df, get_df_from_csv_string
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+class BatchFormatBase():
+    """Converts batches of data between DataFrames and the format they are stored in."""
+
+    name = None
+    file_extension = None
+
+    def get_batch_from_df(self, df):
+        raise NotImplementedError()
+
+    def get_df_from_batch(self, batch):
+        raise NotImplementedError()
+
+class CSVBatchFormat(BatchFormatBase):
+    """
+    Stores batches as tab separated text with every value quoted.
+    Lists of tokens are stored as plain-text representations of Python lists.
+    """
+
+    name = "csv"
+    file_extension = "csv"
+
+    def get_batch_from_df(self, df):
+        return get_csv_string_from_df(df)
+
+    def get_df_from_batch(self, batch):
+        return get_df_from_csv_string(batch)
+
+class ArrowBatchFormatBase(BatchFormatBase):
+    """
+    Base class for binary, columnar batch formats that are read and written with pyarrow.
+    Lists of tokens are stored as native list<string> columns.
+    """
+
+    def __init__(self):
+        if pa is None:
+            raise ImportError(f"pyarrow is required for the {self.name} batch format. Please install it with 'pip install whatwhy[arrow]'.")
+
+    def get_batch_from_df(self, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        self.write_table(table, sink)
+        return sink.getvalue().to_pybytes()
+
+    def get_df_from_batch(self, batch):
+        table = self.read_table(pa.py_buffer(batch))
+        df = table.to_pandas()
+        for field in table.schema:
+            if pa.types.is_list(field.type):
+                df[field.name] = df[field.name].apply(lambda values: list(values) if isinstance(values, np.ndarray) else values)
+        return df
+
+    def write_table(self, table, sink):
+        raise NotImplementedError()
+
+    def read_table(self, buffer):
+        raise NotImplementedError()
+
+class ArrowBatchFormat(ArrowBatchFormatBase):
+    """Stores batches in the Arrow IPC streaming format."""
+
+    name = "arrow"
+    file_extension = "arrow"
+
+    def write_table(self, table, sink):
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+
+    def read_table(self, buffer):
+        return pa.ipc.open_stream(buffer).read_all()
+
+class ParquetBatchFormat(ArrowBatchFormatBase):
+    """Stores batches as compressed Parquet files."""
+
+    name = "parquet"
+    file_extension = "parquet"
+
+    def write_table(self, table, sink):
+        pq.write_table(table, sink, compression="snappy")
+
+    def read_table(self, buffer):
+        return pq.read_table(pa.BufferReader(buffer))
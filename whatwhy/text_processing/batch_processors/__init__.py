@@ -4,3 +4,4 @@ from .preprocessing import BatchPreprocessor
 from .wh_phrases import WHPhrasesBatchProcessor
 from .tokenization import BatchTokenizer, BatchWHPhrasesTokenizer
 from .consolidation import BatchConsolidator
+from .chain import ChainedBatchProcessor
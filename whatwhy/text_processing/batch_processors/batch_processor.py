@@ -1,30 +1,135 @@
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from whatwhy.text_processing.batch_formats import CSVBatchFormat
 
 logging.basicConfig(level="INFO")
 logger = logging.getLogger(__name__)
 
+END_OF_BATCHES = None
+
+worker_batch_processor = None
+
+def get_batch_results_in_worker(batch):
+    return worker_batch_processor.get_batch_results(batch)
+
 class BatchProcessorBase():
     """
     Retrieves batches of text to process from a BatchSource,
     and writes the results to a BatchDestination.
+
+    If a ResultCache is specified, results of processing individual values with
+    get_cached_results() are looked up in it by a hash of the value and the configuration
+    of the batch processor, so values seen in earlier batches or runs are not processed again.
     """
 
+    # This should be increased when a change to a batch processor changes its results.
+    cache_version = 1
+
     def __init__(self, source,
                        dest,
                        id_col_name=None,
                        source_col_name=None,
                        dest_col_name=None,
-                       include_cols=None):
+                       include_cols=None,
+                       batch_format=None,
+                       result_cache=None):
         self.source = source
         self.dest = dest
         self.id_col_name = id_col_name
         self.source_col_name = source_col_name
         self.dest_col_name = dest_col_name
         self.include_cols = include_cols if include_cols is not None else []
+        self.batch_format = batch_format if batch_format is not None else CSVBatchFormat()
+        self.result_cache = result_cache
+        self.cache_key_prefix = None
+        self.num_cache_hits = 0
+        self.num_cache_misses = 0
+        self.num_result_threads = 1
+        self.result_executor = None
+        self.result_executor_pid = None
 
     def get_batch_results(self, batch):
+        batch_as_df = self.batch_format.get_df_from_batch(batch)
+        results_df = self.get_batch_results_df(batch_as_df)
+        self.log_cache_statistics()
+        results = {
+            "target_results_file_name" : self.get_target_results_file_name(batch_as_df),
+            "file_content" : self.batch_format.get_batch_from_df(results_df)
+        }
+        return results
+
+    def get_batch_results_df(self, batch_as_df):
+        """Processes a batch that has already been parsed, and returns the results as a DataFrame."""
         raise NotImplementedError()
 
+    def get_cached_results(self, values, get_result, is_cacheable=None):
+        """
+        Returns a Series with the result of get_result for each value of a Series. Each distinct
+        string is processed at most once, and only if its result is not in the result cache.
+        Results for which is_cacheable returns False, such as failures, are not cached.
+        """
+        distinct_values = list(dict.fromkeys( value for value in values if isinstance(value, str) ))
+        results = {}
+        if self.result_cache is not None:
+            value_keys = { value : self.get_cache_key(value) for value in distinct_values }
+            cached_results = self.result_cache.get_many(list(value_keys.values()))
+            for value, key in value_keys.items():
+                if key in cached_results:
+                    results[value] = cached_results[key]
+            self.num_cache_hits += len(results)
+            self.num_cache_misses += len(distinct_values) - len(results)
+
+        missed_values = [ value for value in distinct_values if value not in results ]
+        new_results = {}
+        for value, result in zip(missed_values, self.get_results(missed_values, get_result)):
+            results[value] = result
+            if self.result_cache is not None and (is_cacheable is None or is_cacheable(result)):
+                new_results[value_keys[value]] = result
+        if len(new_results) > 0:
+            self.result_cache.put_many(new_results)
+        return values.apply(lambda value: results[value] if isinstance(value, str) else get_result(value))
+
+    def get_results(self, values, get_result):
+        """
+        Returns a list with the result of get_result for each value in a list. If num_result_threads
+        is greater than 1, up to that many values are processed concurrently, such as to keep
+        several requests in flight to a server.
+        """
+        if self.num_result_threads <= 1 or len(values) <= 1:
+            return [ get_result(value) for value in values ]
+        # Threads do not survive forking, so each worker process creates its own pool.
+        if self.result_executor is None or self.result_executor_pid != os.getpid():
+            self.result_executor = ThreadPoolExecutor(max_workers=self.num_result_threads)
+            self.result_executor_pid = os.getpid()
+        return list(self.result_executor.map(get_result, values))
+
+    def get_cache_config(self):
+        """Returns any configuration that the results of this batch processor depend on, to include in cache keys."""
+        return {}
+
+    def get_cache_key(self, value):
+        if self.cache_key_prefix is None:
+            config = { "processor" : type(self).__name__, "version" : self.cache_version, "config" : self.get_cache_config() }
+            self.cache_key_prefix = json.dumps(config, sort_keys=True) + "\n"
+        return hashlib.sha256((self.cache_key_prefix + value).encode("utf-8")).hexdigest()
+
+    def log_cache_statistics(self):
+        if self.result_cache is None or self.num_cache_hits + self.num_cache_misses == 0:
+            return
+        logger.info(f"{type(self).__name__} result cache: {self.num_cache_hits} hits, {self.num_cache_misses} misses.")
+        self.num_cache_hits = 0
+        self.num_cache_misses = 0
+
+    def get_target_results_file_name(self, batch_as_df):
+        return f"batch{batch_as_df[self.id_col_name].iloc[0]}.{self.batch_format.file_extension}"
+
     def run(self):
         while True:
             try:
@@ -32,10 +137,154 @@ class BatchProcessorBase():
                 batch_results = self.get_batch_results(batch)
                 results_file_content = batch_results["file_content"]
                 target_file_name = batch_results["target_results_file_name"]
-                self.dest.publish_batch_results(results_file_content, target_file_name)
-                self.source.mark_batch_as_complete()
+                is_published = self.dest.publish_batch_results(results_file_content, target_file_name)
+                num_failed = self.dest.flush()
+                # Batches whose results were not sent are left for the source to deliver again.
+                if is_published and num_failed == 0:
+                    self.source.mark_batch_as_complete()
+                else:
+                    logger.error(f"Failed to publish {target_file_name}, so its batch was not marked as complete.")
             except StopIteration:
                 logger.info(f"Finished reading batches from source.")
+                self.source.close()
+                break
+            except Exception as e:
+                logger.error(e)
+
+    def run_pipelined(self, fetch_queue_depth=4, publish_queue_depth=4, num_workers=1):
+        """
+        Runs the fetch, compute, and publish steps of run() as a pipeline.
+
+        Batches are fetched from the source and published to the destination on
+        background threads, so that network I/O overlaps processing of the current batch.
+        The stages are connected by queues holding at most fetch_queue_depth and
+        publish_queue_depth batches. Batches are marked as complete in the order
+        they were fetched, after their results have been flushed to the destination.
+        Batches whose results could not be published or flushed are not marked as complete.
+
+        If num_workers is greater than 1, batch results are computed by a pool of
+        worker processes instead. The workers are forked from this process, so state
+        loaded by the constructor (such as a spell checking model) is shared with them
+        rather than loaded again. This is not supported on platforms without fork.
+        """
+        pool = self.get_worker_pool(num_workers) if num_workers > 1 else None
+        fetched_batches = queue.Queue(maxsize=max(fetch_queue_depth, 1))
+        batch_results_to_publish = queue.Queue(maxsize=max(publish_queue_depth, 1))
+        fetch_thread = threading.Thread(target=self.fetch_batches, args=(fetched_batches,), daemon=True)
+        publish_thread = threading.Thread(target=self.publish_batches, args=(batch_results_to_publish, publish_queue_depth), daemon=True)
+        fetch_thread.start()
+        publish_thread.start()
+
+        try:
+            if pool is None:
+                self.compute_batch_results(fetched_batches, batch_results_to_publish)
+            else:
+                self.compute_batch_results_in_pool(pool, num_workers, fetched_batches, batch_results_to_publish)
+        finally:
+            batch_results_to_publish.put(END_OF_BATCHES)
+            publish_thread.join()
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        fetch_thread.join()
+        logger.info(f"Finished reading batches from source.")
+        self.source.close()
+
+    def fetch_batches(self, fetched_batches):
+        while True:
+            try:
+                batch = self.source.get_next_batch()
+                if batch is not None:
+                    fetched_batches.put( (batch, self.source.get_batch_handle()) )
+            except StopIteration:
                 break
             except Exception as e:
                 logger.error(e)
+        fetched_batches.put(END_OF_BATCHES)
+
+    def compute_batch_results(self, fetched_batches, batch_results_to_publish):
+        while True:
+            fetched_batch = fetched_batches.get()
+            if fetched_batch is END_OF_BATCHES:
+                break
+            batch, batch_handle = fetched_batch
+            try:
+                batch_results = self.get_batch_results(batch)
+                batch_results_to_publish.put( (batch_results, batch_handle) )
+            except Exception as e:
+                logger.error(e)
+
+    def compute_batch_results_in_pool(self, pool, num_workers, fetched_batches, batch_results_to_publish):
+        pending_batch_results = deque()
+
+        def publish_next_batch_results():
+            async_batch_results, batch_handle = pending_batch_results.popleft()
+            try:
+                batch_results_to_publish.put( (async_batch_results.get(), batch_handle) )
+            except Exception as e:
+                logger.error(e)
+
+        while True:
+            fetched_batch = fetched_batches.get()
+            if fetched_batch is END_OF_BATCHES:
+                break
+            batch, batch_handle = fetched_batch
+            if not isinstance(batch, (str, bytes)):
+                batch = bytes(batch) # Buffers such as memory-mapped files cannot be sent to other processes.
+            async_batch_results = pool.apply_async(get_batch_results_in_worker, (batch,))
+            pending_batch_results.append( (async_batch_results, batch_handle) )
+            # Results are published in the order their batches were fetched.
+            while len(pending_batch_results) > 0 and pending_batch_results[0][0].ready():
+                publish_next_batch_results()
+            if len(pending_batch_results) >= 2 * num_workers:
+                publish_next_batch_results()
+        while len(pending_batch_results) > 0:
+            publish_next_batch_results()
+
+    def get_worker_pool(self, num_workers):
+        """
+        Returns a pool of processes forked from this one for computing batch results.
+        This should be called before any other threads are started.
+        """
+        global worker_batch_processor
+        # Batch processors hold state that cannot be sent to other processes, such as
+        # models, locks, and connections, so workers can only be created by forking.
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise AttributeError("Processing batches with more than one worker is not supported on this platform.")
+        worker_batch_processor = self
+        return multiprocessing.get_context("fork").Pool(num_workers)
+
+    def publish_batches(self, batch_results_to_publish, max_unflushed_batches):
+        unflushed_batch_handles = []
+        while True:
+            published_batch = batch_results_to_publish.get()
+            if published_batch is END_OF_BATCHES:
+                break
+            batch_results, batch_handle = published_batch
+            try:
+                results_file_content = batch_results["file_content"]
+                target_file_name = batch_results["target_results_file_name"]
+                if self.dest.publish_batch_results(results_file_content, target_file_name):
+                    unflushed_batch_handles.append(batch_handle)
+                else:
+                    logger.error(f"Failed to publish {target_file_name}, so its batch was not marked as complete.")
+            except Exception as e:
+                logger.error(e)
+            # Results are flushed in groups while the compute stage is ahead of this stage.
+            if batch_results_to_publish.empty() or len(unflushed_batch_handles) >= max_unflushed_batches:
+                self.mark_batches_as_complete(unflushed_batch_handles)
+        self.mark_batches_as_complete(unflushed_batch_handles)
+
+    def mark_batches_as_complete(self, batch_handles):
+        try:
+            num_failed = self.dest.flush()
+            # The destination does not report which results failed, so none of the group is marked as complete.
+            if num_failed > 0:
+                logger.error(f"Failed to flush {num_failed} results, so {len(batch_handles)} batches were not marked as complete.")
+            else:
+                for batch_handle in batch_handles:
+                    self.source.mark_batch_as_complete(batch_handle)
+        except Exception as e:
+            logger.error(e)
+        batch_handles.clear()
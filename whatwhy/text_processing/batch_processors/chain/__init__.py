@@ -0,0 +1 @@
+from .batch_processor import ChainedBatchProcessor
@@ -0,0 +1,33 @@
+from whatwhy.text_processing.batch_processors import BatchProcessorBase
+
+class ChainedBatchProcessor(BatchProcessorBase):
+    """
+    Runs a sequence of batch processors on each batch, such as
+    preprocessing, wh-phrases, and then tokenize-wh-phrases.
+
+    Each batch is parsed once and passed between the processors as a DataFrame,
+    so only the results of the last processor are serialized and written to the
+    destination. To also keep the results of the other processors, specify
+    intermediate_dests with one destination for each of them.
+    """
+
+    def __init__(self, source,
+                       dest,
+                       batch_processors,
+                       intermediate_dests=None,
+                       id_col_name="ID",
+                       batch_format=None):
+        super().__init__(source, dest, id_col_name=id_col_name, batch_format=batch_format)
+        self.batch_processors = batch_processors
+        self.intermediate_dests = intermediate_dests if intermediate_dests is not None else []
+
+    def get_batch_results_df(self, batch_as_df):
+        target_results_file_name = self.get_target_results_file_name(batch_as_df)
+        for i, batch_processor in enumerate(self.batch_processors):
+            batch_as_df = batch_processor.get_batch_results_df(batch_as_df)
+            batch_processor.log_cache_statistics()
+            if i < len(self.batch_processors) - 1 and i < len(self.intermediate_dests):
+                intermediate_dest = self.intermediate_dests[i]
+                intermediate_dest.publish_batch_results(self.batch_format.get_batch_from_df(batch_as_df), target_results_file_name)
+                intermediate_dest.flush()
+        return batch_as_df
@@ -1,36 +1,172 @@
 import logging
+import queue
+import threading
 import pandas as pd
 from whatwhy.text_processing.batch_processors import BatchProcessorBase
-from whatwhy.text_processing.helper_methods import get_df_from_csv_string, get_csv_string_from_df
+from whatwhy.text_processing.batch_processors.batch_processor import END_OF_BATCHES
+from whatwhy.text_processing.helper_methods import get_csv_string_from_df
+from .external_sort import ExternalSorter, drop_adjacent_duplicates
 
 logging.basicConfig(level="INFO")
 logger = logging.getLogger(__name__)
 
+CONSOLIDATED_FILE_NAME = "consolidated_batches.csv"
+
 class BatchConsolidator (BatchProcessorBase):
-    """Consolidates data from multiple CSV files into a single CSV file."""
+    """
+    Consolidates data from multiple batch files into a single CSV file.
+
+    Each batch is appended to the file as soon as it is read, using a stream opened on
+    the destination, so only one batch is held in memory at a time. Columns are taken from
+    the first batch. Batches are marked as complete once the whole file has been written.
+
+    If sort_and_dedup is True, rows are instead sorted by the ID column, and rows with the same
+    values in dedup_col_names (by default, the ID column) are removed, keeping the row with the lowest ID
+    (or the first one read, if their IDs are equal).
+    Sorting is done with an external merge sort, which holds at most max_rows_in_memory rows in memory
+    and writes the rest to temporary files in tmp_dir. Numeric IDs are sorted by their value.
+    """
 
     def __init__(self, source,
                        dest,
                        id_col_name="ID",
                        source_col_name=None,
                        dest_col_name=None,
-                       include_cols=None):
-        super().__init__(source, dest, id_col_name=id_col_name)
+                       include_cols=None,
+                       batch_format=None,
+                       sort_and_dedup=False,
+                       dedup_col_names=None,
+                       max_rows_in_memory=100000,
+                       tmp_dir=None):
+        super().__init__(source, dest, id_col_name=id_col_name, batch_format=batch_format)
+        self.sort_and_dedup = sort_and_dedup
+        self.dedup_col_names = dedup_col_names if dedup_col_names else [id_col_name]
+        self.max_rows_in_memory = max_rows_in_memory
+        self.tmp_dir = tmp_dir
 
     def run(self):
-        df = pd.DataFrame()
-        while True:
-            try:
-                batch = self.source.get_next_batch()
-                batch_df = get_df_from_csv_string(batch)
-                df = pd.concat([df, batch_df])
-                self.source.mark_batch_as_complete()
-            except StopIteration:
-                logger.info(f"Finished reading batches from source.")
-                results_file_content = get_csv_string_from_df(df)
-                target_file_name = "consolidated_batches.csv"
-                self.dest.publish_batch_results(results_file_content, target_file_name)
-                break
-            except Exception as e:
-                logger.error(e)
-                break
+        def get_batches():
+            while True:
+                try:
+                    batch = self.source.get_next_batch()
+                except StopIteration:
+                    return
+                yield batch, self.source.get_batch_handle()
+
+        self.consolidate_batches(get_batches())
+        logger.info(f"Finished reading batches from source.")
+        self.source.close()
+
+    def run_pipelined(self, fetch_queue_depth=4, publish_queue_depth=4, num_workers=1):
+        """
+        Fetches batches on a background thread while earlier batches are appended to the file.
+        Consolidation publishes a single file, so publish_queue_depth and num_workers are ignored.
+        """
+        fetched_batches = queue.Queue(maxsize=max(fetch_queue_depth, 1))
+        fetch_thread = threading.Thread(target=self.fetch_batches, args=(fetched_batches,), daemon=True)
+        fetch_thread.start()
+        finished_fetching = False
+
+        def get_fetched_batches():
+            nonlocal finished_fetching
+            yield from iter(fetched_batches.get, END_OF_BATCHES)
+            finished_fetching = True
+
+        self.consolidate_batches(get_fetched_batches())
+        if not finished_fetching:
+            # Consolidation stopped early, so the remaining batches are drained to let the fetch thread finish.
+            while fetched_batches.get() is not END_OF_BATCHES:
+                pass
+        fetch_thread.join()
+        logger.info(f"Finished reading batches from source.")
+        self.source.close()
+
+    def consolidate_batches(self, batches):
+        """
+        Appends each (batch, batch handle) pair from an iterable to the consolidated file.
+        Returns whether the file was written successfully.
+        """
+        results_stream = self.dest.open_batch_results_stream(CONSOLIDATED_FILE_NAME)
+        batch_handles = []
+        try:
+            batch_dfs = self.get_batch_dfs(batches, batch_handles)
+            if self.sort_and_dedup:
+                batch_dfs = self.get_sorted_and_deduplicated_dfs(batch_dfs)
+            for i, batch_df in enumerate(batch_dfs):
+                results_stream.write(get_csv_string_from_df(batch_df, header=i == 0))
+        except Exception as e:
+            logger.error(e)
+            results_stream.abort()
+            return False
+        if not results_stream.close():
+            return False
+        logger.info(f"Consolidated {len(batch_handles)} batches.")
+        for batch_handle in batch_handles:
+            self.source.mark_batch_as_complete(batch_handle)
+        return True
+
+    def get_batch_dfs(self, batches, batch_handles):
+        """Parses each batch, aligns its columns to those of the first batch, and records its handle."""
+        columns = None
+        for batch, batch_handle in batches:
+            batch_df = self.batch_format.get_df_from_batch(batch)
+            if columns is None:
+                columns = batch_df.columns
+            elif not batch_df.columns.equals(columns):
+                logger.warning(f"Batch columns {list(batch_df.columns)} differ from the first batch, and will be aligned to {list(columns)}.")
+                batch_df = batch_df.reindex(columns=columns)
+            yield batch_df
+            batch_handles.append(batch_handle)
+
+    def get_sorted_and_deduplicated_dfs(self, batch_dfs):
+        """Yields DataFrames of at most max_rows_in_memory rows, sorted by ID and without duplicates."""
+        columns = None
+        id_sorter = ExternalSorter(lambda row: get_id_sort_key(row[id_col_index]), self.max_rows_in_memory, self.tmp_dir)
+        dedup_sorter = None
+        for batch_df in batch_dfs:
+            if columns is None:
+                columns = list(batch_df.columns)
+                id_col_index = columns.index(self.id_col_name)
+                dedup_col_indices = [ columns.index(col_name) for col_name in self.dedup_col_names ]
+                get_dedup_key = lambda row: tuple( get_value_sort_key(row[i]) for i in dedup_col_indices )
+                if self.dedup_col_names != [self.id_col_name]:
+                    # Rows are first sorted by their dedup columns to find duplicates, and then sorted again by ID.
+                    dedup_sorter = ExternalSorter( lambda row: (get_dedup_key(row), get_id_sort_key(row[id_col_index])),
+                                                   self.max_rows_in_memory,
+                                                   self.tmp_dir )
+            for row in batch_df.itertuples(index=False, name=None):
+                (id_sorter if dedup_sorter is None else dedup_sorter).add(row)
+        if columns is None:
+            id_sorter.close()
+            return
+
+        if dedup_sorter is None:
+            rows = drop_adjacent_duplicates(id_sorter.get_sorted_items(), get_dedup_key)
+        else:
+            for row in drop_adjacent_duplicates(dedup_sorter.get_sorted_items(), get_dedup_key):
+                id_sorter.add(row)
+            rows = id_sorter.get_sorted_items()
+
+        num_rows = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.max_rows_in_memory:
+                yield pd.DataFrame(chunk, columns=columns, index=pd.RangeIndex(num_rows, num_rows + len(chunk)))
+                num_rows += len(chunk)
+                chunk = []
+        if len(chunk) > 0 or num_rows == 0:
+            yield pd.DataFrame(chunk, columns=columns, index=pd.RangeIndex(num_rows, num_rows + len(chunk)))
+            num_rows += len(chunk)
+        logger.info(f"Wrote {num_rows} sorted and deduplicated rows.")
+
+def get_value_sort_key(value):
+    # Missing values are read as NaN, which cannot be compared with strings.
+    return value if isinstance(value, str) else ""
+
+def get_id_sort_key(id):
+    """Sorts numeric IDs by their value, followed by any other IDs as strings."""
+    id = get_value_sort_key(id)
+    if id.isdigit():
+        return (0, len(id.lstrip("0")), id.lstrip("0"), id)
+    return (1, 0, id, id)
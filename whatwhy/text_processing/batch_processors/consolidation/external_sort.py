@@ -0,0 +1,73 @@
+import heapq
+import os
+import pickle
+import tempfile
+
+class ExternalSorter():
+    """
+    Sorts more items than fit in memory.
+
+    Items are added one at a time. Every max_items_in_memory items are sorted
+    and written to a temporary file as a sorted run, and the runs are
+    lazily merged when the sorted items are retrieved.
+    Items must be picklable, and key must map them to comparable values.
+    """
+
+    def __init__(self, key, max_items_in_memory=100000, tmp_dir=None):
+        self.key = key
+        self.max_items_in_memory = max(max_items_in_memory, 1)
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="whatwhy-sort-", dir=tmp_dir)
+        self.items = []
+        self.run_file_names = []
+
+    def add(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.max_items_in_memory:
+            self.write_run()
+
+    def write_run(self):
+        self.items.sort(key=self.key)
+        run_file_name = os.path.join(self.tmp_dir.name, f"run{len(self.run_file_names)}")
+        with open(run_file_name, "wb") as run_file:
+            for item in self.items:
+                pickle.dump(item, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.run_file_names.append(run_file_name)
+        self.items = []
+
+    def get_sorted_items(self):
+        """
+        Yields every added item in sorted order. Items with equal keys are
+        yielded in the order they were added. Temporary files are deleted afterwards.
+        """
+        try:
+            self.items.sort(key=self.key)
+            runs = [ read_run(run_file_name) for run_file_name in self.run_file_names ]
+            # Runs are listed in the order they were written, followed by the items still in memory,
+            # so that heapq.merge keeps items with equal keys in the order they were added.
+            yield from heapq.merge(*runs, self.items, key=self.key)
+        finally:
+            self.close()
+
+    def close(self):
+        self.items = []
+        self.run_file_names = []
+        self.tmp_dir.cleanup()
+
+def read_run(run_file_name):
+    with open(run_file_name, "rb") as run_file:
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+def drop_adjacent_duplicates(items, key):
+    """Yields the first of each group of consecutive items with equal keys."""
+    prev_key = None
+    is_first = True
+    for item in items:
+        item_key = key(item)
+        if is_first or item_key != prev_key:
+            yield item
+        prev_key = item_key
+        is_first = False
@@ -1,55 +1,82 @@
-import re
+import hashlib
 import numpy as np
 import jamspell
 from whatwhy.text_processing.batch_processors import BatchProcessorBase
-from whatwhy.text_processing.helper_methods import get_csv_string_from_df, get_df_from_csv_string
 from whatwhy.resource_manager import get_jamspell_model_file_name
+from whatwhy.text_processing.spelling_correction import SpellingCorrector, get_file_hash
+from whatwhy.text_processing.text_normalization import URL_REGEX, TextNormalizer, URLRemovalStage
 
-def get_spell_checker():    
+def get_spell_checker(model_file_name=None):
     spell_checker = jamspell.TSpellCorrector()
-    spell_checker.LoadLangModel(get_jamspell_model_file_name())
+    spell_checker.LoadLangModel(model_file_name if model_file_name is not None else get_jamspell_model_file_name())
     return spell_checker
 
 class BatchPreprocessor(BatchProcessorBase):
-    """Preprocesses text by removing URL's and auto-correcting common spelling errors."""
+    """
+    Preprocesses text by removing URL's and auto-correcting common spelling errors.
+
+    Text is normalized a column at a time by normalization_stages, which remove URL's by default,
+    and can also strip mentions and hashtags, collapse whitespace, and normalize unicode.
+    Spelling corrections of recently seen sentences are memoized. If a spelling_cache
+    is specified, corrections are also stored in it for the model that is used.
+    If a set of known_words is specified, sentences with only known words are not checked.
+    """
+
+    # Results are cached by the normalized text, rather than the source text.
+    cache_version = 2
 
     def __init__(self, source,
                        dest,
                        id_col_name="ID",
                        source_col_name="Text",
                        dest_col_name="Preprocessed Text",
-                       include_cols=None):
+                       include_cols=None,
+                       batch_format=None,
+                       result_cache=None,
+                       spelling_cache=None,
+                       known_words=None,
+                       normalization_stages=None):
 
         super().__init__(source=source,
                             dest=dest,
                             id_col_name=id_col_name,
                             source_col_name=source_col_name,
                             dest_col_name=dest_col_name,
-                            include_cols=include_cols)
-        self.spell_checker = get_spell_checker()
+                            include_cols=include_cols,
+                            batch_format=batch_format,
+                            result_cache=result_cache)
+        model_file_name = get_jamspell_model_file_name()
+        self.spell_checker = get_spell_checker(model_file_name)
+        # Cached corrections are only reused with the same spell checking model.
+        self.model_hash = get_file_hash(model_file_name) if spelling_cache is not None or result_cache is not None else ""
+        self.spelling_corrector = SpellingCorrector( self.spell_checker,
+                                                     persistent_cache=spelling_cache,
+                                                     model_hash=self.model_hash,
+                                                     known_words=known_words )
+        self.text_normalizer = TextNormalizer(normalization_stages if normalization_stages is not None else [URLRemovalStage()])
 
-    def get_batch_results(self, batch):
-        batch_as_df = get_df_from_csv_string(batch)
-        batch_as_df[self.dest_col_name] = batch_as_df[self.source_col_name].apply( self.remove_url ) \
-                                                                           .apply( self.autocorrect_spelling )
+    def get_batch_results_df(self, batch_as_df):
+        normalized_text = self.text_normalizer.normalize_column(batch_as_df[self.source_col_name])
+        batch_as_df[self.dest_col_name] = self.get_cached_results(normalized_text, self.autocorrect_spelling)
+        self.text_normalizer.log_statistics()
+        self.spelling_corrector.flush()
         results_df_cols = [self.id_col_name, self.dest_col_name]
         results_df_cols.extend(self.include_cols)
-        results_df = batch_as_df[results_df_cols]
-        results_csv_string = get_csv_string_from_df(results_df)
+        return batch_as_df[results_df_cols]
 
-        results = {
-            "target_results_file_name" : f"batch{batch_as_df[self.id_col_name].iloc[0]}.csv",
-            "file_content" : results_csv_string
-        }
-        return results
+    def get_cache_config(self):
+        cache_config = { "model" : self.model_hash }
+        known_words = self.spelling_corrector.known_words
+        if known_words is not None:
+            # Results depend on which words are assumed to be spelled correctly.
+            cache_config["known_words"] = hashlib.sha256("\n".join(sorted(known_words)).encode("utf-8")).hexdigest()
+        return cache_config
 
     def remove_url(self, text):
         if text is None or text is np.nan:
             return text
         try:
-            url_regex = r'''(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))'''
-            text = re.sub(url_regex, "", text, flags=re.MULTILINE) 
-            return text 
+            return URL_REGEX.sub("", text)
         except:
             return text
 
@@ -57,6 +84,6 @@ class BatchPreprocessor(BatchProcessorBase):
         if text is None or text is np.nan:
             return text    
         try:
-            return self.spell_checker.FixFragment(text)
+            return self.spelling_corrector.correct(text)
         except:
             return text
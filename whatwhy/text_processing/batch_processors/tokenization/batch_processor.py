@@ -5,7 +5,6 @@ from nltk.corpus import stopwords
 from whatwhy import QUESTION_WORDS
 from whatwhy.resource_manager import configure_nltk
 from whatwhy.text_processing.batch_processors import BatchProcessorBase
-from whatwhy.text_processing.helper_methods import get_df_from_csv_string, get_csv_string_from_df
 
 configure_nltk()
 
@@ -19,37 +18,36 @@ class BatchTokenizer(BatchProcessorBase):
                        id_col_name="ID",
                        source_col_name="Preprocessed Text",
                        dest_col_name="Tokens",
-                       include_cols=None):
+                       include_cols=None,
+                       batch_format=None,
+                       result_cache=None):
 
         super().__init__(source=source,
                             dest=dest,
                             id_col_name=id_col_name,
                             source_col_name=source_col_name,
                             dest_col_name=dest_col_name,
-                            include_cols=include_cols)
+                            include_cols=include_cols,
+                            batch_format=batch_format,
+                            result_cache=result_cache)
         
-    def get_batch_results(self, batch):
-        batch_as_df = get_df_from_csv_string(batch)
+    def get_batch_results_df(self, batch_as_df):
         batch_as_df[self.dest_col_name] = self.get_tokenized_column(batch_as_df, self.source_col_name)
 
         results_df_cols = [self.id_col_name, self.dest_col_name]
         results_df_cols.extend(self.include_cols)
-        results_df = batch_as_df[results_df_cols]
-        results_csv_string = get_csv_string_from_df(results_df)
-
-        results = {
-            "target_results_file_name" : f"batch{batch_as_df[self.id_col_name].iloc[0]}.csv",
-            "file_content" : results_csv_string
-        }
-        return results
+        return batch_as_df[results_df_cols]
 
     def get_tokenized_column(self, df, col_name):
-        return df[col_name].apply( self.get_list_of_lemmatized_words_from_text ) \
-                           .apply( self.convert_to_lowercase ) \
-                           .apply( self.remove_punctuation ) \
-                           .apply( self.remove_non_alphabetic_tokens ) \
-                           .apply( self.remove_stop_words ) \
-                           .apply( self.remove_short_tokens )
+        return self.get_cached_results(df[col_name], self.get_tokens)
+
+    def get_tokens(self, text):
+        tokens = self.get_list_of_lemmatized_words_from_text(text)
+        tokens = self.convert_to_lowercase(tokens)
+        tokens = self.remove_punctuation(tokens)
+        tokens = self.remove_non_alphabetic_tokens(tokens)
+        tokens = self.remove_stop_words(tokens)
+        return self.remove_short_tokens(tokens)
 
     def get_list_of_lemmatized_words_from_text(self, text):
         if text is None or text is np.nan or text == "NOT PROCESSED":
@@ -84,8 +82,7 @@ class BatchWHPhrasesTokenizer(BatchTokenizer):
     'when tokens', 'where tokens', 'why tokens', and 'how tokens'.
     """
 
-    def get_batch_results(self, batch):
-        batch_as_df = get_df_from_csv_string(batch)
+    def get_batch_results_df(self, batch_as_df):
         results_df_cols = [self.id_col_name]
         results_df_cols.extend(self.include_cols)
 
@@ -95,11 +92,4 @@ class BatchWHPhrasesTokenizer(BatchTokenizer):
             results_df_cols.extend([source_col_name, dest_col_name])
             batch_as_df[dest_col_name] = self.get_tokenized_column(batch_as_df, source_col_name)
 
-        results_df = batch_as_df[results_df_cols]
-        results_csv_string = get_csv_string_from_df(results_df)
-
-        results = {
-            "target_results_file_name" : f"batch{batch_as_df[self.id_col_name].iloc[0]}.csv",
-            "file_content" : results_csv_string
-        }
-        return results
+        return batch_as_df[results_df_cols]
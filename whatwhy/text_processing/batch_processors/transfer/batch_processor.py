@@ -1,5 +1,4 @@
 from whatwhy.text_processing.batch_processors import BatchProcessorBase
-from whatwhy.text_processing.helper_methods import get_df_from_csv_string
 
 class BatchTransferer(BatchProcessorBase):
     """Transfers a batch of data without changing its contents."""
@@ -9,13 +8,17 @@ class BatchTransferer(BatchProcessorBase):
                        id_col_name="ID",
                        source_col_name=None,
                        dest_col_name=None,
-                       include_cols=None):
-        super().__init__(source, dest, id_col_name=id_col_name)
+                       include_cols=None,
+                       batch_format=None):
+        super().__init__(source, dest, id_col_name=id_col_name, batch_format=batch_format)
     
     def get_batch_results(self, batch):
-        batch_as_df = get_df_from_csv_string(batch)
+        batch_as_df = self.batch_format.get_df_from_batch(batch)
         results = {
-            "target_results_file_name" : f"batch{batch_as_df[self.id_col_name].iloc[0]}.csv",
-            "file_content" : batch
+            "target_results_file_name" : self.get_target_results_file_name(batch_as_df),
+            "file_content" : batch if isinstance(batch, (str, bytes)) else bytes(batch)
         }
         return results
+
+    def get_batch_results_df(self, batch_as_df):
+        return batch_as_df
@@ -1,4 +1,4 @@
-from time import sleep
+import threading
 import numpy as np
 from Giveme5W1H.extractor.preprocessors.preprocessor_core_nlp import Preprocessor
 from Giveme5W1H.extractor.document import Document
@@ -7,7 +7,7 @@ from Giveme5W1H.extractor.extractors import action_extractor, cause_extractor, m
 from whatwhy import QUESTION_WORDS
 from whatwhy.resource_manager.nltk import configure_nltk
 from whatwhy.text_processing.batch_processors import BatchProcessorBase
-from whatwhy.text_processing.helper_methods import get_df_from_csv_string, get_csv_string_from_df
+from whatwhy.text_processing.corenlp_pool import CoreNLPEndpointPool, CachedCoreNLPAnnotator
 
 class WHPhrasesBatchProcessor(BatchProcessorBase):
     """
@@ -15,8 +15,17 @@ class WHPhrasesBatchProcessor(BatchProcessorBase):
 
     This is intended to be run from within a Docker network, since
     access to a Stanford CoreNLP server API at http://corenlp-service:9000
-    is required. Please see the readme file at https://github.com/stevengt/whatwhy
+    is required by default. Please see the readme file at https://github.com/stevengt/whatwhy
     for more information.
+
+    Up to num_concurrent_requests texts are sent to the CoreNLP servers at once, since
+    each text otherwise spends most of its time waiting for a server's response. If several
+    corenlp_urls are specified, requests are balanced between the servers that are ready.
+    If no server is ready within corenlp_ready_timeout seconds, a ConnectionError is raised.
+
+    If an annotation_cache is specified, the CoreNLP annotations of each text are stored in it,
+    so that texts which were already annotated are not sent to a server again, such as when
+    rerunning the extraction with different extractors.
     """
 
     def __init__(self, source,
@@ -24,22 +33,46 @@ class WHPhrasesBatchProcessor(BatchProcessorBase):
                        id_col_name="ID",
                        source_col_name="Preprocessed Text",
                        dest_col_name=None,
-                       include_cols=None):
+                       include_cols=None,
+                       batch_format=None,
+                       result_cache=None,
+                       num_concurrent_requests=4,
+                       corenlp_urls=None,
+                       corenlp_ready_timeout=300,
+                       annotation_cache=None):
 
         super().__init__(source=source,
                             dest=dest,
                             id_col_name=id_col_name,
                             source_col_name=source_col_name,
-                            include_cols=include_cols)
+                            include_cols=include_cols,
+                            batch_format=batch_format,
+                            result_cache=result_cache)
         configure_nltk()
-        sleep(60) # Wait for Stanford CoreNLP server to start.
-        extractor_preprocessor = Preprocessor("http://corenlp-service:9000")
-        extractors = [
-            action_extractor.ActionExtractor(),
-            cause_extractor.CauseExtractor(),
-            method_extractor.MethodExtractor()
-        ]
-        self.extractor = MasterExtractor(preprocessor=extractor_preprocessor, extractors=extractors)
+        corenlp_urls = ["http://corenlp-service:9000"] if corenlp_urls is None else corenlp_urls
+        self.corenlp_pool = CoreNLPEndpointPool(corenlp_urls)
+        if not self.corenlp_pool.wait_until_ready(timeout_seconds=corenlp_ready_timeout):
+            raise ConnectionError(f"No CoreNLP server at {', '.join(corenlp_urls)} is ready.")
+        self.corenlp_annotator = self.corenlp_pool
+        if annotation_cache is not None:
+            self.corenlp_annotator = CachedCoreNLPAnnotator(self.corenlp_pool, annotation_cache)
+        self.num_result_threads = num_concurrent_requests
+        self.thread_local = threading.local()
+
+    def get_extractor(self):
+        """Returns an extractor for the current thread, since extractors keep state while parsing a document."""
+        extractor = getattr(self.thread_local, "extractor", None)
+        if extractor is None:
+            extractor_preprocessor = Preprocessor()
+            extractor_preprocessor.cnlp = self.corenlp_annotator
+            extractors = [
+                action_extractor.ActionExtractor(),
+                cause_extractor.CauseExtractor(),
+                method_extractor.MethodExtractor()
+            ]
+            extractor = MasterExtractor(preprocessor=extractor_preprocessor, extractors=extractors)
+            self.thread_local.extractor = extractor
+        return extractor
 
     def get_top_wh_phrases(self, text_segment):
         top_phrases = {}
@@ -49,7 +82,7 @@ class WHPhrasesBatchProcessor(BatchProcessorBase):
         if text_segment is not None and text_segment is not np.nan:
             try:
                 doc = Document.from_text(text_segment)
-                doc = self.extractor.parse(doc)
+                doc = self.get_extractor().parse(doc)
                 for question_type in QUESTION_WORDS:
                     if question_type == "where" or question_type == "when":
                         top_phrases[question_type] = "NOT PROCESSED"
@@ -63,23 +96,18 @@ class WHPhrasesBatchProcessor(BatchProcessorBase):
 
         return top_phrases
 
-    def get_batch_results(self, batch):
-        batch_as_df = get_df_from_csv_string(batch)
+    def was_parsed(self, top_phrases):
+        """Returns False if text could not be parsed, such as when the CoreNLP server is unavailable."""
+        return top_phrases["where"] == "NOT PROCESSED"
+
+    def get_batch_results_df(self, batch_as_df):
+        top_wh_phrases = self.get_cached_results(batch_as_df[self.source_col_name], self.get_top_wh_phrases, is_cacheable=self.was_parsed)
         for question_type in QUESTION_WORDS:
-            batch_as_df[question_type] = None
-        for i, row in batch_as_df.iterrows():
-            top_wh_phrases = self.get_top_wh_phrases(row[self.source_col_name])
-            for question_type in QUESTION_WORDS:
-                batch_as_df.at[i, question_type] = top_wh_phrases.get(question_type)
+            batch_as_df[question_type] = top_wh_phrases.apply(lambda top_phrases: top_phrases.get(question_type))
+        if isinstance(self.corenlp_annotator, CachedCoreNLPAnnotator):
+            self.corenlp_annotator.flush()
 
         results_df_cols = [self.id_col_name]
         results_df_cols.extend(QUESTION_WORDS)
         results_df_cols.extend(self.include_cols)
-        results_df = batch_as_df[results_df_cols]
-        results_csv_string = get_csv_string_from_df(results_df)
-
-        results = {
-            "target_results_file_name" : f"batch{batch_as_df[self.id_col_name].iloc[0]}.csv",
-            "file_content" : results_csv_string
-        }
-        return results
+        return batch_as_df[results_df_cols]
@@ -1,3 +1,5 @@
-from .fs_client import FileSystemBatchSource, FileSystemBatchDestination
-from .s3_client import S3BatchSource, S3BatchDestination
+from .fs_client import FileSystemBatchSource, FileSystemBatchDestination, FileSystemClaimCheckStore, FileSystemCompletionManifest
+from .s3_client import S3BatchSource, S3BatchDestination, S3ClaimCheckStore, S3CompletionManifest
 from .sqs_client import SQSBatchSource, SQSBatchDestination
+from .pipe_client import PipeBatchSource, PipeBatchDestination
+from .sqlite_client import SQLiteBatchSource, SQLiteBatchDestination
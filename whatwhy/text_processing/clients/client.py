@@ -1,5 +1,12 @@
+import json
 import logging
-from whatwhy.text_processing.helper_methods import get_csv_string_from_df
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from whatwhy.text_processing.batch_formats import CSVBatchFormat
+from .compression import get_compression_for_file_name
 
 logging.basicConfig(level="INFO")
 logger = logging.getLogger(__name__)
@@ -7,23 +14,372 @@ logger = logging.getLogger(__name__)
 class BatchSourceBase():
 
     def get_next_batch(self):
+        """Returns the content of the next batch as either a string or bytes."""
         raise NotImplementedError()
 
-    def mark_batch_as_complete(self):
+    def get_batch_handle(self):
+        """
+        Returns an object identifying the batch most recently returned by get_next_batch(),
+        which can be used to mark that batch as complete after later batches have been retrieved.
+        """
         raise NotImplementedError()
 
+    def mark_batch_as_complete(self, batch_handle=None):
+        """
+        Marks a batch as complete. By default, this is the batch
+        most recently returned by get_next_batch().
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Finishes any pending work, such as deleting completed batches."""
+        pass
+
+    def decompress_batch(self, batch, file_name):
+        """Decompresses a batch if the suffix of its file name or key indicates it was compressed."""
+        compression = get_compression_for_file_name(file_name)
+        return batch if compression is None else compression.decompress(batch)
+
 class BatchDestinationBase():
 
+    compression = None
+
     def publish_batch_results(self, results, target_file_name=None):
+        """
+        Sends or buffers batch results, and returns whether this succeeded.
+        Implementations should be safe to call from several threads at once.
+        """
         raise NotImplementedError()
 
-    def populate_from_df(self, df, batch_size=1000):
+    def flush(self):
+        """
+        Sends any batch results that are buffered by this destination, and returns
+        the number of buffered results that failed to send since the last flush.
+        """
+        return 0
+
+    def open_batch_results_stream(self, target_file_name):
+        """
+        Returns a BatchResultsStream for writing a single large file in pieces.
+        By default, the pieces are buffered in memory and published when the stream is closed.
+        """
+        return BufferedBatchResultsStream(self, target_file_name)
+
+    def compress_batch_results(self, results, target_file_name=None):
+        """
+        Compresses batch results if this destination has a compression,
+        and adds the matching suffix to the target file name.
+        """
+        if self.compression is None:
+            return results, target_file_name
+        if isinstance(results, str):
+            results = results.encode("utf-8")
+        if target_file_name is not None:
+            target_file_name = f"{target_file_name}.{self.compression.file_extension}"
+        return self.compression.compress(results), target_file_name
+
+    def populate_from_df(self, df, batch_size=1000, batch_format=None, num_upload_threads=1):
         nrows = df.shape[0]
-        batches = [ df.iloc[i:i+batch_size] for i in range(0, nrows, batch_size) ]
-        for i, batch in enumerate(batches):
+        batches = ( df.iloc[i:i+batch_size] for i in range(0, nrows, batch_size) )
+        return self.populate_from_df_chunks(batches, batch_format, num_upload_threads)
+
+    def populate_from_df_chunks(self, batches, batch_format=None, num_upload_threads=1):
+        """
+        Publishes each DataFrame from an iterable as a batch. Batches are published as soon as
+        they are retrieved, so the iterable may be a lazy reader over a file that does not fit in memory.
+
+        Batches are serialized on the calling thread, and published by a pool of num_upload_threads
+        threads. At most twice that many serialized batches are held in memory while they wait to be published.
+        Returns the number of batches that were published successfully, and the number that failed.
+        """
+        batch_format = batch_format if batch_format is not None else CSVBatchFormat()
+        num_upload_threads = max(num_upload_threads, 1)
+        num_succeeded = 0
+        num_failed = 0
+        pending_uploads = deque()
+
+        def wait_for_next_upload():
+            nonlocal num_succeeded, num_failed
+            i, upload = pending_uploads.popleft()
             try:
-                target_file_name = f"batch{i}.csv"
-                csv_string = get_csv_string_from_df(batch)
-                self.publish_batch_results(csv_string, target_file_name=target_file_name)
+                succeeded = upload.result()
             except Exception as e:
                 logger.error(f"Failed to populate batch {i}: {e}")
+                succeeded = False
+            if succeeded:
+                num_succeeded += 1
+            else:
+                num_failed += 1
+
+        with ThreadPoolExecutor(max_workers=num_upload_threads) as executor:
+            for i, batch in enumerate(batches):
+                try:
+                    target_file_name = f"batch{i}.{batch_format.file_extension}"
+                    batch_content = batch_format.get_batch_from_df(batch)
+                except Exception as e:
+                    logger.error(f"Failed to populate batch {i}: {e}")
+                    num_failed += 1
+                    continue
+                pending_uploads.append( (i, executor.submit(self.publish_batch_results, batch_content, target_file_name)) )
+                while len(pending_uploads) >= 2 * num_upload_threads:
+                    wait_for_next_upload()
+            while len(pending_uploads) > 0:
+                wait_for_next_upload()
+        num_failed_sends = self.flush()
+        num_succeeded -= num_failed_sends
+        num_failed += num_failed_sends
+        logger.info(f"Populated destination with {num_succeeded} batches. {num_failed} batches failed.")
+        return num_succeeded, num_failed
+
+class BatchResultsStreamBase():
+    """
+    Writes a single file of batch results to a destination in pieces,
+    so that the whole file never needs to be held in memory.
+    """
+
+    def write(self, results):
+        raise NotImplementedError()
+
+    def close(self):
+        """Finishes writing the file, and returns whether it was written successfully."""
+        raise NotImplementedError()
+
+    def abort(self):
+        """Discards anything written so far."""
+        raise NotImplementedError()
+
+class BufferedBatchResultsStream(BatchResultsStreamBase):
+
+    def __init__(self, dest, target_file_name):
+        self.dest = dest
+        self.target_file_name = target_file_name
+        self.pieces = []
+
+    def write(self, results):
+        self.pieces.append(results)
+
+    def close(self):
+        if all( isinstance(piece, str) for piece in self.pieces ):
+            results = "".join(self.pieces)
+        else:
+            results = b"".join( piece.encode("utf-8") if isinstance(piece, str) else piece for piece in self.pieces )
+        self.pieces = []
+        return self.dest.publish_batch_results(results, self.target_file_name) is not False and not self.dest.flush()
+
+    def abort(self):
+        self.pieces = []
+
+class CompressedBatchResultsStreamBase(BatchResultsStreamBase):
+    """
+    Base class for streams that write bytes to their destination as they go.
+    Pieces are compressed with the compression of the destination, if any.
+    """
+
+    def __init__(self, compression):
+        self.compressor = compression.get_compressor() if compression is not None else None
+
+    def write(self, results):
+        if isinstance(results, str):
+            results = results.encode("utf-8")
+        if self.compressor is not None:
+            results = self.compressor.compress(results)
+        if len(results) > 0:
+            self.write_bytes(results)
+
+    def close(self):
+        try:
+            if self.compressor is not None:
+                self.write_bytes(self.compressor.flush())
+            self.finish()
+            return True
+        except Exception as e:
+            logger.error(f"Failed to finish writing batch results: {e}")
+            self.abort()
+            return False
+
+    def write_bytes(self, data):
+        raise NotImplementedError()
+
+    def finish(self):
+        raise NotImplementedError()
+
+class ClaimCheckStoreBase():
+    """
+    Stores batch results that are too large to send directly to a destination,
+    such as SQS, so that a URI pointing to them can be sent in their place.
+    """
+
+    def put(self, results, target_file_name=None):
+        """Stores the results and returns their URI."""
+        raise NotImplementedError()
+
+    def get_unique_file_name(self, target_file_name=None):
+        unique_id = uuid.uuid4().hex
+        return unique_id if target_file_name is None else f"{unique_id}-{target_file_name}"
+
+class CompletionManifestBase():
+    """
+    Records the keys of completed batches along with a hash of their content,
+    so that a restarted run can skip batches that were already processed.
+
+    The manifest is loaded once when it is created, and then used as an index
+    of completed batches. It is stored as JSON lines of {"key", "hash"} objects.
+    """
+
+    def __init__(self):
+        self.completed_batches = {}
+        self.completed_batches_lock = threading.Lock()
+        for line in self.load_lines():
+            try:
+                entry = json.loads(line)
+                self.completed_batches[entry["key"]] = entry["hash"]
+            except ValueError:
+                # The last line may be incomplete if a previous run crashed while writing it.
+                logger.warning(f"Ignoring malformed line in manifest: {line.strip()}")
+        logger.info(f"Loaded {len(self.completed_batches)} completed batches from manifest.")
+
+    def is_complete(self, batch_key, content_hash):
+        """Returns whether a batch was completed, and its content has not changed since."""
+        with self.completed_batches_lock:
+            return batch_key in self.completed_batches and self.completed_batches[batch_key] == content_hash
+
+    def record_completed_batch(self, batch_key, content_hash):
+        line = json.dumps({ "key" : batch_key, "hash" : content_hash }) + "\n"
+        with self.completed_batches_lock:
+            self.completed_batches[batch_key] = content_hash
+            self.write_line(line)
+
+    def load_lines(self):
+        """Returns the lines of the stored manifest, or an empty list if it does not exist yet."""
+        raise NotImplementedError()
+
+    def write_line(self, line):
+        """Stores a line recording a completed batch. This is called while holding completed_batches_lock."""
+        raise NotImplementedError()
+
+    def flush(self):
+        """Stores any lines that are buffered by this manifest."""
+        pass
+
+BATCH_CLAIMED = "claimed"
+BATCH_HELD_BY_OTHER_CONSUMER = "held"
+BATCH_COMPLETE = "complete"
+WAITING_FOR_OTHER_CONSUMERS = object()
+# Yielded by iterators of batch names before they wait for new batches, such as while watching a folder.
+WAITING_FOR_NEW_BATCHES = object()
+
+class BatchLeasesBase():
+    """
+    Lets any number of consumers share one source by claiming batches with leases.
+
+    A consumer claims a batch by taking its lease, and renews the leases it holds
+    on a background thread every lease_seconds / 3 seconds. Completed batches are
+    marked as complete so that no other consumer claims them. Leases that are not
+    renewed within lease_seconds, such as those of a consumer that died, expire and
+    can be claimed by other consumers.
+    """
+
+    def __init__(self, lease_seconds=300, retry_interval_seconds=None):
+        self.lease_seconds = lease_seconds
+        self.retry_interval_seconds = retry_interval_seconds if retry_interval_seconds is not None else max(lease_seconds / 3, 1)
+        self.consumer_id = uuid.uuid4().hex
+        self.held_leases = {}
+        self.held_leases_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self.run_heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def claim_batches(self, batch_names):
+        """
+        Yields the names of batches claimed by this consumer. Batches held by other consumers
+        are retried every retry_interval_seconds until they are complete or their leases expire.
+        If batch_names yields WAITING_FOR_NEW_BATCHES, such as while watching a folder, they are
+        retried while waiting for new batches. Once every other batch has been tried, they are
+        retried until none are left, and until then, WAITING_FOR_OTHER_CONSUMERS is yielded
+        without blocking, so the caller can decide whether to call wait_for_retry().
+        """
+        held_by_other_consumers = []
+        next_retry_time = time.monotonic() + self.retry_interval_seconds
+        for batch_name in batch_names:
+            if batch_name is not WAITING_FOR_NEW_BATCHES:
+                yield from self.claim_available_batches([batch_name], held_by_other_consumers)
+            elif len(held_by_other_consumers) > 0 and time.monotonic() >= next_retry_time:
+                yield from self.retry_held_batches(held_by_other_consumers)
+                next_retry_time = time.monotonic() + self.retry_interval_seconds
+        next_retry_time = time.monotonic() + self.retry_interval_seconds
+        while len(held_by_other_consumers) > 0 and not self.stop_event.is_set():
+            if time.monotonic() < next_retry_time:
+                yield WAITING_FOR_OTHER_CONSUMERS
+                continue
+            yield from self.retry_held_batches(held_by_other_consumers)
+            next_retry_time = time.monotonic() + self.retry_interval_seconds
+
+    def retry_held_batches(self, held_by_other_consumers):
+        logger.info(f"Retrying {len(held_by_other_consumers)} batches held by other consumers.")
+        batch_names = list(held_by_other_consumers)
+        held_by_other_consumers.clear()
+        yield from self.claim_available_batches(batch_names, held_by_other_consumers)
+
+    def wait_for_retry(self):
+        self.stop_event.wait(self.retry_interval_seconds)
+
+    def claim_available_batches(self, batch_names, held_by_other_consumers):
+        for batch_name in batch_names:
+            status = self.try_claim(batch_name)
+            if status == BATCH_CLAIMED:
+                yield batch_name
+            elif status == BATCH_HELD_BY_OTHER_CONSUMER:
+                held_by_other_consumers.append(batch_name)
+
+    def get_lease_expiry_time(self):
+        return time.time() + self.lease_seconds
+
+    def run_heartbeat(self):
+        while not self.stop_event.wait(max(self.lease_seconds / 3, 1)):
+            with self.held_leases_lock:
+                batch_names = list(self.held_leases.keys())
+            for batch_name in batch_names:
+                try:
+                    self.renew(batch_name)
+                except Exception as e:
+                    logger.error(f"Lost lease on batch {batch_name}: {e}")
+                    with self.held_leases_lock:
+                        self.held_leases.pop(batch_name, None)
+
+    def mark_batch_as_complete(self, batch_name):
+        try:
+            self.complete(batch_name)
+        except Exception as e:
+            logger.error(f"Failed to mark lease on batch {batch_name} as complete: {e}")
+        with self.held_leases_lock:
+            self.held_leases.pop(batch_name, None)
+
+    def close(self):
+        """Stops renewing leases, and releases any that are still held so other consumers can claim them."""
+        self.stop_event.set()
+        with self.held_leases_lock:
+            batch_names = list(self.held_leases.keys())
+        # Leases are forgotten after they are released, since releasing a lease may depend on its state.
+        for batch_name in batch_names:
+            try:
+                self.release(batch_name)
+            except Exception as e:
+                logger.error(f"Failed to release lease on batch {batch_name}: {e}")
+        with self.held_leases_lock:
+            self.held_leases.clear()
+
+    def try_claim(self, batch_name):
+        """
+        Tries to take the lease on a batch, and returns BATCH_CLAIMED, BATCH_HELD_BY_OTHER_CONSUMER,
+        or BATCH_COMPLETE. Claimed leases are added to held_leases.
+        """
+        raise NotImplementedError()
+
+    def renew(self, batch_name):
+        raise NotImplementedError()
+
+    def complete(self, batch_name):
+        raise NotImplementedError()
+
+    def release(self, batch_name):
+        raise NotImplementedError()
@@ -0,0 +1,83 @@
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class CompressionBase():
+    """Compresses and decompresses batch payloads."""
+
+    name = None
+    file_extension = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+    def get_compressor(self):
+        """
+        Returns an object for compressing a stream incrementally. Its compress(data) method returns
+        the compressed data that is ready so far, and its flush() method returns the remainder.
+        """
+        raise NotImplementedError()
+
+class GzipCompression(CompressionBase):
+
+    name = "gzip"
+    file_extension = "gz"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+    def get_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # Adding 16 writes a gzip header.
+
+class ZstdCompression(CompressionBase):
+
+    name = "zstd"
+    file_extension = "zst"
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise ImportError("zstandard is required for zstd compression. Please install it with 'pip install whatwhy[zstd]'.")
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        # Streamed frames do not record their size, so they are decompressed incrementally.
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    def get_compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+COMPRESSION_TYPES = {
+    GzipCompression.name : GzipCompression,
+    ZstdCompression.name : ZstdCompression
+}
+
+def get_compression(compression_name):
+    """Returns the compression with the given name, or None if compression_name is None or 'none'."""
+    if compression_name is None or compression_name == "none":
+        return None
+    if compression_name not in COMPRESSION_TYPES:
+        raise AttributeError(f"Unsupported compression type {compression_name}.")
+    return COMPRESSION_TYPES[compression_name]()
+
+def get_compression_for_file_name(file_name):
+    """Returns the compression indicated by the suffix of a file name or key, if any."""
+    for compression_class in COMPRESSION_TYPES.values():
+        if file_name.endswith("." + compression_class.file_extension):
+            return compression_class()
+    return None
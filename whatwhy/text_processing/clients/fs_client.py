@@ -1,56 +1,393 @@
 import os
-from .client import logger, BatchSourceBase, BatchDestinationBase
+import hashlib
+import mmap
+import time
+from .client import ( logger, BatchSourceBase, BatchDestinationBase, ClaimCheckStoreBase, CompressedBatchResultsStreamBase, CompletionManifestBase,
+                      BatchLeasesBase, BATCH_CLAIMED, BATCH_HELD_BY_OTHER_CONSUMER, BATCH_COMPLETE, WAITING_FOR_OTHER_CONSUMERS,
+                      WAITING_FOR_NEW_BATCHES )
 
 class FileSystemBatchSource(BatchSourceBase):
     """
     Retrieves batch files from a local file system folder.
 
-    Each instance of this class should only have ONE consumer.
+    Each folder should only have ONE consumer, unless lease_seconds is specified.
+    In that case, any number of consumers can share the folder, each claiming
+    the next unclaimed batch with a lease (see FileSystemBatchLeases).
     
     This class iterates through all the files available in the folder
     at the time of instantiation, and optionally deletes them as they are processed.
+    Hidden files, such as partially written batches, are ignored.
+
+    If watch_interval_seconds is specified, the folder is polled for new batch files
+    at that interval once the existing files have been processed, until no new files
+    arrive for max_idle_seconds (if specified). The folder is only listed again when
+    its modification time changes. Files that are replaced, such as by a later run
+    writing batches with the same names, are processed again.
+
+    If use_mmap is True, batch files are memory-mapped, and the mapped buffer is returned
+    instead of a copy of the file content, so that parsers can read it directly.
+
+    If a CompletionManifest is specified, completed batches are recorded in it with the
+    SHA-256 hash of their content, and batches it records as complete are skipped.
     """
 
-    def __init__(self, folder_name, delete_when_complete=False):
+    def __init__(self, folder_name,
+                       delete_when_complete=False,
+                       manifest=None,
+                       lease_seconds=None,
+                       use_mmap=False,
+                       watch_interval_seconds=None,
+                       max_idle_seconds=None):
         logger.info(f"Reading batches from local folder {folder_name}.")
         self.delete_when_complete = delete_when_complete
         self.folder_name = folder_name
-        batch_file_names = os.listdir(folder_name)
-        batch_file_names.sort()
-        self.batch_file_names = iter(batch_file_names)
+        self.use_mmap = use_mmap
+        self.watch_interval_seconds = watch_interval_seconds
+        self.max_idle_seconds = max_idle_seconds
+        self.folder_mtime = os.stat(folder_name).st_mtime_ns
+        batch_file_mtimes = self.list_batch_files()
+        if watch_interval_seconds is not None:
+            batch_file_names = self.watch_batch_file_names(batch_file_mtimes)
+        else:
+            batch_file_names = sorted(batch_file_mtimes)
+        self.leases = FileSystemBatchLeases(folder_name, lease_seconds) if lease_seconds is not None else None
+        if self.leases is not None:
+            self.batch_file_names = self.leases.claim_batches(batch_file_names)
+        else:
+            self.batch_file_names = iter(batch_file_names)
         self.cur_batch_file_name = None
+        self.manifest = manifest
+        self.batch_hashes = {}
+        self.num_skipped_batches = 0
 
     def get_next_batch(self):
         try:
-            self.cur_batch_file_name = os.path.join(self.folder_name, self.batch_file_names.__next__())
-            with open(self.cur_batch_file_name) as batch_file:
-                return batch_file.read()
+            while True:
+                batch_file_name = self.batch_file_names.__next__()
+                if batch_file_name is WAITING_FOR_OTHER_CONSUMERS:
+                    self.leases.wait_for_retry()
+                    continue
+                if batch_file_name is WAITING_FOR_NEW_BATCHES:
+                    continue
+                self.cur_batch_file_name = os.path.join(self.folder_name, batch_file_name)
+                try:
+                    batch = self.read_batch_file(self.cur_batch_file_name)
+                except FileNotFoundError:
+                    if self.leases is None:
+                        raise
+                    # Another consumer completed and deleted the batch after it was listed.
+                    self.leases.mark_batch_as_complete(batch_file_name)
+                    continue
+                if self.manifest is None:
+                    break
+                batch_hash = hashlib.sha256(batch).hexdigest()
+                if not self.manifest.is_complete(batch_file_name, batch_hash):
+                    self.batch_hashes[self.cur_batch_file_name] = batch_hash
+                    break
+                self.num_skipped_batches += 1
+                if self.leases is not None:
+                    self.leases.mark_batch_as_complete(batch_file_name)
+            return self.decompress_batch(batch, self.cur_batch_file_name)
         except StopIteration as e:
             self.cur_batch_file_name = None
             raise e
         except Exception as e:
             logger.error(f"Failed to receive batch from local folder: {e}")
 
-    def mark_batch_as_complete(self):
-        if self.delete_when_complete and self.cur_batch_file_name is not None:
+    def list_batch_files(self):
+        """Returns the modification time of each batch file in the folder, by file name."""
+        batch_file_mtimes = {}
+        with os.scandir(self.folder_name) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    batch_file_mtimes[entry.name] = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    pass # The file was deleted after the folder was listed.
+        return batch_file_mtimes
+
+    def watch_batch_file_names(self, batch_file_mtimes):
+        """
+        Yields the names of the given batch files, followed by the names of any files that are added
+        to the folder or replaced, which are recognized by their modification times.
+        WAITING_FOR_NEW_BATCHES is yielded before each wait for new files.
+        """
+        seen_batch_file_mtimes = batch_file_mtimes
+        yield from sorted(batch_file_mtimes)
+        idle_since = time.monotonic()
+        while True:
+            folder_mtime = os.stat(self.folder_name).st_mtime_ns
+            # Files added within the timestamp resolution of the file system may not change
+            # the modification time, so the folder is always listed while it is recent.
+            if folder_mtime != self.folder_mtime or time.time() - folder_mtime / 10**9 < 2:
+                self.folder_mtime = folder_mtime
+                batch_file_mtimes = self.list_batch_files()
+                new_batch_file_names = sorted( name for name, mtime in batch_file_mtimes.items() if seen_batch_file_mtimes.get(name) != mtime )
+                # Deleted files are forgotten, so that the seen files do not grow without bound.
+                seen_batch_file_mtimes = batch_file_mtimes
+                if len(new_batch_file_names) > 0:
+                    yield from new_batch_file_names
+                    idle_since = time.monotonic()
+                    continue
+            idle_seconds = time.monotonic() - idle_since
+            if self.max_idle_seconds is not None and idle_seconds >= self.max_idle_seconds:
+                logger.info(f"Local folder has been idle for {int(idle_seconds)} seconds.")
+                return
+            yield WAITING_FOR_NEW_BATCHES
+            time.sleep(self.watch_interval_seconds)
+
+    def read_batch_file(self, batch_file_name):
+        with open(batch_file_name, "rb") as batch_file:
+            if not self.use_mmap:
+                return batch_file.read()
             try:
-                os.remove(self.cur_batch_file_name)
+                # The mapping stays valid after the file is closed, until it is garbage collected.
+                return mmap.mmap(batch_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return b"" # Empty files cannot be mapped.
+
+    def get_batch_handle(self):
+        return self.cur_batch_file_name
+
+    def mark_batch_as_complete(self, batch_handle=None):
+        batch_file_name = self.cur_batch_file_name if batch_handle is None else batch_handle
+        if self.manifest is not None and batch_file_name in self.batch_hashes:
+            self.manifest.record_completed_batch(os.path.basename(batch_file_name), self.batch_hashes.pop(batch_file_name))
+        if self.leases is not None and batch_file_name is not None:
+            self.leases.mark_batch_as_complete(os.path.basename(batch_file_name))
+        if self.delete_when_complete and batch_file_name is not None:
+            try:
+                os.remove(batch_file_name)
             except Exception as e:
                 logger.error(f"Failed to delete batch from local folder: {e}")
 
+    def close(self):
+        if self.manifest is not None:
+            logger.info(f"Skipped {self.num_skipped_batches} batches that were already complete.")
+            self.manifest.flush()
+        if self.leases is not None:
+            self.leases.close()
+
 class FileSystemBatchDestination(BatchDestinationBase):
-    """Writes batch files to a local file system folder."""
+    """
+    Writes batch files to a local file system folder.
 
-    def __init__(self, folder_name):
+    If a compression is specified, batches are compressed
+    and its file extension is appended to their file names.
+    """
+
+    def __init__(self, folder_name, compression=None):
         logger.info(f"Writing batches to local folder {folder_name}.")
         self.folder_name = folder_name
+        self.compression = compression
         if not os.path.exists(folder_name):
             os.mkdir(folder_name)
 
     def publish_batch_results(self, results, target_file_name):
-        target_file_name = os.path.join(self.folder_name, target_file_name)
         try:
-            with open(target_file_name, "w") as target_file:
+            results, target_file_name = self.compress_batch_results(results, target_file_name)
+            target_file_name = os.path.join(self.folder_name, target_file_name)
+            # Files are written under a hidden name and then renamed, so that a source
+            # watching this folder never reads a partially written batch.
+            partial_file_name = get_partial_file_name(target_file_name)
+            with open(partial_file_name, "wb" if isinstance(results, bytes) else "w") as target_file:
                 target_file.write(results)
+            os.replace(partial_file_name, target_file_name)
+            return True
         except Exception as e:
             logger.error(f"Failed to send batch to local folder: {e}")
+            return False
+
+    def open_batch_results_stream(self, target_file_name):
+        if self.compression is not None:
+            target_file_name = f"{target_file_name}.{self.compression.file_extension}"
+        return FileSystemBatchResultsStream(os.path.join(self.folder_name, target_file_name), self.compression)
+
+class FileSystemBatchResultsStream(CompressedBatchResultsStreamBase):
+    """
+    Appends batch results to a file in a local file system folder.
+    The file is written under a hidden name, and renamed once it is complete.
+    """
+
+    def __init__(self, file_name, compression=None):
+        super().__init__(compression)
+        self.file_name = file_name
+        self.partial_file_name = get_partial_file_name(file_name)
+        self.file = open(self.partial_file_name, "wb")
+
+    def write_bytes(self, data):
+        self.file.write(data)
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.partial_file_name, self.file_name)
+
+    def abort(self):
+        try:
+            self.file.close()
+            os.remove(self.partial_file_name)
+        except Exception as e:
+            logger.error(f"Failed to delete partial batch results from local folder: {e}")
+
+class FileSystemClaimCheckStore(ClaimCheckStoreBase):
+    """Stores oversized batch results in a local file system folder."""
+
+    def __init__(self, folder_name):
+        logger.info(f"Storing oversized batches in local folder {folder_name}.")
+        self.folder_name = os.path.abspath(folder_name)
+        if not os.path.exists(self.folder_name):
+            os.mkdir(self.folder_name)
+
+    def put(self, results, target_file_name=None):
+        file_name = os.path.join(self.folder_name, self.get_unique_file_name(target_file_name))
+        with open(file_name, "wb" if isinstance(results, bytes) else "w") as claim_check_file:
+            claim_check_file.write(results)
+        return "file://" + file_name
+
+class FileSystemCompletionManifest(CompletionManifestBase):
+    """Stores a CompletionManifest in a local file, which is appended to as batches are completed."""
+
+    def __init__(self, file_name):
+        logger.info(f"Using completion manifest {file_name}.")
+        self.file_name = file_name
+        super().__init__()
+        self.manifest_file = open(file_name, "a")
+
+    def load_lines(self):
+        if not os.path.exists(self.file_name):
+            return []
+        with open(self.file_name, "r") as manifest_file:
+            return manifest_file.readlines()
+
+    def write_line(self, line):
+        self.manifest_file.write(line)
+        self.manifest_file.flush()
+
+class FileSystemBatchLeases(BatchLeasesBase):
+    """
+    Claims batches in a local or shared file system folder with lock files.
+
+    Lock files are stored in a sibling folder with the suffix '.leases'. A lease is taken
+    by creating its lock file exclusively, which holds the ID of its consumer, and renewed by
+    updating its modification time. An expired lease is reclaimed by atomically renaming it
+    away before taking it again.
+    Completed batches are recorded with a '.done' file, which holds the modification time and
+    size the batch file had when it was claimed. A batch file that has changed since, such as
+    one written again by a later run, is no longer complete.
+    """
+
+    def __init__(self, folder_name, lease_seconds=300, retry_interval_seconds=None):
+        self.folder_name = folder_name
+        self.lease_folder_name = os.path.normpath(folder_name) + ".leases"
+        os.makedirs(self.lease_folder_name, exist_ok=True)
+        super().__init__(lease_seconds, retry_interval_seconds)
+
+    def get_lease_file_name(self, batch_name):
+        return os.path.join(self.lease_folder_name, batch_name + ".lease")
+
+    def get_done_file_name(self, batch_name):
+        return os.path.join(self.lease_folder_name, batch_name + ".done")
+
+    def get_content_id(self, batch_name):
+        """Identifies the content of a batch file by its modification time and size, or returns None if it does not exist."""
+        try:
+            batch_file_stat = os.stat(os.path.join(self.folder_name, batch_name))
+        except FileNotFoundError:
+            return None
+        return f"{batch_file_stat.st_mtime_ns}-{batch_file_stat.st_size}"
+
+    def is_complete(self, batch_name, content_id):
+        try:
+            with open(self.get_done_file_name(batch_name), "r") as done_file:
+                return done_file.read() == content_id
+        except FileNotFoundError:
+            return False
+
+    def try_claim(self, batch_name):
+        content_id = self.get_content_id(batch_name)
+        # Batch files that no longer exist were completed and deleted by another consumer.
+        if content_id is None or self.is_complete(batch_name, content_id):
+            return BATCH_COMPLETE
+        lease_file_name = self.get_lease_file_name(batch_name)
+        if not self.take_lease(lease_file_name):
+            return self.try_reclaim(batch_name, content_id)
+        # The batch may have been completed between checking for its done file and taking its lease.
+        if self.is_complete(batch_name, content_id):
+            os.remove(lease_file_name)
+            return BATCH_COMPLETE
+        with self.held_leases_lock:
+            self.held_leases[batch_name] = content_id
+        return BATCH_CLAIMED
+
+    def try_reclaim(self, batch_name, content_id):
+        lease_file_name = self.get_lease_file_name(batch_name)
+        try:
+            if not self.is_expired(lease_file_name):
+                return BATCH_HELD_BY_OTHER_CONSUMER
+            # Only one consumer can rename the lease file, but another consumer may have already
+            # reclaimed it since it was checked, so the renamed file is checked again.
+            expired_lease_file_name = f"{lease_file_name}.expired-{self.consumer_id}"
+            os.rename(lease_file_name, expired_lease_file_name)
+        except FileNotFoundError:
+            return BATCH_HELD_BY_OTHER_CONSUMER
+        if not self.is_expired(expired_lease_file_name):
+            self.restore_lease(lease_file_name, expired_lease_file_name)
+            return BATCH_HELD_BY_OTHER_CONSUMER
+        os.remove(expired_lease_file_name)
+        logger.info(f"Reclaiming expired lease on batch {batch_name}.")
+        if not self.take_lease(lease_file_name):
+            return BATCH_HELD_BY_OTHER_CONSUMER
+        with self.held_leases_lock:
+            self.held_leases[batch_name] = content_id
+        return BATCH_CLAIMED
+
+    def is_expired(self, lease_file_name):
+        return time.time() - os.path.getmtime(lease_file_name) >= self.lease_seconds
+
+    def restore_lease(self, lease_file_name, renamed_lease_file_name):
+        """Moves a renamed lease back, unless a new lease was taken in the meantime."""
+        try:
+            # Unlike renaming, linking fails instead of replacing an existing lease.
+            os.link(renamed_lease_file_name, lease_file_name)
+        except FileExistsError:
+            pass
+        os.remove(renamed_lease_file_name)
+
+    def take_lease(self, lease_file_name):
+        """Creates a lock file, and returns False if it already exists."""
+        try:
+            lease_file = os.open(lease_file_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(lease_file, self.consumer_id.encode("utf-8"))
+        os.close(lease_file)
+        return True
+
+    def assert_lease_is_held(self, batch_name):
+        """Raises an exception if the lease on a batch was reclaimed by another consumer."""
+        with open(self.get_lease_file_name(batch_name), "r") as lease_file:
+            owner_id = lease_file.read()
+        if owner_id != self.consumer_id:
+            raise RuntimeError(f"Lease on batch {batch_name} is held by consumer {owner_id}.")
+
+    def renew(self, batch_name):
+        self.assert_lease_is_held(batch_name)
+        os.utime(self.get_lease_file_name(batch_name))
+
+    def complete(self, batch_name):
+        with self.held_leases_lock:
+            content_id = self.held_leases.get(batch_name)
+        # Changes made to the batch file after it was claimed are not marked as complete.
+        content_id = content_id if content_id is not None else self.get_content_id(batch_name)
+        with open(self.get_done_file_name(batch_name), "w") as done_file:
+            done_file.write(content_id if content_id is not None else "")
+        self.release(batch_name)
+
+    def release(self, batch_name):
+        self.assert_lease_is_held(batch_name)
+        os.remove(self.get_lease_file_name(batch_name))
+
+def get_partial_file_name(file_name):
+    folder_name, base_name = os.path.split(file_name)
+    return os.path.join(folder_name, f".{base_name}.partial")
@@ -0,0 +1,114 @@
+import struct
+import sys
+import threading
+from .client import logger, BatchSourceBase, BatchDestinationBase
+
+# Each batch is framed by the lengths of its file name and content, followed by both.
+FRAME_HEADER = struct.Struct(">IQ")
+
+STANDARD_STREAM_NAME = "-"
+
+class PipeBatchSource(BatchSourceBase):
+    """
+    Reads length-delimited batches from standard input, or from a named pipe (FIFO) or file.
+
+    This allows stages to be chained in a single shell pipeline, with each stage reading
+    the batches published by a PipeBatchDestination in the previous one. Batches are read
+    until the writer closes the pipe. Since a pipe cannot redeliver batches, marking
+    a batch as complete has no effect.
+    """
+
+    def __init__(self, pipe_name=STANDARD_STREAM_NAME):
+        if pipe_name == STANDARD_STREAM_NAME:
+            logger.info("Reading batches from standard input.")
+            self.pipe = sys.stdin.buffer
+        else:
+            logger.info(f"Reading batches from pipe {pipe_name}.")
+            self.pipe = open(pipe_name, "rb")
+        self.pipe_name = pipe_name
+        self.num_batches = 0
+        self.cur_batch_file_name = None
+
+    def get_next_batch(self):
+        try:
+            header = self.read_exactly(FRAME_HEADER.size)
+            if header is None:
+                self.cur_batch_file_name = None
+                raise StopIteration()
+            file_name_length, content_length = FRAME_HEADER.unpack(header)
+            file_name = self.read_exactly(file_name_length)
+            batch = self.read_exactly(content_length)
+            if file_name is None or batch is None:
+                raise EOFError("Pipe was closed in the middle of a batch.")
+            self.num_batches += 1
+            self.cur_batch_file_name = file_name.decode("utf-8")
+            return self.decompress_batch(batch, self.cur_batch_file_name)
+        except StopIteration as e:
+            raise e
+        except EOFError as e:
+            logger.error(f"Failed to receive batch from pipe: {e}")
+            raise StopIteration()
+        except Exception as e:
+            logger.error(f"Failed to receive batch from pipe: {e}")
+
+    def read_exactly(self, num_bytes):
+        """Reads num_bytes from the pipe, and returns None if it is closed first."""
+        data = bytearray()
+        while len(data) < num_bytes:
+            chunk = self.pipe.read(num_bytes - len(data))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+    def get_batch_handle(self):
+        return self.cur_batch_file_name
+
+    def mark_batch_as_complete(self, batch_handle=None):
+        pass
+
+    def close(self):
+        logger.info(f"Read {self.num_batches} batches from pipe.")
+        if self.pipe_name != STANDARD_STREAM_NAME:
+            self.pipe.close()
+
+class PipeBatchDestination(BatchDestinationBase):
+    """
+    Writes length-delimited batches to standard output, or to a named pipe (FIFO) or file.
+
+    Log messages are written to standard error, so standard output only contains batches.
+    If a compression is specified, batches are compressed and its file extension
+    is appended to their file names, so that a PipeBatchSource can decompress them.
+    """
+
+    def __init__(self, pipe_name=STANDARD_STREAM_NAME, compression=None):
+        if pipe_name == STANDARD_STREAM_NAME:
+            logger.info("Writing batches to standard output.")
+            self.pipe = sys.stdout.buffer
+        else:
+            logger.info(f"Writing batches to pipe {pipe_name}.")
+            self.pipe = open(pipe_name, "wb")
+        self.pipe_name = pipe_name
+        self.compression = compression
+        self.pipe_lock = threading.Lock()
+
+    def publish_batch_results(self, results, target_file_name):
+        try:
+            results, target_file_name = self.compress_batch_results(results, target_file_name)
+            if isinstance(results, str):
+                results = results.encode("utf-8")
+            file_name = target_file_name.encode("utf-8")
+            # Batches may be published from several threads, so frames are written whole.
+            with self.pipe_lock:
+                self.pipe.write(FRAME_HEADER.pack(len(file_name), len(results)))
+                self.pipe.write(file_name)
+                self.pipe.write(results)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to send batch to pipe: {e}")
+            return False
+
+    def flush(self):
+        with self.pipe_lock:
+            self.pipe.flush()
+        return 0
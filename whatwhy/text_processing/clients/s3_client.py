@@ -1,11 +1,22 @@
+import json
+import threading
+import time
 import boto3
-from .client import logger, BatchSourceBase, BatchDestinationBase
+from botocore.exceptions import ClientError
+from botocore.config import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .client import ( logger, BatchSourceBase, BatchDestinationBase, ClaimCheckStoreBase, CompressedBatchResultsStreamBase, CompletionManifestBase,
+                      BatchLeasesBase, BATCH_CLAIMED, BATCH_HELD_BY_OTHER_CONSUMER, BATCH_COMPLETE, WAITING_FOR_OTHER_CONSUMERS )
+
+MULTIPART_UPLOAD_PART_SIZE = 8 * 1024 * 1024 # S3 requires every part except the last to be at least 5 MiB.
 
 class S3ClientBase():
 
-    def __init__(self, bucket_name, folder_name):
+    def __init__(self, bucket_name, folder_name, max_pool_connections=10):
         logger.info(f"Connecting to S3 bucket/folder '{bucket_name}/{folder_name}'.")
-        self.s3 = boto3.client("s3")
+        config = Config(max_pool_connections=max_pool_connections, retries={"mode" : "adaptive"})
+        self.s3 = boto3.client("s3", config=config)
         self.bucket_name = bucket_name
         self.folder_name = folder_name + "/"
 
@@ -17,40 +28,124 @@ class S3BatchSource(S3ClientBase, BatchSourceBase):
     such as environment variables or a credentials file. For more information, see:
     https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
 
-    Each instance of this class should only have ONE consumer.
+    Each bucket/folder should only have ONE consumer, unless lease_seconds is specified.
+    In that case, any number of consumers can share the bucket/folder, each claiming
+    the next unclaimed batch with a lease (see S3BatchLeases).
     
     This class iterates through all the files available in the bucket/folder
     at the time of instantiation, and optionally deletes them as they are processed.
+
+    While a batch is being processed, the next num_prefetched_batches batches are
+    downloaded in the background. Completed batches are deleted in groups of
+    delete_batch_size, so a crash may leave up to that many processed batches behind.
+
+    If a CompletionManifest is specified, completed batches are recorded in it with their
+    ETag (the MD5 hash of their content, unless they were uploaded in multiple parts).
+    Batches it records as complete are skipped without being downloaded.
     """
 
-    def __init__(self, bucket_name, folder_name, delete_when_complete=False):
-        super().__init__(bucket_name, folder_name)
+    def __init__(self, bucket_name, folder_name, delete_when_complete=False, num_prefetched_batches=4, delete_batch_size=100, manifest=None, lease_seconds=None):
+        super().__init__(bucket_name, folder_name, max_pool_connections=max(num_prefetched_batches, 10))
         self.delete_when_complete = delete_when_complete
-        bucket_objects = self.s3.list_objects(Bucket=self.bucket_name, Prefix=self.folder_name)["Contents"]
-        batch_keys = [ bucket_object["Key"] for bucket_object in bucket_objects if bucket_object["Key"] != self.folder_name ]
+        self.manifest = manifest
+        self.batch_etags = {}
+        batch_keys = self.get_batch_keys()
+        if manifest is not None:
+            num_batch_keys = len(batch_keys)
+            batch_keys = [ batch_key for batch_key in batch_keys if not manifest.is_complete(batch_key, self.batch_etags[batch_key]) ]
+            logger.info(f"Skipping {num_batch_keys - len(batch_keys)} batches that were already complete.")
         batch_keys.sort()
-        self.batch_iterator = iter(batch_keys)
+        self.leases = S3BatchLeases(self.s3, bucket_name, self.folder_name, lease_seconds, batch_etags=self.batch_etags) if lease_seconds is not None else None
+        if self.leases is not None:
+            self.batch_iterator = self.leases.claim_batches(batch_keys)
+        else:
+            self.batch_iterator = iter(batch_keys)
         self.cur_batch_key = None
+        self.num_prefetched_batches = max(num_prefetched_batches, 1)
+        self.prefetched_batches = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.num_prefetched_batches)
+        self.delete_batch_size = min(max(delete_batch_size, 1), 1000) # delete_objects accepts at most 1000 keys.
+        self.completed_batch_keys = []
+        self.completed_batch_keys_lock = threading.Lock()
+
+    def get_batch_keys(self):
+        paginator = self.s3.get_paginator("list_objects_v2")
+        batch_keys = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.folder_name):
+            for bucket_object in page.get("Contents", []):
+                if bucket_object["Key"] != self.folder_name:
+                    batch_keys.append(bucket_object["Key"])
+                    self.batch_etags[bucket_object["Key"]] = bucket_object.get("ETag")
+        return batch_keys
 
     def get_next_batch(self):
-        try:
-            self.cur_batch_key = self.batch_iterator.__next__()
-            obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.cur_batch_key)
-            return obj["Body"].read().decode("utf-8")
-        except StopIteration as e:
+        self.prefetch_batches()
+        if len(self.prefetched_batches) == 0:
             self.cur_batch_key = None
-            raise e
+            raise StopIteration()
+        self.cur_batch_key, batch_future = self.prefetched_batches.popleft()
+        self.prefetch_batches(wait_for_other_consumers=False)
+        try:
+            return batch_future.result()
         except Exception as e:
             logger.error(f"Failed to receive batch from S3: {e}")
             return None
 
-    def mark_batch_as_complete(self):
-        if self.delete_when_complete and self.cur_batch_key is not None:
-            try:
-                self.s3.delete_object(Bucket=self.bucket_name, Key=self.cur_batch_key)
-            except Exception as e:
-                logger.error(f"Failed to delete batch from S3: {e}")
-                self.cur_batch_key = None
+    def prefetch_batches(self, wait_for_other_consumers=True):
+        while len(self.prefetched_batches) < self.num_prefetched_batches:
+            batch_key = next(self.batch_iterator, None)
+            if batch_key is None:
+                return
+            if batch_key is WAITING_FOR_OTHER_CONSUMERS:
+                # Only wait for batches held by other consumers once there is nothing else to process.
+                if not wait_for_other_consumers or len(self.prefetched_batches) > 0:
+                    return
+                self.leases.wait_for_retry()
+                continue
+            batch_future = self.executor.submit(self.download_batch, batch_key)
+            self.prefetched_batches.append( (batch_key, batch_future) )
+
+    def download_batch(self, batch_key):
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=batch_key)
+        return self.decompress_batch(obj["Body"].read(), batch_key)
+
+    def get_batch_handle(self):
+        return self.cur_batch_key
+
+    def mark_batch_as_complete(self, batch_handle=None):
+        batch_key = self.cur_batch_key if batch_handle is None else batch_handle
+        if self.manifest is not None and batch_key is not None:
+            self.manifest.record_completed_batch(batch_key, self.batch_etags.get(batch_key))
+        if self.leases is not None and batch_key is not None:
+            self.leases.mark_batch_as_complete(batch_key)
+        if self.delete_when_complete and batch_key is not None:
+            with self.completed_batch_keys_lock:
+                self.completed_batch_keys.append(batch_key)
+                should_delete = len(self.completed_batch_keys) >= self.delete_batch_size
+            if should_delete:
+                self.delete_completed_batches()
+
+    def close(self):
+        self.delete_completed_batches()
+        self.executor.shutdown(wait=False)
+        if self.manifest is not None:
+            self.manifest.flush()
+        if self.leases is not None:
+            self.leases.close()
+
+    def delete_completed_batches(self):
+        with self.completed_batch_keys_lock:
+            batch_keys = self.completed_batch_keys
+            self.completed_batch_keys = []
+        if len(batch_keys) == 0:
+            return
+        try:
+            objects_to_delete = [ {"Key" : batch_key} for batch_key in batch_keys ]
+            response = self.s3.delete_objects(Bucket=self.bucket_name, Delete={"Objects" : objects_to_delete, "Quiet" : True})
+            for error in response.get("Errors", []):
+                logger.error(f"Failed to delete batch {error.get('Key')} from S3: {error.get('Message')}")
+        except Exception as e:
+            logger.error(f"Failed to delete batches from S3: {e}")
 
 class S3BatchDestination(S3ClientBase, BatchDestinationBase):
     """
@@ -59,17 +154,279 @@ class S3BatchDestination(S3ClientBase, BatchDestinationBase):
     AWS credentials should be stored in a format compatible with boto3,
     such as environment variables or a credentials file. For more information, see:
     https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
+
+    If a compression is specified, batches are compressed
+    and its file extension is appended to their keys.
     """
 
-    def __init__(self, bucket_name, folder_name):
-        super().__init__(bucket_name, folder_name)
+    def __init__(self, bucket_name, folder_name, compression=None, max_pool_connections=10):
+        super().__init__(bucket_name, folder_name, max_pool_connections)
+        self.compression = compression
 
     def publish_batch_results(self, results, target_file_name=None):
         try:
             if target_file_name is None:
                 raise Exception("No filename specified.")
+            results, target_file_name = self.compress_batch_results(results, target_file_name)
             target_file_name = self.folder_name + target_file_name
             self.s3.put_object(Bucket=self.bucket_name, Key=target_file_name, Body=results)
+            return True
         except Exception as e:
             logger.error(f"Failed to send batch to S3: {e}")
             self.cur_batch_key = None
+            return False
+
+    def open_batch_results_stream(self, target_file_name):
+        if self.compression is not None:
+            target_file_name = f"{target_file_name}.{self.compression.file_extension}"
+        return S3BatchResultsStream(self.s3, self.bucket_name, self.folder_name + target_file_name, self.compression)
+
+class S3BatchResultsStream(CompressedBatchResultsStreamBase):
+    """
+    Uploads batch results to AWS S3 with a multipart upload, so that
+    only one part of at most MULTIPART_UPLOAD_PART_SIZE bytes is held in memory.
+    Results smaller than one part are uploaded with a single put_object request instead.
+    """
+
+    def __init__(self, s3, bucket_name, key, compression=None, part_size=MULTIPART_UPLOAD_PART_SIZE):
+        super().__init__(compression)
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def write_bytes(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part( Bucket=self.bucket_name,
+                                        Key=self.key,
+                                        UploadId=self.upload_id,
+                                        PartNumber=part_number,
+                                        Body=bytes(self.buffer) )
+        self.parts.append({ "ETag" : response["ETag"], "PartNumber" : part_number })
+        self.buffer = bytearray()
+
+    def finish(self):
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer))
+            self.buffer = bytearray()
+            return
+        if len(self.buffer) > 0:
+            self.upload_part()
+        self.s3.complete_multipart_upload( Bucket=self.bucket_name,
+                                           Key=self.key,
+                                           UploadId=self.upload_id,
+                                           MultipartUpload={ "Parts" : self.parts } )
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.error(f"Failed to abort multipart upload to S3: {e}")
+
+class S3ClaimCheckStore(S3ClientBase, ClaimCheckStoreBase):
+    """
+    Stores oversized batch results in AWS S3.
+
+    AWS credentials should be stored in a format compatible with boto3,
+    such as environment variables or a credentials file. For more information, see:
+    https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
+    """
+
+    def __init__(self, bucket_name, folder_name):
+        super().__init__(bucket_name, folder_name)
+
+    def put(self, results, target_file_name=None):
+        key = self.folder_name + self.get_unique_file_name(target_file_name)
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=results)
+        return f"s3://{self.bucket_name}/{key}"
+
+class S3CompletionManifest(CompletionManifestBase):
+    """
+    Stores a CompletionManifest as an object in AWS S3.
+
+    S3 objects cannot be appended to, so the whole manifest is uploaded again
+    after every flush_interval completed batches, and when flush() is called.
+    """
+
+    def __init__(self, bucket_name, key, flush_interval=100):
+        logger.info(f"Using completion manifest s3://{bucket_name}/{key}.")
+        self.s3 = boto3.client("s3", config=Config(retries={"mode" : "adaptive"}))
+        self.bucket_name = bucket_name
+        self.key = key
+        self.flush_interval = max(flush_interval, 1)
+        self.lines = []
+        self.num_unflushed_lines = 0
+        self.flush_lock = threading.Lock()
+        super().__init__()
+
+    def load_lines(self):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if get_error_code(e) in ("NoSuchKey", "404"):
+                return []
+            raise e
+        self.lines = obj["Body"].read().decode("utf-8").splitlines(keepends=True)
+        return self.lines
+
+    def record_completed_batch(self, batch_key, content_hash):
+        super().record_completed_batch(batch_key, content_hash)
+        if self.num_unflushed_lines >= self.flush_interval:
+            self.flush()
+
+    def write_line(self, line):
+        self.lines.append(line)
+        self.num_unflushed_lines += 1
+
+    def flush(self):
+        with self.flush_lock:
+            with self.completed_batches_lock:
+                manifest_content = "".join(self.lines)
+                self.num_unflushed_lines = 0
+            try:
+                self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=manifest_content.encode("utf-8"))
+            except Exception as e:
+                logger.error(f"Failed to write completion manifest to S3: {e}")
+
+class S3BatchLeases(BatchLeasesBase):
+    """
+    Claims batches in an AWS S3 bucket/folder with lease objects.
+
+    Lease objects are stored under a sibling prefix with the suffix '.leases/', with one prefix
+    per batch. Each consumer writes its own lease object under the prefix of a batch, named
+    by its consumer ID and recording when the lease expires. After writing its lease, a consumer
+    lists the prefix again, and gives up the lease if another consumer holds an unexpired one,
+    so two consumers that claim a batch at the same time may both give it up until it is retried,
+    but never both hold it. Completed batches are marked with an object under their prefix named by
+    the ETag of the batch, so a batch that is written again, such as by a later run, is no longer complete.
+    This only relies on the strong read-after-write consistency of S3, rather than on conditional writes.
+    Lease expiry times are compared with the local clock, so the clocks of consumers should be synchronized.
+    """
+
+    COMPLETE_OBJECT_PREFIX = "complete-"
+
+    def __init__(self, s3, bucket_name, folder_name, lease_seconds=300, retry_interval_seconds=None, batch_etags=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.folder_name = folder_name
+        self.batch_etags = batch_etags if batch_etags is not None else {}
+        self.lease_folder_name = folder_name.rstrip("/") + ".leases/"
+        super().__init__(lease_seconds, retry_interval_seconds)
+
+    def get_lease_prefix(self, batch_key):
+        return self.lease_folder_name + batch_key[len(self.folder_name):] + "/"
+
+    def get_lease_key(self, batch_key):
+        return self.get_lease_prefix(batch_key) + self.consumer_id
+
+    def get_complete_key(self, batch_key, etag):
+        return self.get_lease_prefix(batch_key) + self.COMPLETE_OBJECT_PREFIX + etag.strip('"')
+
+    def get_batch_etag(self, batch_key):
+        """Returns the ETag of a batch, as listed by the source if possible, or None if the batch does not exist."""
+        if batch_key in self.batch_etags:
+            return self.batch_etags[batch_key]
+        try:
+            return self.s3.head_object(Bucket=self.bucket_name, Key=batch_key)["ETag"]
+        except ClientError as e:
+            if get_error_code(e) in ("NoSuchKey", "404"):
+                return None
+            raise e
+
+    def try_claim(self, batch_key):
+        # Batches that no longer exist were completed and deleted by another consumer.
+        etag = self.get_batch_etag(batch_key)
+        if etag is None:
+            return BATCH_COMPLETE
+        is_complete, other_lease_keys = self.get_other_leases(batch_key, etag)
+        if is_complete:
+            return BATCH_COMPLETE
+        if len(other_lease_keys) > 0:
+            return BATCH_HELD_BY_OTHER_CONSUMER
+        expires = self.write_lease(batch_key)
+        # Another consumer may have written its lease at the same time, in which case both give it up.
+        is_complete, other_lease_keys = self.get_other_leases(batch_key, etag)
+        if is_complete or len(other_lease_keys) > 0:
+            self.release(batch_key)
+            return BATCH_COMPLETE if is_complete else BATCH_HELD_BY_OTHER_CONSUMER
+        with self.held_leases_lock:
+            self.held_leases[batch_key] = expires
+        return BATCH_CLAIMED
+
+    def get_other_leases(self, batch_key, etag):
+        """
+        Returns whether a batch with the given ETag is complete, and the keys of the unexpired
+        leases that other consumers hold on it. Expired leases of other consumers, such as
+        those of a consumer that died, are deleted.
+        """
+        lease_prefix = self.get_lease_prefix(batch_key)
+        response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=lease_prefix)
+        lease_keys = [ bucket_object["Key"] for bucket_object in response.get("Contents", []) ]
+        if self.get_complete_key(batch_key, etag) in lease_keys:
+            return True, []
+        other_lease_keys = []
+        for lease_key in lease_keys:
+            # Objects marking earlier content of the batch as complete are ignored.
+            if lease_key == self.get_lease_key(batch_key) or lease_key[len(lease_prefix):].startswith(self.COMPLETE_OBJECT_PREFIX):
+                continue
+            try:
+                obj = self.s3.get_object(Bucket=self.bucket_name, Key=lease_key)
+                lease = json.loads(obj["Body"].read())
+            except ClientError as e:
+                if get_error_code(e) in ("NoSuchKey", "404"):
+                    continue
+                raise e
+            if lease.get("expires", 0) > time.time():
+                other_lease_keys.append(lease_key)
+            else:
+                logger.info(f"Reclaiming expired lease on batch {batch_key}.")
+                self.s3.delete_object(Bucket=self.bucket_name, Key=lease_key)
+        return False, other_lease_keys
+
+    def write_lease(self, batch_key):
+        expires = self.get_lease_expiry_time()
+        lease = { "consumer" : self.consumer_id, "expires" : expires }
+        self.s3.put_object(Bucket=self.bucket_name, Key=self.get_lease_key(batch_key), Body=json.dumps(lease).encode("utf-8"))
+        return expires
+
+    def assert_lease_is_held(self, batch_key):
+        with self.held_leases_lock:
+            expires = self.held_leases.get(batch_key)
+        # Once a lease has expired, another consumer may have reclaimed it.
+        if expires is None or expires <= time.time():
+            raise Exception("Lease is not held by this consumer.")
+
+    def renew(self, batch_key):
+        self.assert_lease_is_held(batch_key)
+        expires = self.write_lease(batch_key)
+        with self.held_leases_lock:
+            if batch_key in self.held_leases:
+                self.held_leases[batch_key] = expires
+
+    def complete(self, batch_key):
+        self.assert_lease_is_held(batch_key)
+        etag = self.get_batch_etag(batch_key)
+        if etag is not None:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.get_complete_key(batch_key, etag), Body=b"")
+        self.release(batch_key)
+
+    def release(self, batch_key):
+        # Only this consumer writes its own lease object, so deleting it cannot affect other consumers.
+        self.s3.delete_object(Bucket=self.bucket_name, Key=self.get_lease_key(batch_key))
+
+def get_error_code(client_error):
+    return client_error.response.get("Error", {}).get("Code")
@@ -0,0 +1,222 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from whatwhy.text_processing.batch_formats import CSVBatchFormat
+from .client import ( logger, BatchSourceBase, BatchDestinationBase, BatchLeasesBase,
+                      BATCH_CLAIMED, BATCH_HELD_BY_OTHER_CONSUMER, BATCH_COMPLETE, WAITING_FOR_OTHER_CONSUMERS )
+
+BATCH_PENDING_STATE = 0
+BATCH_CLAIMED_STATE = 1
+BATCH_COMPLETE_STATE = 2
+
+DEFAULT_LEASE_SECONDS = 300
+
+class SQLiteClientBase():
+    """
+    Stores batches in the table 'batches' of a SQLite database file, along with their
+    state (pending, claimed or complete) and the lease of the consumer that claimed them.
+    The IDs of the rows in each batch can be stored in the table 'batch_ids',
+    which is indexed by ID.
+
+    The database is used in WAL mode, so batches can be read while others are written.
+    One connection is shared by all threads of a client, and used while holding connection_lock.
+    """
+
+    def __init__(self, db_file_name):
+        logger.info(f"Connecting to SQLite database {db_file_name}.")
+        self.db_file_name = db_file_name
+        # Statements are committed as they are executed, unless a transaction is explicitly started.
+        self.connection = sqlite3.connect(db_file_name, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection_lock = threading.Lock()
+        with self.connection_lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute( "CREATE TABLE IF NOT EXISTS batches ( "
+                                     "name TEXT PRIMARY KEY, "
+                                     "content BLOB NOT NULL, "
+                                     "state INTEGER NOT NULL DEFAULT 0, "
+                                     "consumer TEXT, "
+                                     "lease_expiry_time REAL, "
+                                     "completed_time REAL )" )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS batches_state ON batches (state, name)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS batch_ids ( id TEXT NOT NULL, batch_name TEXT NOT NULL )")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS batch_ids_id ON batch_ids (id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS batch_ids_batch_name ON batch_ids (batch_name)")
+
+    def execute(self, sql, parameters=()):
+        """Executes a single statement, and returns the number of rows it changed and any rows it selected."""
+        with self.connection_lock:
+            cursor = self.connection.execute(sql, parameters)
+            return cursor.rowcount, cursor.fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """Returns a context in which statements executed on the connection are committed together."""
+        with self.connection_lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+                self.connection.execute("COMMIT")
+            except Exception as e:
+                self.connection.execute("ROLLBACK")
+                raise e
+
+    def close_connection(self):
+        with self.connection_lock:
+            self.connection.close()
+
+class SQLiteBatchSource(SQLiteClientBase, BatchSourceBase):
+    """
+    Retrieves batches from a SQLite database written by a SQLiteBatchDestination.
+
+    Any number of consumers can share the database. Each batch is claimed with a lease
+    of lease_seconds (300 by default), which is renewed while the batch is processed.
+    Claims, renewals and acknowledgements are single transactional updates of the batch,
+    and completed batches are marked as complete in the database, or optionally deleted.
+    So an interrupted run can be resumed, and batches that are published again are
+    processed again.
+
+    This class iterates through all the batches that are not complete
+    at the time of instantiation.
+    """
+
+    def __init__(self, db_file_name, delete_when_complete=False, lease_seconds=None):
+        super().__init__(db_file_name)
+        self.delete_when_complete = delete_when_complete
+        self.leases = SQLiteBatchLeases(self, lease_seconds if lease_seconds is not None else DEFAULT_LEASE_SECONDS, delete_when_complete)
+        _, rows = self.execute("SELECT name FROM batches WHERE state != ? ORDER BY name", (BATCH_COMPLETE_STATE,))
+        self.batch_names = self.leases.claim_batches([ row[0] for row in rows ])
+        self.cur_batch_name = None
+
+    def get_next_batch(self):
+        try:
+            while True:
+                batch_name = self.batch_names.__next__()
+                if batch_name is WAITING_FOR_OTHER_CONSUMERS:
+                    self.leases.wait_for_retry()
+                    continue
+                self.cur_batch_name = batch_name
+                batch = self.get_batch(batch_name)
+                if batch is not None:
+                    return batch
+                # The batch was deleted after it was listed.
+                self.leases.mark_batch_as_complete(batch_name)
+        except StopIteration as e:
+            self.cur_batch_name = None
+            raise e
+        except Exception as e:
+            logger.error(f"Failed to receive batch from SQLite database: {e}")
+
+    def get_batch(self, batch_name):
+        """Returns the content of a batch, or None if it does not exist."""
+        _, rows = self.execute("SELECT content FROM batches WHERE name = ?", (batch_name,))
+        if len(rows) == 0:
+            return None
+        return self.decompress_batch(rows[0][0], batch_name)
+
+    def get_batch_names_for_id(self, row_id):
+        """Returns the names of the batches containing the row with an ID, if IDs were stored."""
+        _, rows = self.execute("SELECT batch_name FROM batch_ids WHERE id = ? ORDER BY batch_name", (str(row_id),))
+        return [ row[0] for row in rows ]
+
+    def get_batch_handle(self):
+        return self.cur_batch_name
+
+    def mark_batch_as_complete(self, batch_handle=None):
+        batch_name = self.cur_batch_name if batch_handle is None else batch_handle
+        if batch_name is not None:
+            self.leases.mark_batch_as_complete(batch_name)
+
+    def close(self):
+        self.leases.close()
+        self.close_connection()
+
+class SQLiteBatchDestination(SQLiteClientBase, BatchDestinationBase):
+    """
+    Writes batches to a SQLite database, replacing any batch with the same name.
+
+    If id_col_name is specified, each batch is parsed with batch_format (CSV by default),
+    and the IDs of its rows are stored in an index, so that the batches containing a row can
+    be found with SQLiteBatchSource.get_batch_names_for_id(). If a compression is specified,
+    batches are compressed and its file extension is appended to their names.
+    """
+
+    def __init__(self, db_file_name, compression=None, batch_format=None, id_col_name=None):
+        super().__init__(db_file_name)
+        self.compression = compression
+        self.batch_format = batch_format if batch_format is not None else CSVBatchFormat()
+        self.id_col_name = id_col_name
+
+    def publish_batch_results(self, results, target_file_name):
+        try:
+            row_ids = self.get_row_ids(results)
+            results, target_file_name = self.compress_batch_results(results, target_file_name)
+            if isinstance(results, str):
+                results = results.encode("utf-8")
+            with self.transaction() as connection:
+                connection.execute( "INSERT OR REPLACE INTO batches (name, content, state) VALUES (?, ?, ?)",
+                                    (target_file_name, results, BATCH_PENDING_STATE) )
+                connection.execute("DELETE FROM batch_ids WHERE batch_name = ?", (target_file_name,))
+                connection.executemany( "INSERT INTO batch_ids (id, batch_name) VALUES (?, ?)",
+                                        [ (row_id, target_file_name) for row_id in row_ids ] )
+            return True
+        except Exception as e:
+            logger.error(f"Failed to send batch to SQLite database: {e}")
+            return False
+
+    def get_row_ids(self, results):
+        if self.id_col_name is None:
+            return []
+        df = self.batch_format.get_df_from_batch(results)
+        if self.id_col_name not in df.columns:
+            return []
+        return [ str(row_id) for row_id in df[self.id_col_name] ]
+
+class SQLiteBatchLeases(BatchLeasesBase):
+    """
+    Claims batches in a SQLite database by updating their state.
+
+    A batch is claimed by updating it only if it is pending, or its lease has expired,
+    so only one consumer can claim it. Lease expiry times are compared with the local clock.
+    """
+
+    def __init__(self, client, lease_seconds=DEFAULT_LEASE_SECONDS, delete_when_complete=False, retry_interval_seconds=None):
+        self.client = client
+        self.delete_when_complete = delete_when_complete
+        super().__init__(lease_seconds, retry_interval_seconds)
+
+    def try_claim(self, batch_name):
+        num_claimed, _ = self.client.execute( "UPDATE batches SET state = ?, consumer = ?, lease_expiry_time = ? "
+                                              "WHERE name = ? AND (state = ? OR (state = ? AND lease_expiry_time < ?))",
+                                              (BATCH_CLAIMED_STATE, self.consumer_id, self.get_lease_expiry_time(),
+                                               batch_name, BATCH_PENDING_STATE, BATCH_CLAIMED_STATE, time.time()) )
+        if num_claimed == 0:
+            _, rows = self.client.execute("SELECT state FROM batches WHERE name = ?", (batch_name,))
+            if len(rows) == 0 or rows[0][0] == BATCH_COMPLETE_STATE:
+                return BATCH_COMPLETE
+            return BATCH_HELD_BY_OTHER_CONSUMER
+        with self.held_leases_lock:
+            self.held_leases[batch_name] = self.consumer_id
+        return BATCH_CLAIMED
+
+    def renew(self, batch_name):
+        num_renewed, _ = self.client.execute( "UPDATE batches SET lease_expiry_time = ? WHERE name = ? AND state = ? AND consumer = ?",
+                                              (self.get_lease_expiry_time(), batch_name, BATCH_CLAIMED_STATE, self.consumer_id) )
+        if num_renewed == 0:
+            raise Exception("Lease is not held by this consumer.")
+
+    def complete(self, batch_name):
+        # Batches that were published again after they were claimed are left to be processed again.
+        if not self.delete_when_complete:
+            self.client.execute( "UPDATE batches SET state = ?, consumer = NULL, lease_expiry_time = NULL, completed_time = ? "
+                                 "WHERE name = ? AND consumer = ?",
+                                 (BATCH_COMPLETE_STATE, time.time(), batch_name, self.consumer_id) )
+            return
+        with self.client.transaction() as connection:
+            if connection.execute("DELETE FROM batches WHERE name = ? AND consumer = ?", (batch_name, self.consumer_id)).rowcount > 0:
+                connection.execute("DELETE FROM batch_ids WHERE batch_name = ?", (batch_name,))
+
+    def release(self, batch_name):
+        self.client.execute( "UPDATE batches SET state = ?, consumer = NULL, lease_expiry_time = NULL WHERE name = ? AND consumer = ?",
+                             (BATCH_PENDING_STATE, batch_name, self.consumer_id) )
@@ -1,11 +1,30 @@
+import os
+import re
+import base64
+import signal
+import threading
+import time
+from collections import deque
 import boto3
+from botocore.config import Config
 from .client import logger, BatchSourceBase, BatchDestinationBase
+from .compression import get_compression
+
+MAX_MESSAGE_SIZE = 262144 # SQS limit in bytes, for both single messages and batches of messages.
+MAX_BATCH_ENTRIES = 10 # SQS allows at most 10 messages per request.
+CLAIM_CHECK_ATTRIBUTE_NAME = "WhatWhyClaimCheck"
+ENCODING_ATTRIBUTE_NAME = "WhatWhyEncoding"
+COMPRESSION_ATTRIBUTE_NAME = "WhatWhyCompression"
+BINARY_FILE_EXTENSIONS = ("arrow", "parquet")
+# Characters that SQS does not allow in message bodies.
+INVALID_MESSAGE_BODY_CHARACTERS = re.compile("[^\t\n\r\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
 
 class SQSClientBase():
 
-    def __init__(self, queue_name, region_name="us-east-1"):
+    def __init__(self, queue_name, region_name="us-east-1", max_pool_connections=10):
         logger.info(f"Connecting to SQS queue with name '{queue_name}' in region '{region_name}'.")
-        self.sqs = boto3.client("sqs", region_name=region_name)
+        config = Config(max_pool_connections=max_pool_connections, retries={"mode" : "adaptive"})
+        self.sqs = boto3.client("sqs", region_name=region_name, config=config)
         self.queue_name = queue_name
         self.queue_url = self.sqs.get_queue_url(QueueName=queue_name)["QueueUrl"]
 
@@ -18,29 +37,264 @@ class SQSBatchSource(SQSClientBase, BatchSourceBase):
     https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
     
     Each instance of this class should only have ONE consumer.
+
+    Messages are received up to max_number_of_messages at a time using long polling,
+    buffered locally, and deleted in groups once they have been processed.
+    When the queue is empty, polling backs off exponentially up to max_backoff_seconds.
+    Iteration stops once the queue has been idle for max_idle_seconds (if specified),
+    or after receiving SIGINT or SIGTERM. Any buffered messages that were not
+    processed are then made visible to other consumers again.
+
+    While messages are held by this instance, a background heartbeat thread
+    periodically resets their visibility timeout to visibility_timeout seconds,
+    so long-running batches are not redelivered to other consumers. Messages held
+    for longer than max_visibility_extension seconds are no longer extended, which
+    lets batches from a stuck consumer be released back to the queue. This limit
+    applies from the time a message is returned by get_next_batch, so messages
+    waiting in the local buffer are extended for as long as they wait.
+
+    Messages sent by SQSBatchDestination with a claim check are transparently
+    replaced by the batch content they point to, which is deleted from its
+    side store once the batch is complete. Similarly, binary batches that were
+    base64 encoded by SQSBatchDestination are decoded.
     """
     
-    def __init__(self, queue_name, region_name="us-east-1"):
+    def __init__(self, queue_name,
+                       region_name="us-east-1",
+                       max_number_of_messages=10,
+                       wait_time_seconds=20,
+                       max_backoff_seconds=300,
+                       max_idle_seconds=None,
+                       visibility_timeout=300,
+                       max_visibility_extension=3600,
+                       handle_shutdown_signals=True):
         super().__init__(queue_name, region_name)
+        self.max_number_of_messages = min(max(max_number_of_messages, 1), MAX_BATCH_ENTRIES)
+        self.wait_time_seconds = min(max(wait_time_seconds, 0), 20)
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_idle_seconds = max_idle_seconds
         self.message = None
+        self.buffered_messages = deque()
+        self.completed_messages = []
+        self.completed_messages_lock = threading.Lock()
+        self.shutdown_event = threading.Event()
+        self.visibility_timeout = visibility_timeout
+        self.max_visibility_extension = max_visibility_extension
+        self.heartbeat_interval = max(visibility_timeout // 3, 1)
+        self.in_flight_messages = {}
+        self.in_flight_messages_lock = threading.Lock()
+        self.heartbeat_thread = None
+        self.heartbeat_stop_event = threading.Event()
+        self.s3 = None
+        if handle_shutdown_signals:
+            self.handle_shutdown_signals()
+
+    def handle_shutdown_signals(self):
+        def request_shutdown(signal_number, frame):
+            logger.info(f"Received signal {signal_number}. Stopping after the current batch.")
+            self.shutdown_event.set()
+            # A second signal terminates the process immediately.
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            signal.signal(signal.SIGINT, request_shutdown)
+            signal.signal(signal.SIGTERM, request_shutdown)
+        except ValueError:
+            logger.warning("Shutdown signals can only be handled from the main thread.")
+
+    def shutdown(self):
+        self.shutdown_event.set()
 
     def get_next_batch(self):
+        idle_since = time.monotonic()
+        backoff_seconds = 1
+        while not self.shutdown_event.is_set():
+            if len(self.buffered_messages) > 0:
+                self.message = self.buffered_messages.popleft()
+                self.start_visibility_extension_clock(self.message)
+                return self.get_message_content(self.message)
+            self.delete_completed_messages()
+            if self.receive_messages():
+                backoff_seconds = 1
+                continue
+            idle_seconds = time.monotonic() - idle_since
+            if self.max_idle_seconds is not None and idle_seconds >= self.max_idle_seconds:
+                logger.info(f"SQS queue has been idle for {int(idle_seconds)} seconds.")
+                break
+            self.shutdown_event.wait(backoff_seconds)
+            backoff_seconds = min(backoff_seconds * 2, self.max_backoff_seconds)
+        unprocessed_messages = list(self.buffered_messages)
+        self.buffered_messages.clear()
+        self.untrack_in_flight_messages(unprocessed_messages)
+        self.release_messages([ message["ReceiptHandle"] for message in unprocessed_messages ])
+        raise StopIteration()
+
+    def receive_messages(self):
         try:
-            messages = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=1)
-            if "Messages" in messages:
-                self.message = messages["Messages"][0]
-                return self.message["Body"]
+            response = self.sqs.receive_message( QueueUrl=self.queue_url,
+                                                 MaxNumberOfMessages=self.max_number_of_messages,
+                                                 WaitTimeSeconds=self.wait_time_seconds,
+                                                 VisibilityTimeout=self.visibility_timeout,
+                                                 MessageAttributeNames=[CLAIM_CHECK_ATTRIBUTE_NAME, ENCODING_ATTRIBUTE_NAME, COMPRESSION_ATTRIBUTE_NAME] )
+            messages = response.get("Messages", [])
+            self.buffered_messages.extend(messages)
+            self.track_in_flight_messages(messages)
+            return len(messages) > 0
         except Exception as e:
             logger.error(f"Failed to receive batch from SQS: {e}")
+            return False
+
+    def get_message_content(self, message):
+        claim_check_uri = get_claim_check_uri(message)
+        try:
+            if claim_check_uri is None:
+                if get_message_attribute(message, ENCODING_ATTRIBUTE_NAME) == "base64":
+                    content = base64.b64decode(message["Body"])
+                else:
+                    content = message["Body"]
+            elif claim_check_uri.startswith("s3://"):
+                bucket_name, key = claim_check_uri[len("s3://"):].split("/", 1)
+                obj = self.get_s3_client().get_object(Bucket=bucket_name, Key=key)
+                content = obj["Body"].read()
+            else:
+                with open(claim_check_uri[len("file://"):], "rb") as claim_check_file:
+                    content = claim_check_file.read()
+        except Exception as e:
+            logger.error(f"Failed to receive batch from claim check {claim_check_uri}: {e}")
             return None
+        compression = get_compression(get_message_attribute(message, COMPRESSION_ATTRIBUTE_NAME))
+        return content if compression is None else compression.decompress(content)
 
-    def mark_batch_as_complete(self):
+    def delete_claim_check_content(self, message):
+        claim_check_uri = get_claim_check_uri(message)
+        if claim_check_uri is None:
+            return
         try:
-            message_receipt_handle = self.message["ReceiptHandle"]
-            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message_receipt_handle)
+            if claim_check_uri.startswith("s3://"):
+                bucket_name, key = claim_check_uri[len("s3://"):].split("/", 1)
+                self.get_s3_client().delete_object(Bucket=bucket_name, Key=key)
+            else:
+                os.remove(claim_check_uri[len("file://"):])
         except Exception as e:
-            logger.error(f"Failed to delete batch from SQS: {e}")
+            logger.error(f"Failed to delete batch from claim check {claim_check_uri}: {e}")
+
+    def get_s3_client(self):
+        if self.s3 is None:
+            self.s3 = boto3.client("s3")
+        return self.s3
+
+    def get_batch_handle(self):
+        return self.message
+
+    def mark_batch_as_complete(self, batch_handle=None):
+        message = self.message if batch_handle is None else batch_handle
+        if message is None:
+            return
+        if message is self.message:
+            self.message = None
+        with self.completed_messages_lock:
+            self.completed_messages.append(message)
+            should_delete = len(self.completed_messages) >= self.max_number_of_messages
+        if should_delete:
+            self.delete_completed_messages()
+
+    def delete_completed_messages(self):
+        with self.completed_messages_lock:
+            messages = self.completed_messages
+            self.completed_messages = []
+        if len(messages) == 0:
             return
+        self.untrack_in_flight_messages(messages)
+        entries = [ { "Id" : str(i), "ReceiptHandle" : message["ReceiptHandle"] } for i, message in enumerate(messages) ]
+        try:
+            response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed_ids = set()
+            for failure in response.get("Failed", []):
+                failed_ids.add(failure.get("Id"))
+                logger.error(f"Failed to delete batch from SQS: {failure.get('Message')}")
+            for i, message in enumerate(messages):
+                if str(i) not in failed_ids:
+                    self.delete_claim_check_content(message)
+        except Exception as e:
+            logger.error(f"Failed to delete batch from SQS: {e}")
+
+    def close(self):
+        """
+        Deletes completed messages, and makes any messages that were
+        received but not completed visible to other consumers again.
+        """
+        self.delete_completed_messages()
+        self.stop_heartbeat()
+        with self.in_flight_messages_lock:
+            receipt_handles = list(self.in_flight_messages.keys())
+            self.in_flight_messages.clear()
+        self.release_messages(receipt_handles)
+        self.message = None
+
+    def release_messages(self, receipt_handles):
+        for i in range(0, len(receipt_handles), MAX_BATCH_ENTRIES):
+            entries = [ { "Id" : str(j), "ReceiptHandle" : receipt_handle, "VisibilityTimeout" : 0 }
+                        for j, receipt_handle in enumerate(receipt_handles[i:i+MAX_BATCH_ENTRIES]) ]
+            try:
+                self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logger.error(f"Failed to release unprocessed batches to SQS: {e}")
+
+    def track_in_flight_messages(self, messages):
+        # Buffered messages are kept hidden without a limit until they are handed out,
+        # since they may wait behind the other messages of the group for a long time.
+        with self.in_flight_messages_lock:
+            for message in messages:
+                self.in_flight_messages[message["ReceiptHandle"]] = None
+        if len(messages) > 0 and self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self.run_heartbeat, daemon=True)
+            self.heartbeat_thread.start()
+
+    def start_visibility_extension_clock(self, message):
+        with self.in_flight_messages_lock:
+            if message["ReceiptHandle"] in self.in_flight_messages:
+                self.in_flight_messages[message["ReceiptHandle"]] = time.monotonic()
+
+    def untrack_in_flight_messages(self, messages):
+        with self.in_flight_messages_lock:
+            for message in messages:
+                self.in_flight_messages.pop(message["ReceiptHandle"], None)
+
+    def run_heartbeat(self):
+        while not self.heartbeat_stop_event.wait(self.heartbeat_interval):
+            self.extend_visibility_timeouts()
+
+    def stop_heartbeat(self):
+        if self.heartbeat_thread is not None:
+            self.heartbeat_stop_event.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+            self.heartbeat_stop_event.clear()
+
+    def extend_visibility_timeouts(self):
+        """
+        Resets the visibility timeout of every in-flight message that has not been
+        processed for longer than max_visibility_extension since it was handed out.
+        """
+        now = time.monotonic()
+        receipt_handles = []
+        with self.in_flight_messages_lock:
+            for receipt_handle, handed_out_time in list(self.in_flight_messages.items()):
+                if ( self.max_visibility_extension is not None and handed_out_time is not None
+                     and now - handed_out_time >= self.max_visibility_extension ):
+                    logger.warning(f"Batch has been in flight for over {self.max_visibility_extension} seconds. Releasing it back to SQS.")
+                    del self.in_flight_messages[receipt_handle]
+                else:
+                    receipt_handles.append(receipt_handle)
+        for i in range(0, len(receipt_handles), MAX_BATCH_ENTRIES):
+            entries = [ { "Id" : str(j), "ReceiptHandle" : receipt_handle, "VisibilityTimeout" : self.visibility_timeout }
+                        for j, receipt_handle in enumerate(receipt_handles[i:i+MAX_BATCH_ENTRIES]) ]
+            try:
+                response = self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+                for failure in response.get("Failed", []):
+                    logger.error(f"Failed to extend visibility timeout of batch in SQS: {failure.get('Message')}")
+            except Exception as e:
+                logger.error(f"Failed to extend visibility timeout of batch in SQS: {e}")
 
 class SQSBatchDestination(SQSClientBase, BatchDestinationBase):
     """
@@ -49,14 +303,137 @@ class SQSBatchDestination(SQSClientBase, BatchDestinationBase):
     AWS credentials should be stored in a format compatible with boto3,
     such as environment variables or a credentials file. For more information, see:
     https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
+
+    Results are buffered and sent in groups of up to 10 messages with
+    send_message_batch. Buffered results are sent once a group is full,
+    or when flush() is called.
+
+    Text results, such as CSV batches, are sent as text. Binary results, such as Arrow
+    or Parquet batches, and results that are not valid SQS message text are sent base64 encoded.
+    If a compression is specified, results are compressed before being encoded,
+    and the compression is recorded in a message attribute.
+    Results larger than the SQS message size limit are written to claim_check_store,
+    and a message pointing to their location is sent in their place.
+    SQSBatchSource resolves these messages transparently.
     """
 
-    def __init__(self, queue_name, region_name="us-east-1"):
-        super().__init__(queue_name, region_name)
+    def __init__(self, queue_name, region_name="us-east-1", claim_check_store=None, compression=None, max_pool_connections=10):
+        super().__init__(queue_name, region_name, max_pool_connections)
+        self.claim_check_store = claim_check_store
+        self.compression = compression
+        self.pending_entries = []
+        self.pending_entries_size = 0
+        self.num_failed_entries = 0
+        self.pending_entries_lock = threading.Lock()
 
     def publish_batch_results(self, results, target_file_name=None):
         try:
-            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=results)
+            entry = self.get_message_entry(results, target_file_name)
         except Exception as e:
             logger.error(f"Failed to send batch to SQS: {e}")
+            return False
+        entry_size = get_message_entry_size(entry)
+        groups_to_send = []
+        with self.pending_entries_lock:
+            if len(self.pending_entries) == MAX_BATCH_ENTRIES or self.pending_entries_size + entry_size > MAX_MESSAGE_SIZE:
+                groups_to_send.append(self.take_pending_entries())
+            entry["Id"] = str(len(self.pending_entries))
+            self.pending_entries.append(entry)
+            self.pending_entries_size += entry_size
+            if len(self.pending_entries) == MAX_BATCH_ENTRIES:
+                groups_to_send.append(self.take_pending_entries())
+        # Groups are sent outside the lock, so that several threads can publish concurrently.
+        for entries in groups_to_send:
+            self.send_entries(entries)
+        return True
+
+    def get_message_entry(self, results, target_file_name=None):
+        results, target_file_name = self.compress_batch_results(results, target_file_name)
+        message_attributes = {}
+        if self.compression is not None:
+            message_attributes[COMPRESSION_ATTRIBUTE_NAME] = { "DataType" : "String", "StringValue" : self.compression.name }
+        # Compressed results are always binary.
+        text = get_message_body_text(results, target_file_name) if self.compression is None else None
+        if text is not None:
+            entry = { "MessageBody" : text }
+        else:
+            if isinstance(results, str):
+                results = results.encode("utf-8")
+            entry = {
+                "MessageBody" : base64.b64encode(results).decode("ascii"),
+                "MessageAttributes" : {
+                    ENCODING_ATTRIBUTE_NAME : { "DataType" : "String", "StringValue" : "base64" },
+                    **message_attributes
+                }
+            }
+        if get_message_entry_size(entry) <= MAX_MESSAGE_SIZE:
+            return entry
+        if self.claim_check_store is None:
+            raise Exception("Batch exceeds the SQS message size limit, and no claim check store was specified.")
+        claim_check_uri = self.claim_check_store.put(results, target_file_name)
+        return {
+            "MessageBody" : claim_check_uri,
+            "MessageAttributes" : {
+                CLAIM_CHECK_ATTRIBUTE_NAME : { "DataType" : "String", "StringValue" : claim_check_uri },
+                **message_attributes
+            }
+        }
+
+    def take_pending_entries(self):
+        entries = self.pending_entries
+        self.pending_entries = []
+        self.pending_entries_size = 0
+        return entries
+
+    def flush(self):
+        with self.pending_entries_lock:
+            entries = self.take_pending_entries()
+        self.send_entries(entries)
+        with self.pending_entries_lock:
+            num_failed_entries = self.num_failed_entries
+            self.num_failed_entries = 0
+        return num_failed_entries
+
+    def send_entries(self, entries):
+        if len(entries) == 0:
             return
+        num_failed_entries = 0
+        try:
+            response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed_ids = [ failure.get("Id") for failure in response.get("Failed", []) ]
+            if len(failed_ids) > 0:
+                # Retry failed messages once before reporting them.
+                retry_entries = [ entry for entry in entries if entry["Id"] in failed_ids ]
+                response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=retry_entries)
+                for failure in response.get("Failed", []):
+                    logger.error(f"Failed to send batch to SQS: {failure.get('Message')}")
+                    num_failed_entries += 1
+        except Exception as e:
+            logger.error(f"Failed to send batch to SQS: {e}")
+            num_failed_entries = len(entries)
+        with self.pending_entries_lock:
+            self.num_failed_entries += num_failed_entries
+
+def get_message_body_text(results, target_file_name=None):
+    """Returns batch results as a string if they can be sent as the body of an SQS message, or None otherwise."""
+    if target_file_name is not None and target_file_name.rsplit(".", 1)[-1] in BINARY_FILE_EXTENSIONS:
+        return None
+    if isinstance(results, bytes):
+        try:
+            results = results.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    return None if INVALID_MESSAGE_BODY_CHARACTERS.search(results) else results
+
+def get_message_entry_size(entry):
+    size = len(entry["MessageBody"].encode("utf-8"))
+    for name, attribute in entry.get("MessageAttributes", {}).items():
+        size += len(name) + len(attribute["DataType"]) + len(attribute["StringValue"].encode("utf-8"))
+    return size
+
+def get_message_attribute(message, attribute_name):
+    attribute = message.get("MessageAttributes", {}).get(attribute_name)
+    return None if attribute is None else attribute["StringValue"]
+
+def get_claim_check_uri(message):
+    return get_message_attribute(message, CLAIM_CHECK_ATTRIBUTE_NAME)
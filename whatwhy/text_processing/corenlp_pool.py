@@ -0,0 +1,195 @@
+import hashlib
+import json
+import time
+import threading
+import requests
+from .clients.client import logger
+
+class CoreNLPEndpoint():
+    """The state of a single Stanford CoreNLP server, as seen by a CoreNLPEndpointPool."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.num_outstanding_requests = 0
+        self.is_healthy = False
+        self.num_failures = 0
+        self.retry_time = 0
+
+class CoreNLPEndpointPool():
+    """
+    Sends annotation requests to one of several Stanford CoreNLP servers.
+
+    Each request is sent to the healthy server with the fewest outstanding requests.
+    A server is taken out of rotation when a request to it fails, and is added back once its
+    /ready endpoint responds successfully. It is probed again after min_backoff_seconds,
+    and the wait doubles after each consecutive failure, up to max_backoff_seconds.
+
+    annotate() can be used in place of the annotate method of a stanza CoreNLPClient,
+    such as by Giveme5W1H's CoreNLP preprocessor.
+    """
+
+    def __init__(self, urls, request_timeout_seconds=600, probe_timeout_seconds=5, min_backoff_seconds=1, max_backoff_seconds=60):
+        if len(urls) == 0:
+            raise AttributeError("At least one CoreNLP server URL is required.")
+        self.endpoints = [ CoreNLPEndpoint(url) for url in urls ]
+        self.request_timeout_seconds = request_timeout_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+        self.min_backoff_seconds = min_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.endpoints_lock = threading.Lock()
+
+    def wait_until_ready(self, timeout_seconds=300, poll_interval_seconds=1):
+        """
+        Probes every server until at least one of them is ready, and returns True,
+        or returns False if none are ready within timeout_seconds.
+        """
+        end_time = time.time() + timeout_seconds
+        while True:
+            for endpoint in self.endpoints:
+                self.probe(endpoint)
+            ready_urls = [ endpoint.url for endpoint in self.endpoints if endpoint.is_healthy ]
+            if len(ready_urls) > 0:
+                logger.info(f"CoreNLP servers are ready: {', '.join(ready_urls)}")
+                return True
+            if time.time() >= end_time:
+                logger.error(f"No CoreNLP server was ready within {timeout_seconds} seconds.")
+                return False
+            time.sleep(poll_interval_seconds)
+
+    def probe(self, endpoint):
+        try:
+            response = requests.get(endpoint.url + "/ready", timeout=self.probe_timeout_seconds)
+            is_ready = response.status_code == 200
+        except requests.RequestException:
+            is_ready = False
+        if is_ready:
+            self.mark_as_healthy(endpoint)
+        else:
+            self.mark_as_unhealthy(endpoint)
+        return is_ready
+
+    def mark_as_healthy(self, endpoint):
+        with self.endpoints_lock:
+            endpoint.is_healthy = True
+            endpoint.num_failures = 0
+
+    def mark_as_unhealthy(self, endpoint):
+        with self.endpoints_lock:
+            if endpoint.is_healthy:
+                logger.warning(f"Taking CoreNLP server {endpoint.url} out of rotation.")
+            endpoint.is_healthy = False
+            backoff_seconds = min(self.max_backoff_seconds, self.min_backoff_seconds * 2**endpoint.num_failures)
+            endpoint.retry_time = time.time() + backoff_seconds
+            endpoint.num_failures += 1
+
+    def get_endpoint(self, excluded_endpoints=()):
+        """
+        Returns the healthy server with the fewest outstanding requests, after probing any
+        unhealthy servers that are due to be retried, or None if no server is healthy.
+        """
+        with self.endpoints_lock:
+            now = time.time()
+            endpoints_to_probe = [ endpoint for endpoint in self.endpoints
+                                   if not endpoint.is_healthy and endpoint.retry_time <= now and endpoint not in excluded_endpoints ]
+            # Other threads wait for the backoff to expire again instead of probing the same server.
+            for endpoint in endpoints_to_probe:
+                endpoint.retry_time = now + self.probe_timeout_seconds
+        for endpoint in endpoints_to_probe:
+            self.probe(endpoint)
+
+        with self.endpoints_lock:
+            healthy_endpoints = [ endpoint for endpoint in self.endpoints if endpoint.is_healthy and endpoint not in excluded_endpoints ]
+            if len(healthy_endpoints) == 0:
+                return None
+            endpoint = min(healthy_endpoints, key=lambda endpoint: endpoint.num_outstanding_requests)
+            endpoint.num_outstanding_requests += 1
+            return endpoint
+
+    def annotate(self, text, properties=None):
+        """
+        Returns the annotations of text as a dictionary. properties must include 'outputFormat': 'json'.
+        If a request fails, it is retried once with each of the other healthy servers.
+        """
+        properties = {} if properties is None else properties
+        failed_endpoints = []
+        while True:
+            endpoint = self.get_endpoint(excluded_endpoints=failed_endpoints)
+            if endpoint is None:
+                raise ConnectionError("No CoreNLP server is available.")
+            try:
+                response = requests.post( endpoint.url,
+                                          params={ "properties" : json.dumps(properties) },
+                                          data=text.encode("utf-8"),
+                                          headers={ "Content-Type" : "text/plain; charset=utf-8" },
+                                          timeout=self.request_timeout_seconds )
+                # Client errors are caused by the request rather than by the server, so are not retried.
+                if 400 <= response.status_code < 500:
+                    raise ValueError(f"CoreNLP server {endpoint.url} rejected the request: {response.text}")
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, json.JSONDecodeError) as e:
+                logger.error(f"Request to CoreNLP server {endpoint.url} failed: {e}")
+                self.mark_as_unhealthy(endpoint)
+                failed_endpoints.append(endpoint)
+            finally:
+                with self.endpoints_lock:
+                    endpoint.num_outstanding_requests -= 1
+
+class CachedCoreNLPAnnotator():
+    """
+    Stores the annotations returned by another annotator, such as a CoreNLPEndpointPool,
+    in a ResultCache, so that texts are only annotated once with the same properties. Since
+    the cache is keyed by the properties, such as the list of annotators, changing them does
+    not reuse old annotations, but changing how the annotations are used does.
+
+    New annotations are buffered until flush() is called.
+    """
+
+    # Properties that do not affect the annotations.
+    IGNORED_PROPERTIES = ("timeout",)
+
+    def __init__(self, annotator, annotation_cache):
+        self.annotator = annotator
+        self.annotation_cache = annotation_cache
+        self.unflushed_annotations = {}
+        self.cache_lock = threading.Lock()
+        self.num_cache_hits = 0
+        self.num_cache_misses = 0
+
+    def get_cache_key(self, text, properties):
+        properties = { name : value for name, value in properties.items() if name not in self.IGNORED_PROPERTIES }
+        cache_key_prefix = json.dumps(properties, sort_keys=True)
+        return hashlib.sha256(f"{cache_key_prefix}\n{text}".encode("utf-8")).hexdigest()
+
+    def annotate(self, text, properties=None):
+        properties = {} if properties is None else properties
+        key = self.get_cache_key(text, properties)
+        with self.cache_lock:
+            annotation = self.unflushed_annotations.get(key)
+        # The cache is looked up without holding the lock, so that the lookups of several
+        # threads, which may be network requests, overlap.
+        if annotation is None:
+            annotation = self.annotation_cache.get_many([key]).get(key)
+        with self.cache_lock:
+            if annotation is not None:
+                self.num_cache_hits += 1
+                return annotation
+            self.num_cache_misses += 1
+
+        annotation = self.annotator.annotate(text, properties=properties)
+        with self.cache_lock:
+            self.unflushed_annotations[key] = annotation
+        return annotation
+
+    def flush(self):
+        """Stores any buffered annotations in the cache, and logs how many texts were annotated."""
+        with self.cache_lock:
+            unflushed_annotations = self.unflushed_annotations
+            self.unflushed_annotations = {}
+            if self.num_cache_hits + self.num_cache_misses > 0:
+                logger.info( f"CoreNLP annotations: {self.num_cache_hits} were cached, "
+                             f"{self.num_cache_misses} were requested from a server." )
+            self.num_cache_hits = 0
+            self.num_cache_misses = 0
+        if len(unflushed_annotations) > 0:
+            self.annotation_cache.put_many(unflushed_annotations)
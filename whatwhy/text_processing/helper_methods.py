@@ -1,15 +1,31 @@
-from io import StringIO
+from io import StringIO, BytesIO
 import csv
 import pandas as pd
 
-def get_csv_string_from_df(df):
+def get_csv_string_from_df(df, header=True):
     with StringIO() as csv_stream:
-        df.to_csv(csv_stream, sep="\t", quoting=csv.QUOTE_ALL, quotechar='"')
+        df.to_csv(csv_stream, sep="\t", quoting=csv.QUOTE_ALL, quotechar='"', header=header)
         return csv_stream.getvalue()
 
 def get_df_from_csv_string(csv_string):
-    with StringIO(csv_string) as csv_stream:
-        return pd.read_csv(csv_stream, index_col=False, sep="\t", dtype=str, quoting=csv.QUOTE_ALL, quotechar='"')
+    """
+    Parses a CSV batch, which may be a string, UTF-8 encoded bytes,
+    or a readable binary buffer such as a memory-mapped file, which is parsed without copying it first.
+    """
+    if isinstance(csv_string, str):
+        csv_stream = StringIO(csv_string)
+    elif isinstance(csv_string, bytes):
+        csv_stream = BytesIO(csv_string)
+    else:
+        csv_stream = csv_string
+    return pd.read_csv(csv_stream, index_col=False, sep="\t", dtype=str, quoting=csv.QUOTE_ALL, quotechar='"')
 
 def get_df_from_file(file_name):
     return pd.read_csv(file_name, index_col=False, sep="\t", dtype=str, quoting=csv.QUOTE_ALL, quotechar='"')
+
+def get_df_chunks_from_file(file_name, chunk_size):
+    """
+    Lazily reads a CSV file as DataFrames of at most chunk_size rows, so that only
+    one chunk is held in memory at a time. Files ending in .gz are decompressed as they are read.
+    """
+    return pd.read_csv(file_name, index_col=False, sep="\t", dtype=str, quoting=csv.QUOTE_ALL, quotechar='"', chunksize=chunk_size, compression="infer")
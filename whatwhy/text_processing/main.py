@@ -1,8 +1,20 @@
 import argparse
 from whatwhy import RawTextAndArgumentDefaultsHelpFormatter
-from .helper_methods import get_df_from_file
-from .clients import FileSystemBatchSource, FileSystemBatchDestination, S3BatchSource, S3BatchDestination, SQSBatchSource, SQSBatchDestination
-from .batch_processors import BatchTransferer, BatchPreprocessor, WHPhrasesBatchProcessor, BatchTokenizer, BatchWHPhrasesTokenizer, BatchConsolidator
+from .helper_methods import get_df_chunks_from_file
+from .batch_formats import CSVBatchFormat, ArrowBatchFormat, ParquetBatchFormat
+from .clients import ( FileSystemBatchSource, FileSystemBatchDestination, FileSystemClaimCheckStore, FileSystemCompletionManifest,
+                       S3BatchSource, S3BatchDestination, S3ClaimCheckStore, S3CompletionManifest,
+                       SQSBatchSource, SQSBatchDestination,
+                       PipeBatchSource, PipeBatchDestination,
+                       SQLiteBatchSource, SQLiteBatchDestination )
+from .clients.compression import get_compression
+from .clients.sqs_client import MAX_BATCH_ENTRIES
+from .result_cache import LocalResultCache, FileSystemResultCache, S3ResultCache, TieredResultCache
+from .spelling_correction import load_known_words
+from .text_normalization import NORMALIZATION_STAGE_TYPES, get_normalization_stages
+from .batch_processors import BatchTransferer, BatchPreprocessor, WHPhrasesBatchProcessor, BatchTokenizer, BatchWHPhrasesTokenizer, BatchConsolidator, ChainedBatchProcessor
+
+BATCH_PROCESSOR_TYPES = ["preprocessing", "wh-phrases", "transfer", "tokenize", "tokenize-wh-phrases", "consolidate"]
 
 description = """
 This is a CLI for batch processing text data. Specifically, it is used
@@ -19,6 +31,12 @@ Data must be read from, and written to, one of these supported locations:
     - Local File System
     - Amazon S3
     - Amazon SQS
+    - Standard input and output, or a named pipe
+    - SQLite database file
+
+To chain tasks in a shell pipeline, use the pipe type with the name '-', such as
+'whatwhy-text --process preprocessing -st fs -sn raw -dt pipe -dn - |
+ whatwhy-text --process tokenize -st pipe -sn - -dt fs -dn tokens'.
 
 If using AWS, credentials should be stored in a format compatible with boto3,
 such as environment variables or a credentials file. For more information, see:
@@ -30,7 +48,8 @@ Supported batch processing tasks are:
     - preprocessing : Preprocesses text by removing URL's and auto-correcting common spelling errors.
     - wh-phrases    : Extracts the WH phrases (who, what, when, where, why, how) from text.
                       This is intended to be run from within a Docker network, since access to
-                      a Stanford CoreNLP server API at http://corenlp-service:9000 is required.
+                      a Stanford CoreNLP server API at http://corenlp-service:9000 is required,
+                      unless other servers are specified with --corenlp-urls.
                       Please see the readme file at https://github.com/stevengt/whatwhy
                       for more information.
     - tokenize      : Tokenizes and standardizes text-segments.
@@ -38,71 +57,272 @@ Supported batch processing tasks are:
                             columns 'who', 'what', 'when', 'where', 'why', 'how'
                             and stores the results in 'who tokens', 'what tokens', 
                             'when tokens', 'where tokens', 'why tokens', and 'how tokens'.
+
+Multiple tasks (except for consolidate) can be chained by separating them with commas,
+such as '--process preprocessing,wh-phrases,tokenize-wh-phrases'. Each batch is then
+kept in memory between tasks, and only the results of the last task are written to
+the destination unless --intermediate-dest-names is used.
 """
 
-def get_batch_source(source_type, source_name, delete_when_complete, aws_region_name):
+def get_batch_source( source_type,
+                      source_name,
+                      delete_when_complete,
+                      aws_region_name,
+                      max_idle_seconds=None,
+                      max_visibility_extension=3600,
+                      num_download_threads=4,
+                      manifest=None,
+                      lease_seconds=None,
+                      use_mmap=False,
+                      watch_interval_seconds=None,
+                      max_number_of_messages=10,
+                      visibility_timeout=300 ):
     if source_type == "fs":
-        return FileSystemBatchSource(source_name, delete_when_complete=delete_when_complete)
+        return FileSystemBatchSource( source_name,
+                                      delete_when_complete=delete_when_complete,
+                                      manifest=manifest,
+                                      lease_seconds=lease_seconds,
+                                      use_mmap=use_mmap,
+                                      watch_interval_seconds=watch_interval_seconds,
+                                      max_idle_seconds=max_idle_seconds )
     elif source_type == "s3":
         source_names = source_name.split("/")
         bucket_name = source_names[0]
         folder_name = "/".join(source_names[1:])
-        return S3BatchSource(bucket_name=bucket_name, folder_name=folder_name, delete_when_complete=delete_when_complete)
+        return S3BatchSource( bucket_name=bucket_name,
+                              folder_name=folder_name,
+                              delete_when_complete=delete_when_complete,
+                              num_prefetched_batches=num_download_threads,
+                              manifest=manifest,
+                              lease_seconds=lease_seconds )
     elif source_type == "sqs":
-        return SQSBatchSource(source_name, aws_region_name)
+        return SQSBatchSource( source_name,
+                               aws_region_name,
+                               max_number_of_messages=max_number_of_messages,
+                               max_idle_seconds=max_idle_seconds,
+                               visibility_timeout=visibility_timeout,
+                               max_visibility_extension=max_visibility_extension )
+    elif source_type == "pipe":
+        return PipeBatchSource(source_name)
+    elif source_type == "sqlite":
+        return SQLiteBatchSource( source_name,
+                                  delete_when_complete=delete_when_complete,
+                                  lease_seconds=lease_seconds )
     else:
         raise AttributeError(f"Unsupported batch source type {source_type}.")
 
-def get_batch_destination(dest_type, dest_name, aws_region_name):
+def get_batch_destination( dest_type,
+                           dest_name,
+                           aws_region_name,
+                           claim_check_store=None,
+                           compression=None,
+                           max_pool_connections=10,
+                           batch_format=None,
+                           id_col_name=None ):
     if dest_type == "fs":
-        return FileSystemBatchDestination(dest_name)
+        return FileSystemBatchDestination(dest_name, compression=compression)
     elif dest_type == "s3":
         dest_names = dest_name.split("/")
         bucket_name = dest_names[0]
         folder_name = "/".join(dest_names[1:])
-        return S3BatchDestination(bucket_name=bucket_name, folder_name=folder_name)
+        return S3BatchDestination(bucket_name=bucket_name, folder_name=folder_name, compression=compression, max_pool_connections=max_pool_connections)
     elif dest_type == "sqs":
-        return SQSBatchDestination(dest_name, aws_region_name)
+        return SQSBatchDestination(dest_name, aws_region_name, claim_check_store=claim_check_store, compression=compression, max_pool_connections=max_pool_connections)
+    elif dest_type == "pipe":
+        return PipeBatchDestination(dest_name, compression=compression)
+    elif dest_type == "sqlite":
+        return SQLiteBatchDestination(dest_name, compression=compression, batch_format=batch_format, id_col_name=id_col_name)
     else:
         raise AttributeError(f"Unsupported batch destination type {dest_type}.")
 
+def get_claim_check_store(store_type, store_name):
+    if store_type is None or store_name is None:
+        return None
+    elif store_type == "fs":
+        return FileSystemClaimCheckStore(store_name)
+    elif store_type == "s3":
+        store_names = store_name.split("/")
+        bucket_name = store_names[0]
+        folder_name = "/".join(store_names[1:])
+        return S3ClaimCheckStore(bucket_name=bucket_name, folder_name=folder_name)
+    else:
+        raise AttributeError(f"Unsupported claim check store type {store_type}.")
+
+def get_completion_manifest(manifest_type, manifest_name):
+    if manifest_type is None or manifest_name is None:
+        return None
+    elif manifest_type == "fs":
+        return FileSystemCompletionManifest(manifest_name)
+    elif manifest_type == "s3":
+        manifest_names = manifest_name.split("/")
+        bucket_name = manifest_names[0]
+        key = "/".join(manifest_names[1:])
+        return S3CompletionManifest(bucket_name=bucket_name, key=key)
+    else:
+        raise AttributeError(f"Unsupported manifest type {manifest_type}.")
+
+def get_result_cache(local_cache_file_name, local_cache_size_mb, shared_cache_type, shared_cache_name):
+    local_cache = None
+    if local_cache_file_name is not None:
+        local_cache = LocalResultCache(local_cache_file_name, max_size_bytes=local_cache_size_mb * 1024**2)
+    shared_cache = None
+    if shared_cache_type is None or shared_cache_name is None:
+        pass
+    elif shared_cache_type == "fs":
+        shared_cache = FileSystemResultCache(shared_cache_name)
+    elif shared_cache_type == "s3":
+        shared_cache_names = shared_cache_name.split("/")
+        bucket_name = shared_cache_names[0]
+        folder_name = "/".join(shared_cache_names[1:])
+        shared_cache = S3ResultCache(bucket_name=bucket_name, folder_name=folder_name)
+    else:
+        raise AttributeError(f"Unsupported result cache type {shared_cache_type}.")
+    if local_cache is not None and shared_cache is not None:
+        return TieredResultCache(local_cache, shared_cache)
+    return local_cache if local_cache is not None else shared_cache
+
 def get_batch_processor( batch_processor_type,
                          batch_source,
                          batch_dest,
                          id_col_name=None,
                          source_col_name=None,
                          dest_col_name=None,
-                         include_cols=None ):
+                         include_cols=None,
+                         batch_format=None,
+                         sort_and_dedup=False,
+                         dedup_col_names=None,
+                         result_cache=None,
+                         spelling_cache=None,
+                         known_words=None,
+                         normalization_stages=None,
+                         num_corenlp_requests=4,
+                         corenlp_urls=None,
+                         annotation_cache=None ):
     kwargs = {
         "source" : batch_source, 
         "dest" : batch_dest,
         "id_col_name" : id_col_name,
         "source_col_name" : source_col_name,
         "dest_col_name" : dest_col_name,
-        "include_cols" : include_cols
+        "include_cols" : include_cols,
+        "batch_format" : batch_format
     }
+    # Unspecified column names fall back to the defaults of each batch processor.
+    kwargs = { key : value for key, value in kwargs.items() if value is not None or key in ("source", "dest") }
     
     if batch_processor_type == "preprocessing":
-        return BatchPreprocessor(**kwargs)
+        return BatchPreprocessor( **kwargs,
+                                  result_cache=result_cache,
+                                  spelling_cache=spelling_cache,
+                                  known_words=known_words,
+                                  normalization_stages=normalization_stages )
     elif batch_processor_type == "wh-phrases":
-        return WHPhrasesBatchProcessor(**kwargs)
+        return WHPhrasesBatchProcessor( **kwargs,
+                                        result_cache=result_cache,
+                                        num_concurrent_requests=num_corenlp_requests,
+                                        corenlp_urls=corenlp_urls,
+                                        annotation_cache=annotation_cache )
     elif batch_processor_type == "transfer":
         return BatchTransferer(**kwargs)
     elif batch_processor_type == "tokenize":
-        return BatchTokenizer(**kwargs)
+        return BatchTokenizer(**kwargs, result_cache=result_cache)
     elif batch_processor_type == "tokenize-wh-phrases":
-        return BatchWHPhrasesTokenizer(**kwargs)
+        return BatchWHPhrasesTokenizer(**kwargs, result_cache=result_cache)
     elif batch_processor_type == "consolidate":
-        return BatchConsolidator(**kwargs)
+        return BatchConsolidator(**kwargs, sort_and_dedup=sort_and_dedup, dedup_col_names=dedup_col_names)
     else:
         raise AttributeError(f"Unsupported batch processor type {batch_processor_type}.")
 
-def populate(df_file_name, batch_dest, batch_size):
-    df = get_df_from_file(df_file_name)
-    batch_dest.populate_from_df(df, batch_size)
+def get_chained_batch_processor( batch_processor_types,
+                                 batch_source,
+                                 batch_dest,
+                                 id_col_name=None,
+                                 source_col_name=None,
+                                 dest_col_name=None,
+                                 include_cols=None,
+                                 intermediate_dests=None,
+                                 batch_format=None,
+                                 result_cache=None,
+                                 spelling_cache=None,
+                                 known_words=None,
+                                 normalization_stages=None,
+                                 num_corenlp_requests=4,
+                                 corenlp_urls=None,
+                                 annotation_cache=None ):
+    if "consolidate" in batch_processor_types:
+        raise AttributeError("The consolidate batch processor cannot be chained.")
+
+    batch_processors = []
+    for i, batch_processor_type in enumerate(batch_processor_types):
+        is_first = i == 0
+        is_last = i == len(batch_processor_types) - 1
+        batch_processor = get_batch_processor( batch_processor_type=batch_processor_type,
+                                               batch_source=None,
+                                               batch_dest=None,
+                                               id_col_name=id_col_name,
+                                               source_col_name=source_col_name if is_first else batch_processors[-1].dest_col_name,
+                                               dest_col_name=dest_col_name if is_last else None,
+                                               include_cols=include_cols,
+                                               result_cache=result_cache,
+                                               spelling_cache=spelling_cache,
+                                               known_words=known_words,
+                                               normalization_stages=normalization_stages,
+                                               num_corenlp_requests=num_corenlp_requests,
+                                               corenlp_urls=corenlp_urls,
+                                               annotation_cache=annotation_cache
+                                             )
+        batch_processors.append(batch_processor)
 
-def process(batch_processor):
-    batch_processor.run()
+    return ChainedBatchProcessor( source=batch_source,
+                                  dest=batch_dest,
+                                  batch_processors=batch_processors,
+                                  intermediate_dests=intermediate_dests,
+                                  id_col_name=id_col_name,
+                                  batch_format=batch_format )
+
+def get_batch_format(batch_format_name):
+    if batch_format_name == "csv":
+        return CSVBatchFormat()
+    elif batch_format_name == "arrow":
+        return ArrowBatchFormat()
+    elif batch_format_name == "parquet":
+        return ParquetBatchFormat()
+    else:
+        raise AttributeError(f"Unsupported batch format {batch_format_name}.")
+
+def get_batch_processor_types(value):
+    batch_processor_types = value.split(",")
+    for batch_processor_type in batch_processor_types:
+        if batch_processor_type not in BATCH_PROCESSOR_TYPES:
+            raise argparse.ArgumentTypeError(f"invalid choice: '{batch_processor_type}' (choose from {', '.join(BATCH_PROCESSOR_TYPES)})")
+    return batch_processor_types
+
+def get_normalization_stage_names(value):
+    stage_names = [ stage_name for stage_name in value.split(",") if stage_name != "" ]
+    for stage_name in stage_names:
+        if stage_name not in NORMALIZATION_STAGE_TYPES:
+            raise argparse.ArgumentTypeError(f"invalid choice: '{stage_name}' (choose from {', '.join(NORMALIZATION_STAGE_TYPES)})")
+    return stage_names
+
+def get_corenlp_urls(value):
+    corenlp_urls = [ url for url in value.split(",") if url != "" ]
+    if len(corenlp_urls) == 0:
+        raise argparse.ArgumentTypeError("at least one URL is required")
+    return corenlp_urls
+
+def populate(df_file_name, batch_dest, batch_size, batch_format=None, num_upload_threads=1):
+    df_chunks = get_df_chunks_from_file(df_file_name, batch_size)
+    return batch_dest.populate_from_df_chunks(df_chunks, batch_format, num_upload_threads)
+
+def process(batch_processor, fetch_queue_depth=0, publish_queue_depth=0, num_workers=1, dest_type=None):
+    # run() flushes the results of each batch before fetching the next one, so results sent to
+    # SQS are published in the background by default, where they can be flushed in groups.
+    if dest_type == "sqs" and publish_queue_depth == 0:
+        publish_queue_depth = MAX_BATCH_ENTRIES
+    if fetch_queue_depth > 0 or publish_queue_depth > 0 or num_workers > 1:
+        batch_processor.run_pipelined(fetch_queue_depth, publish_queue_depth, num_workers)
+    else:
+        batch_processor.run()
 
 def main():
     parser = argparse.ArgumentParser(description=description, formatter_class=RawTextAndArgumentDefaultsHelpFormatter)
@@ -110,35 +330,95 @@ def main():
 
     arggroup.add_argument( "--populate",
                            action="store_true",
-                           help="Use this argument to split a single CSV file into multiple batch files."
+                           help=( "Use this argument to split a single CSV file into multiple batch files. \n"
+                                  "The file is read one batch at a time, and may be gzip compressed (.gz)."
+                                )
                          )
 
     arggroup.add_argument( "--process",
-                           choices=["preprocessing", "wh-phrases", "transfer", "tokenize", "tokenize-wh-phrases", "consolidate"]
+                           type=get_batch_processor_types,
+                           metavar="{" + ",".join(BATCH_PROCESSOR_TYPES) + "}",
+                           help="One or more comma separated batch processing tasks."
                          )
 
     parser.add_argument( "-st",
                          "--source-type",
                          required=True,
-                         choices=["fs", "s3", "sqs"]
+                         choices=["fs", "s3", "sqs", "pipe", "sqlite"]
                        )
 
     parser.add_argument( "-sn",
                          "--source-name",
                          required=True,
-                         help="If using S3, use the format bucket-name/folder/name."
+                         help=( "If using S3, use the format bucket-name/folder/name. \n"
+                                "If using a pipe, use the path of a named pipe, or - for standard input. \n"
+                                "If using SQLite, use the path of the database file."
+                              )
                        )
 
     parser.add_argument( "-dt",
                          "--dest-type",
                          required=True,
-                         choices=["fs", "s3", "sqs"]
+                         choices=["fs", "s3", "sqs", "pipe", "sqlite"]
                        )
 
     parser.add_argument( "-dn",
                          "--dest-name",
                          required=True,
-                         help="If using S3, use the format bucket-name/folder/name."
+                         help=( "If using S3, use the format bucket-name/folder/name. \n"
+                                "If using a pipe, use the path of a named pipe, or - for standard output. \n"
+                                "If using SQLite, use the path of the database file. The IDs of the rows \n"
+                                "in each batch are indexed, so the batches containing a row can be found."
+                              )
+                       )
+
+    parser.add_argument( "--intermediate-dest-names",
+                         nargs="*",
+                         default=None,
+                         help=( "If chaining multiple tasks with --process, the names of destinations \n"
+                                "to write the results of each task except the last one to. \n"
+                                "These destinations have the same type as --dest-type."
+                              )
+                       )
+
+    parser.add_argument( "--claim-check-type",
+                         choices=["fs", "s3"],
+                         default=None,
+                         help="If using SQS as the destination, where to store batches that exceed the SQS message size limit."
+                       )
+
+    parser.add_argument( "--claim-check-name",
+                         default=None,
+                         help=( "Name of the folder to store oversized SQS batches in. \n"
+                                "If using S3, use the format bucket-name/folder/name."
+                              )
+                       )
+
+    parser.add_argument( "--manifest-type",
+                         choices=["fs", "s3"],
+                         default=None,
+                         help=( "If using the local file system or S3 as the source, where to store a manifest \n"
+                                "of completed batches. Batches recorded in the manifest are skipped, \n"
+                                "so an interrupted run can be resumed."
+                              )
+                       )
+
+    parser.add_argument( "--manifest-name",
+                         default=None,
+                         help=( "Name of the manifest file. If using S3, use the format \n"
+                                "bucket-name/folder/manifest.jsonl."
+                              )
+                       )
+
+    parser.add_argument( "--lease-time",
+                         type=int,
+                         default=None,
+                         help=( "If using the local file system, S3 or SQLite as the source, share the source with \n"
+                                "other consumers by claiming each batch with a lease of this many seconds. \n"
+                                "Leases are renewed while batches are processed, and leases of consumers \n"
+                                "that stop are reclaimed once they expire. SQLite sources always use leases, \n"
+                                "of 300 seconds by default."
+                              )
                        )
 
     parser.add_argument( "-d",
@@ -157,11 +437,128 @@ def main():
                               )
                        )
 
+    parser.add_argument( "--upload-threads",
+                         type=int,
+                         default=8,
+                         help=( "The number of batches to upload to the destination concurrently \n"
+                                "if using the --populate flag."
+                              )
+                       )
+
+    parser.add_argument( "--download-threads",
+                         type=int,
+                         default=4,
+                         help=( "If using S3 as the source, the number of batches to \n"
+                                "download concurrently ahead of the batch being processed."
+                              )
+                       )
+
+    parser.add_argument( "--fetch-queue-depth",
+                         type=int,
+                         default=0,
+                         help=( "The number of batches to fetch from the source in the background \n"
+                                "while the current batch is processed. If this or --publish-queue-depth \n"
+                                "is greater than 0, batches are fetched, processed, and published concurrently."
+                              )
+                       )
+
+    parser.add_argument( "--publish-queue-depth",
+                         type=int,
+                         default=0,
+                         help=( "The number of processed batches that can wait to be published \n"
+                                "to the destination in the background. If using SQS as the destination, \n"
+                                "10 is used by default, so that results are sent in groups of up to 10 messages."
+                              )
+                       )
+
+    parser.add_argument( "-w",
+                         "--workers",
+                         type=int,
+                         default=1,
+                         help=( "The number of processes to use for processing batches. \n"
+                                "Models used for processing are loaded once and shared by all processes. \n"
+                                "More than 1 worker is not supported on platforms without fork, such as Windows."
+                              )
+                       )
+
+    parser.add_argument( "--format",
+                         choices=["csv", "arrow", "parquet"],
+                         default="csv",
+                         help=( "The format batches are stored in. The arrow and parquet formats \n"
+                                "require pyarrow, and store lists of tokens as native list columns. \n"
+                                "The input file for --populate and the output of consolidate are always CSV."
+                              )
+                       )
+
+    parser.add_argument( "--compression",
+                         choices=["none", "gzip", "zstd"],
+                         default="none",
+                         help=( "Compression to apply to batches written to the destination. \n"
+                                "Compressed batches are detected and decompressed when read. \n"
+                                "The zstd compression requires zstandard."
+                              )
+                       )
+
     parser.add_argument( "--aws-region",
                          default="us-east-1",
                          help="Name of AWS region, if using SQS."
                        )
 
+    parser.add_argument( "--max-idle-time",
+                         type=int,
+                         default=None,
+                         help=( "If using SQS as the source, or --watch, the number of seconds to wait for new \n"
+                                "batches before stopping. By default, the queue or folder is polled until \n"
+                                "the process is stopped."
+                              )
+                       )
+
+    parser.add_argument( "--watch",
+                         type=float,
+                         nargs="?",
+                         const=1.0,
+                         default=None,
+                         help=( "If using the local file system as the source, keep polling the folder for \n"
+                                "new batch files every WATCH seconds (1 if no value is given) once the \n"
+                                "existing files are processed, so that a stage writing into the folder \n"
+                                "can stream batches to this one."
+                              )
+                       )
+
+    parser.add_argument( "--mmap",
+                         action="store_true",
+                         help=( "If using the local file system as the source, memory-map batch files \n"
+                                "and parse them without copying their content."
+                              )
+                       )
+
+    parser.add_argument( "--max-visibility-extension",
+                         type=int,
+                         default=3600,
+                         help=( "If using SQS as the source, the maximum number of seconds a batch \n"
+                                "is kept hidden from other consumers while it is being processed. \n"
+                                "Batches that take longer are released back to the queue."
+                              )
+                       )
+
+    parser.add_argument( "--sqs-max-messages",
+                         type=int,
+                         default=10,
+                         help=( "If using SQS as the source, the maximum number of batches to receive \n"
+                                "per request, from 1 to 10. Received batches are buffered until they are \n"
+                                "processed, so lower values suit batches that take long to process."
+                              )
+                       )
+
+    parser.add_argument( "--visibility-timeout",
+                         type=int,
+                         default=300,
+                         help=( "If using SQS as the source, the number of seconds received batches are \n"
+                                "hidden from other consumers. It is renewed while batches are buffered \n"
+                                "or processed, up to --max-visibility-extension."
+                              )
+                       )
+
     parser.add_argument( "--id-col",
                          default="ID",
                          help=( "Name of the column to treat as an index containing \n"
@@ -188,34 +585,235 @@ def main():
                               )
                        )
 
+    parser.add_argument( "--sort-and-dedup",
+                         action="store_true",
+                         help=( "If consolidating, sort rows by the ID column and remove duplicate rows. \n"
+                                "Sorting is done on disk, so the data set does not need to fit in memory."
+                              )
+                       )
+
+    parser.add_argument( "--dedup-cols",
+                         nargs="*",
+                         default=None,
+                         help=( "If using --sort-and-dedup, rows with the same values in these columns \n"
+                                "are duplicates. By default, rows with the same ID are duplicates."
+                              )
+                       )
+
+    parser.add_argument( "--result-cache",
+                         default=None,
+                         help=( "Path of a local file to cache the results of processing each distinct text in, \n"
+                                "so that text seen in earlier batches or runs is not processed again. \n"
+                                "The least recently used results are evicted once the file reaches --result-cache-size."
+                              )
+                       )
+
+    parser.add_argument( "--result-cache-size",
+                         type=int,
+                         default=1024,
+                         help="The maximum size of the local result cache, in MB."
+                       )
+
+    parser.add_argument( "--shared-result-cache-type",
+                         choices=["fs", "s3"],
+                         default=None,
+                         help=( "Where to store a result cache that is shared with other hosts. \n"
+                                "If --result-cache is also used, it caches results from the shared cache locally."
+                              )
+                       )
+
+    parser.add_argument( "--shared-result-cache-name",
+                         default=None,
+                         help=( "Name of the folder to store the shared result cache in. \n"
+                                "If using S3, use the format bucket-name/folder/name."
+                              )
+                       )
+
+    parser.add_argument( "--spelling-cache",
+                         default=None,
+                         help=( "If preprocessing, path of a local file to store spelling corrections of \n"
+                                "sentences in, so that they are reused by later runs. Corrections are only \n"
+                                "reused with the same spell checking model."
+                              )
+                       )
+
+    parser.add_argument( "--spelling-cache-size",
+                         type=int,
+                         default=256,
+                         help="The maximum size of the spelling cache, in MB."
+                       )
+
+    parser.add_argument( "--known-words",
+                         default=None,
+                         help=( "If preprocessing, path of a file with one correctly spelled word per line, \n"
+                                "such as the vocabulary of a word2vec model. Sentences in which every word \n"
+                                "is known are not spell checked, which is much faster, but known words used \n"
+                                "in the wrong context are not corrected."
+                              )
+                       )
+
+    parser.add_argument( "--normalization-stages",
+                         type=get_normalization_stage_names,
+                         default="urls",
+                         metavar="{" + ",".join(NORMALIZATION_STAGE_TYPES) + "}",
+                         help=( "If preprocessing, comma separated steps to normalize text with before \n"
+                                "correcting its spelling, in the order they are applied. The steps remove \n"
+                                "URL's, remove mentions, remove the # from hashtags, collapse whitespace, \n"
+                                "and apply NFKC unicode normalization."
+                              )
+                       )
+
+    parser.add_argument( "--corenlp-requests",
+                         type=int,
+                         default=4,
+                         help=( "If extracting WH phrases, the number of texts to send to the CoreNLP server \n"
+                                "at once by each worker. Results are still in the same order as the texts."
+                              )
+                       )
+
+    parser.add_argument( "--corenlp-urls",
+                         type=get_corenlp_urls,
+                         default=["http://corenlp-service:9000"],
+                         help=( "If extracting WH phrases, comma separated URL's of Stanford CoreNLP servers. \n"
+                                "Each request is sent to the ready server with the fewest outstanding requests, \n"
+                                "and servers that fail are retried with exponential backoff."
+                              )
+                       )
+
+    parser.add_argument( "--corenlp-cache",
+                         default=None,
+                         help=( "If extracting WH phrases, path of a local file to store the CoreNLP annotations \n"
+                                "of texts in, so that texts are not annotated again by later runs, even if \n"
+                                "they use different extractors."
+                              )
+                       )
+
+    parser.add_argument( "--corenlp-cache-size",
+                         type=int,
+                         default=4096,
+                         help="The maximum size of the local CoreNLP annotation cache, in MB."
+                       )
+
+    parser.add_argument( "--shared-corenlp-cache-type",
+                         choices=["fs", "s3"],
+                         default=None,
+                         help=( "Where to store a CoreNLP annotation cache that is shared with other hosts. \n"
+                                "If --corenlp-cache is also used, it caches annotations from the shared cache locally."
+                              )
+                       )
+
+    parser.add_argument( "--shared-corenlp-cache-name",
+                         default=None,
+                         help=( "Name of the folder to store the shared CoreNLP annotation cache in. \n"
+                                "If using S3, use the format bucket-name/folder/name."
+                              )
+                       )
+
     args = parser.parse_args()
 
+    batch_format = get_batch_format(args.format)
+
+    compression = get_compression(args.compression)
+
+    claim_check_store = get_claim_check_store( args.claim_check_type,
+                                               args.claim_check_name
+                                             )
+
     batch_dest = get_batch_destination( args.dest_type,
                                         args.dest_name,
-                                        args.aws_region
+                                        args.aws_region,
+                                        claim_check_store,
+                                        compression,
+                                        max(args.upload_threads, 10),
+                                        batch_format,
+                                        args.id_col
                                       )
 
     if args.populate:
         df_file_name = args.source_name
         populate( df_file_name,
                   batch_dest,
-                  args.batch_size
+                  args.batch_size,
+                  batch_format,
+                  args.upload_threads
                 )
     else:
+        result_cache = get_result_cache( args.result_cache,
+                                         args.result_cache_size,
+                                         args.shared_result_cache_type,
+                                         args.shared_result_cache_name
+                                       )
+        spelling_cache = None
+        if args.spelling_cache is not None:
+            spelling_cache = LocalResultCache(args.spelling_cache, max_size_bytes=args.spelling_cache_size * 1024**2)
+        annotation_cache = get_result_cache( args.corenlp_cache,
+                                             args.corenlp_cache_size,
+                                             args.shared_corenlp_cache_type,
+                                             args.shared_corenlp_cache_name
+                                           )
+        known_words = load_known_words(args.known_words) if args.known_words is not None else None
+        normalization_stages = get_normalization_stages(args.normalization_stages)
         batch_source = get_batch_source( args.source_type,
                                          args.source_name,
                                          args.delete_when_complete,
-                                         args.aws_region
+                                         args.aws_region,
+                                         args.max_idle_time,
+                                         args.max_visibility_extension,
+                                         args.download_threads,
+                                         get_completion_manifest(args.manifest_type, args.manifest_name),
+                                         args.lease_time,
+                                         args.mmap,
+                                         args.watch,
+                                         args.sqs_max_messages,
+                                         args.visibility_timeout
                                        )
-        batch_processor = get_batch_processor( batch_processor_type=args.process,
-                                               batch_source=batch_source,
-                                               batch_dest=batch_dest,
-                                               id_col_name=args.id_col,
-                                               source_col_name=args.source_col,
-                                               dest_col_name=args.dest_col,
-                                               include_cols=args.include_cols
-                                             )
-        process(batch_processor)
+        if len(args.process) == 1:
+            batch_processor = get_batch_processor( batch_processor_type=args.process[0],
+                                                   batch_source=batch_source,
+                                                   batch_dest=batch_dest,
+                                                   id_col_name=args.id_col,
+                                                   source_col_name=args.source_col,
+                                                   dest_col_name=args.dest_col,
+                                                   include_cols=args.include_cols,
+                                                   batch_format=batch_format,
+                                                   sort_and_dedup=args.sort_and_dedup,
+                                                   dedup_col_names=args.dedup_cols,
+                                                   result_cache=result_cache,
+                                                   spelling_cache=spelling_cache,
+                                                   known_words=known_words,
+                                                   normalization_stages=normalization_stages,
+                                                   num_corenlp_requests=args.corenlp_requests,
+                                                   corenlp_urls=args.corenlp_urls,
+                                                   annotation_cache=annotation_cache
+                                                 )
+        else:
+            intermediate_dest_names = args.intermediate_dest_names if args.intermediate_dest_names is not None else []
+            intermediate_dests = [ get_batch_destination(args.dest_type, intermediate_dest_name, args.aws_region, claim_check_store, compression,
+                                                         batch_format=batch_format, id_col_name=args.id_col)
+                                   for intermediate_dest_name in intermediate_dest_names ]
+            batch_processor = get_chained_batch_processor( batch_processor_types=args.process,
+                                                           batch_source=batch_source,
+                                                           batch_dest=batch_dest,
+                                                           id_col_name=args.id_col,
+                                                           source_col_name=args.source_col,
+                                                           dest_col_name=args.dest_col,
+                                                           include_cols=args.include_cols,
+                                                           intermediate_dests=intermediate_dests,
+                                                           batch_format=batch_format,
+                                                           result_cache=result_cache,
+                                                           spelling_cache=spelling_cache,
+                                                           known_words=known_words,
+                                                           normalization_stages=normalization_stages,
+                                                           num_corenlp_requests=args.corenlp_requests,
+                                                           corenlp_urls=args.corenlp_urls,
+                                                           annotation_cache=annotation_cache
+                                                         )
+        process( batch_processor,
+                 args.fetch_queue_depth,
+                 args.publish_queue_depth,
+                 args.workers,
+                 args.dest_type
+               )
 
 if __name__ == "__main__":
     main()
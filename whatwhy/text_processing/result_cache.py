@@ -0,0 +1,265 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from .clients.client import logger
+from .clients.s3_client import get_error_code
+
+MISSING_RESULT = object()
+
+class ResultCacheBase():
+    """
+    Stores the results of processing individual values, such as the text of a row,
+    by a key that is a hash of the value and the configuration of the batch processor.
+    Results are stored as JSON, so they should be strings, numbers, lists, dicts or None.
+    """
+
+    def get_many(self, keys):
+        """Returns a dict of the results that are stored for any of the keys."""
+        raise NotImplementedError()
+
+    def put_many(self, results):
+        """Stores a dict of results by their keys."""
+        raise NotImplementedError()
+
+class LocalResultCache(ResultCacheBase):
+    """
+    Stores results in a local SQLite database file, which is limited to about max_size_bytes.
+    Once the cache is larger than that, the least recently used results are evicted until
+    it is 10% smaller. Worker processes open their own connection to the database.
+    """
+
+    def __init__(self, file_name, max_size_bytes=1024**3):
+        logger.info(f"Using local result cache {file_name}.")
+        self.file_name = file_name
+        self.max_size_bytes = max_size_bytes
+        self.connection = None
+        self.connection_pid = None
+        self.connection_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["connection"] = None
+        state["connection_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.connection_lock = threading.Lock()
+
+    def get_connection(self):
+        """Returns the connection of this process, since connections cannot be shared with forked processes."""
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.file_name, timeout=60, isolation_level=None, check_same_thread=False)
+            self.connection_pid = os.getpid()
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute( "CREATE TABLE IF NOT EXISTS results ( "
+                                     "key TEXT PRIMARY KEY, "
+                                     "value TEXT NOT NULL, "
+                                     "size INTEGER NOT NULL, "
+                                     "last_used_time REAL NOT NULL )" )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used_time ON results (last_used_time)")
+            # The total size of the results is kept up to date as they are stored and evicted,
+            # so it does not need to be summed over the whole table.
+            self.connection.execute("CREATE TABLE IF NOT EXISTS total_size ( id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL )")
+            self.connection.execute("INSERT OR IGNORE INTO total_size (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM results")
+        return self.connection
+
+    def get_many(self, keys):
+        results = {}
+        with self.connection_lock:
+            connection = self.get_connection()
+            # SQLite limits the number of parameters in a statement.
+            for i in range(0, len(keys), 500):
+                key_group = keys[i:i+500]
+                parameters = ",".join("?" * len(key_group))
+                for key, value in connection.execute(f"SELECT key, value FROM results WHERE key IN ({parameters})", key_group):
+                    results[key] = json.loads(value)
+                if len(results) > 0:
+                    connection.execute(f"UPDATE results SET last_used_time = ? WHERE key IN ({parameters})", [time.time()] + key_group)
+        return results
+
+    def put_many(self, results):
+        now = time.time()
+        rows = []
+        for key, result in results.items():
+            value = json.dumps(result)
+            rows.append( (key, value, len(key) + len(value), now) )
+        with self.connection_lock:
+            connection = self.get_connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                replaced_size = 0
+                for i in range(0, len(rows), 500):
+                    row_group = rows[i:i+500]
+                    parameters = ",".join("?" * len(row_group))
+                    replaced_size += connection.execute( f"SELECT COALESCE(SUM(size), 0) FROM results WHERE key IN ({parameters})",
+                                                         [ row[0] for row in row_group ] ).fetchone()[0]
+                connection.executemany("INSERT OR REPLACE INTO results (key, value, size, last_used_time) VALUES (?, ?, ?, ?)", rows)
+                added_size = sum( row[2] for row in rows ) - replaced_size
+                connection.execute("UPDATE total_size SET size = size + ? WHERE id = 0", (added_size,))
+                self.evict_least_recently_used(connection)
+                connection.execute("COMMIT")
+            except Exception as e:
+                connection.execute("ROLLBACK")
+                raise e
+
+    def evict_least_recently_used(self, connection):
+        total_size = connection.execute("SELECT size FROM total_size WHERE id = 0").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        size_to_evict = total_size - int(0.9 * self.max_size_bytes)
+        evicted_keys = []
+        evicted_size = 0
+        for key, size in connection.execute("SELECT key, size FROM results ORDER BY last_used_time"):
+            evicted_keys.append( (key,) )
+            evicted_size += size
+            if evicted_size >= size_to_evict:
+                break
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted_keys)
+        connection.execute("UPDATE total_size SET size = size - ? WHERE id = 0", (evicted_size,))
+        logger.info(f"Evicted {len(evicted_keys)} least recently used results from local result cache.")
+
+class FileSystemResultCache(ResultCacheBase):
+    """
+    Stores results as files in a local or shared file system folder, so that they can be shared
+    by several hosts. Results are never evicted, so old results should be deleted separately.
+    """
+
+    def __init__(self, folder_name):
+        logger.info(f"Using result cache in local folder {folder_name}.")
+        self.folder_name = folder_name
+        os.makedirs(folder_name, exist_ok=True)
+
+    def get_file_name(self, key):
+        # Results are spread over subfolders, so that no folder holds too many files.
+        return os.path.join(self.folder_name, key[:2], key + ".json")
+
+    def get_many(self, keys):
+        results = {}
+        for key in keys:
+            try:
+                with open(self.get_file_name(key), "r") as result_file:
+                    results[key] = json.load(result_file)
+            except FileNotFoundError:
+                continue
+            except ValueError as e:
+                logger.error(f"Ignoring malformed result {key} in result cache: {e}")
+        return results
+
+    def put_many(self, results):
+        for key, result in results.items():
+            file_name = self.get_file_name(key)
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            # Results are written under a temporary name and renamed, so they are never read partially written.
+            partial_file_name = f"{file_name}.{os.getpid()}-{threading.get_ident()}.partial"
+            with open(partial_file_name, "w") as result_file:
+                json.dump(result, result_file)
+            os.replace(partial_file_name, file_name)
+
+class S3ResultCache(ResultCacheBase):
+    """
+    Stores results as objects under an AWS S3 bucket/folder, so that they can be shared
+    by several hosts. Results are looked up and stored concurrently by num_threads threads.
+    Results are never evicted, so a lifecycle rule should be used to expire old results.
+    """
+
+    def __init__(self, bucket_name, folder_name, num_threads=16):
+        logger.info(f"Using result cache in S3 bucket/folder '{bucket_name}/{folder_name}'.")
+        self.bucket_name = bucket_name
+        self.folder_name = folder_name.rstrip("/") + "/"
+        self.num_threads = num_threads
+        self.s3 = None
+        self.s3_pid = None
+        self.s3_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["s3"] = None
+        state["s3_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.s3_lock = threading.Lock()
+
+    def get_s3(self):
+        """
+        Returns the S3 client of this process. The client is created while holding a lock,
+        since creating clients is not thread-safe, but it can then be used by several threads.
+        """
+        with self.s3_lock:
+            if self.s3 is None or self.s3_pid != os.getpid():
+                config = Config(max_pool_connections=self.num_threads, retries={"mode" : "adaptive"})
+                self.s3 = boto3.client("s3", config=config)
+                self.s3_pid = os.getpid()
+            return self.s3
+
+    def get_key(self, key):
+        return f"{self.folder_name}{key}.json"
+
+    def get_result(self, key):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.get_key(key))
+            return key, json.loads(obj["Body"].read())
+        except ClientError as e:
+            if get_error_code(e) not in ("NoSuchKey", "404"):
+                logger.error(f"Failed to get result {key} from result cache: {e}")
+        except ValueError as e:
+            logger.error(f"Ignoring malformed result {key} in result cache: {e}")
+        return key, MISSING_RESULT
+
+    def put_result(self, key, result):
+        try:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.get_key(key), Body=json.dumps(result).encode("utf-8"))
+        except Exception as e:
+            logger.error(f"Failed to put result {key} in result cache: {e}")
+
+    def get_many(self, keys):
+        if len(keys) == 0:
+            return {}
+        self.get_s3()
+        # Single results, such as those looked up by several threads at once, are not worth starting threads for.
+        if len(keys) == 1:
+            key_results = [ self.get_result(keys[0]) ]
+        else:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                key_results = list(executor.map(self.get_result, keys))
+        return { key : result for key, result in key_results if result is not MISSING_RESULT }
+
+    def put_many(self, results):
+        if len(results) == 0:
+            return
+        self.get_s3()
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            list(executor.map(self.put_result, results.keys(), results.values()))
+
+class TieredResultCache(ResultCacheBase):
+    """
+    Looks up results in a local cache, and then in a shared cache. Results found in the shared cache
+    are also stored in the local cache, and new results are stored in both.
+    """
+
+    def __init__(self, local_cache, shared_cache):
+        self.local_cache = local_cache
+        self.shared_cache = shared_cache
+
+    def get_many(self, keys):
+        results = self.local_cache.get_many(keys)
+        missed_keys = [ key for key in keys if key not in results ]
+        if len(missed_keys) > 0:
+            shared_results = self.shared_cache.get_many(missed_keys)
+            if len(shared_results) > 0:
+                self.local_cache.put_many(shared_results)
+                results.update(shared_results)
+        return results
+
+    def put_many(self, results):
+        self.local_cache.put_many(results)
+        self.shared_cache.put_many(results)
@@ -0,0 +1,106 @@
+import re
+import hashlib
+from collections import OrderedDict
+from .clients.client import logger
+
+# Sentences are split after sentence-ending punctuation followed by whitespace. jamspell also ends
+# sentences there, and corrects each sentence independently, so correcting them separately
+# gives the same results as correcting the whole text.
+SENTENCE_BOUNDARY_REGEX = re.compile(r"(?<=[.!?])(\s+)")
+
+WORD_REGEX = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+
+def load_known_words(file_name):
+    """Returns the set of lowercase words in a file with one word per line."""
+    with open(file_name, "r", encoding="utf-8") as in_file:
+        known_words = frozenset( line.strip().lower() for line in in_file if line.strip() != "" )
+    logger.info(f"Loaded {len(known_words)} known words from {file_name}.")
+    return known_words
+
+def get_file_hash(file_name):
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(1024**2), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+class SpellingCorrector():
+    """
+    Corrects the spelling of text with a jamspell spell checker one sentence at a time,
+    and memoizes the corrections of up to max_cached_sentences recently used sentences.
+
+    If a persistent ResultCache is specified, corrections are also stored in it so they can be
+    reused by later runs. Its keys include model_hash, which should be a hash of the jamspell model,
+    so that corrections are not reused once the model changes. New corrections are buffered
+    until flush() is called.
+
+    If a set of known_words is specified, sentences in which every word is known are assumed
+    to be spelled correctly, and are not checked. This skips most sentences, but unlike the spell
+    checker, it does not correct known words that are used in the wrong context.
+    """
+
+    def __init__(self, spell_checker, max_cached_sentences=100000, persistent_cache=None, model_hash="", known_words=None):
+        self.spell_checker = spell_checker
+        self.max_cached_sentences = max_cached_sentences
+        self.cached_sentences = OrderedDict()
+        self.persistent_cache = persistent_cache
+        self.model_hash = model_hash
+        self.known_words = known_words
+        self.unflushed_corrections = {}
+        self.num_known_sentences = 0
+        self.num_cache_hits = 0
+        self.num_cache_misses = 0
+
+    def correct(self, text):
+        parts = SENTENCE_BOUNDARY_REGEX.split(text)
+        # Sentences are at even indices, and the whitespace separating them at odd indices.
+        parts[::2] = [ self.correct_sentence(sentence) for sentence in parts[::2] ]
+        return "".join(parts)
+
+    def correct_sentence(self, sentence):
+        if sentence == "":
+            return sentence
+        if self.known_words is not None and self.has_only_known_words(sentence):
+            self.num_known_sentences += 1
+            return sentence
+        corrected_sentence = self.cached_sentences.get(sentence)
+        if corrected_sentence is not None:
+            self.cached_sentences.move_to_end(sentence)
+            self.num_cache_hits += 1
+            return corrected_sentence
+
+        key = self.get_persistent_cache_key(sentence) if self.persistent_cache is not None else None
+        if key is not None:
+            corrected_sentence = self.unflushed_corrections.get(key)
+            if corrected_sentence is None:
+                corrected_sentence = self.persistent_cache.get_many([key]).get(key)
+        if corrected_sentence is not None:
+            self.num_cache_hits += 1
+        else:
+            corrected_sentence = self.spell_checker.FixFragment(sentence)
+            self.num_cache_misses += 1
+            if key is not None:
+                self.unflushed_corrections[key] = corrected_sentence
+
+        self.cached_sentences[sentence] = corrected_sentence
+        if len(self.cached_sentences) > self.max_cached_sentences:
+            self.cached_sentences.popitem(last=False)
+        return corrected_sentence
+
+    def has_only_known_words(self, sentence):
+        return all( word.lower() in self.known_words for word in WORD_REGEX.findall(sentence) )
+
+    def get_persistent_cache_key(self, sentence):
+        return hashlib.sha256(f"{self.model_hash}\n{sentence}".encode("utf-8")).hexdigest()
+
+    def flush(self):
+        """Stores any buffered corrections in the persistent cache, and logs how many sentences were corrected."""
+        if self.num_known_sentences + self.num_cache_hits + self.num_cache_misses > 0:
+            logger.info( f"Spelling corrections: {self.num_known_sentences} sentences had only known words, "
+                         f"{self.num_cache_hits} were cached, {self.num_cache_misses} were corrected." )
+        self.num_known_sentences = 0
+        self.num_cache_hits = 0
+        self.num_cache_misses = 0
+        if self.persistent_cache is not None and len(self.unflushed_corrections) > 0:
+            self.persistent_cache.put_many(self.unflushed_corrections)
+            self.unflushed_corrections = {}
@@ -0,0 +1,109 @@
+import re
+import time
+import pandas as pd
+from .clients.client import logger
+
+URL_REGEX = re.compile( r'''(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))''',
+                        flags=re.MULTILINE )
+
+class NormalizationStageBase():
+    """A step of text normalization, which is applied to a whole column of text at once."""
+
+    name = None
+
+    def normalize_column(self, values):
+        raise NotImplementedError()
+
+class RegexReplacementStage(NormalizationStageBase):
+    """Replaces every match of a compiled regular expression."""
+
+    pattern = None
+    replacement = ""
+
+    def normalize_column(self, values):
+        return values.str.replace(self.pattern, self.replacement, regex=True)
+
+class URLRemovalStage(RegexReplacementStage):
+    """Removes URL's."""
+
+    name = "urls"
+    pattern = URL_REGEX
+
+class MentionRemovalStage(RegexReplacementStage):
+    """Removes mentions of users, such as @whatwhy."""
+
+    name = "mentions"
+    pattern = re.compile(r"(?<!\w)@\w+")
+
+class HashtagStrippingStage(RegexReplacementStage):
+    """Removes the # from hashtags, keeping their text as a word."""
+
+    name = "hashtags"
+    pattern = re.compile(r"(?<!\w)#(\w+)")
+    replacement = r"\1"
+
+class WhitespaceCollapseStage(RegexReplacementStage):
+    """Replaces runs of whitespace with a single space, and removes leading and trailing whitespace."""
+
+    name = "whitespace"
+    pattern = re.compile(r"\s+")
+    replacement = " "
+
+    def normalize_column(self, values):
+        return super().normalize_column(values).str.strip()
+
+class UnicodeNormalizationStage(NormalizationStageBase):
+    """Normalizes unicode text to the NFKC form, so that equivalent characters are represented the same way."""
+
+    name = "unicode"
+
+    def normalize_column(self, values):
+        return values.str.normalize("NFKC")
+
+NORMALIZATION_STAGE_TYPES = { stage_type.name : stage_type for stage_type in [ URLRemovalStage,
+                                                                               MentionRemovalStage,
+                                                                               HashtagStrippingStage,
+                                                                               WhitespaceCollapseStage,
+                                                                               UnicodeNormalizationStage ] }
+
+def get_normalization_stages(stage_names):
+    stages = []
+    for stage_name in stage_names:
+        if stage_name not in NORMALIZATION_STAGE_TYPES:
+            raise AttributeError(f"Unsupported normalization stage {stage_name}.")
+        stages.append(NORMALIZATION_STAGE_TYPES[stage_name]())
+    return stages
+
+class TextNormalizer():
+    """
+    Applies an ordered list of normalization stages to columns of text. Missing values are left as they are.
+
+    The time spent in each stage, and the number of values it changed, are recorded
+    until log_statistics() is called.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.stage_seconds = { stage.name : 0.0 for stage in stages }
+        self.stage_hits = { stage.name : 0 for stage in stages }
+
+    def normalize_column(self, values):
+        if len(self.stages) == 0 or len(values) == 0:
+            return values
+        if not pd.api.types.is_object_dtype(values) and not pd.api.types.is_string_dtype(values):
+            return values
+        for stage in self.stages:
+            start_time = time.perf_counter()
+            normalized_values = stage.normalize_column(values)
+            self.stage_seconds[stage.name] += time.perf_counter() - start_time
+            self.stage_hits[stage.name] += int((normalized_values != values).sum() - values.isna().sum())
+            values = normalized_values
+        return values
+
+    def log_statistics(self):
+        if len(self.stages) == 0:
+            return
+        stage_statistics = [ f"{name} changed {self.stage_hits[name]} values in {self.stage_seconds[name]:.3f}s" for name in self.stage_seconds ]
+        logger.info("Text normalization: " + ", ".join(stage_statistics) + ".")
+        self.stage_seconds = { name : 0.0 for name in self.stage_seconds }
+        self.stage_hits = { name : 0 for name in self.stage_hits }